@@ -26,10 +26,84 @@ def create_app():
     app.config['JWT_SECRET_KEY'] = os.environ.get('JWT_SECRET_KEY', 'dev-secret-key-change-in-production')
     app.config['JWT_ACCESS_TOKEN_EXPIRES'] = 3600  # 1小时
     
+    # 配置画像快照目录
+    app.config['MATCH_SNAPSHOT_DIR'] = os.environ.get('MATCH_SNAPSHOT_DIR', os.path.join(app.instance_path, 'snapshot'))
+    
+    # 配置跨worker共享的经理模型目录（所有worker必须指向同一目录）
+    app.config['MATCH_MANAGER_MODEL_DIR'] = os.environ.get('MATCH_MANAGER_MODEL_DIR', os.path.join(app.instance_path, 'manager_model'))
+    
+    # 分类打分使用的进程数，大于1时按客户分片并行计算
+    app.config['MATCH_WORKERS'] = int(os.environ.get('MATCH_WORKERS', 1))
+    
+    # 近似候选生成的 LSH 设置（如 32x2），为空时对所有客户-经理对精确打分
+    app.config['MATCH_LSH'] = os.environ.get('MATCH_LSH', '')
+    
+    # 聚类中心剪枝设置（候选数[:退回阈值差]，如 20:1），设置后优先于 LSH
+    app.config['MATCH_PRUNE'] = os.environ.get('MATCH_PRUNE', '')
+    
+    # 是否按网点分区执行自动分配，以及同时执行的网点数
+    app.config['MATCH_PARTITION_BY_BRANCH'] = os.environ.get('MATCH_PARTITION_BY_BRANCH', '').lower() in ('1', 'true', 'yes')
+    app.config['MATCH_BRANCH_PARALLEL'] = int(os.environ.get('MATCH_BRANCH_PARALLEL', 4))
+    
+    # 流式分类（flask match stream）的常驻内存预算（MB），0表示不限制
+    app.config['MATCH_MEMORY_BUDGET_MB'] = int(os.environ.get('MATCH_MEMORY_BUDGET_MB', 0))
+    
+    # 分数缓存中每个客户保留的候选经理数
+    app.config['MATCH_SCORE_TOP_N'] = int(os.environ.get('MATCH_SCORE_TOP_N', 10))
+    
+    # 分类批处理结束后预先生成客户洞察，经理客户簿的批量洞察接口直接读取
+    app.config['INSIGHTS_PRECOMPUTED'] = os.environ.get('INSIGHTS_PRECOMPUTED', '').lower() in ('1', 'true', 'yes')
+    
+    # 匹配历史归档文件目录
+    app.config['MATCH_HISTORY_ARCHIVE_DIR'] = os.environ.get('MATCH_HISTORY_ARCHIVE_DIR', os.path.join(app.instance_path, 'history_archive'))
+    
+    # 是否在 create_app 时预加载匹配算法依赖的模块
+    app.config['MATCH_PRELOAD'] = os.environ.get('MATCH_PRELOAD', '').lower() in ('1', 'true', 'yes')
+    
+    # 按端点的并发上限（如 admin_stats=2,customers=4，0表示不限制）和槽位锁文件目录（同一台机器的所有worker共用）
+    from app.utils.admission import parse_limits
+    app.config['CONCURRENCY_LIMITS'] = parse_limits(os.environ.get('CONCURRENCY_LIMITS', ''))
+    app.config['CONCURRENCY_LOCK_DIR'] = os.environ.get('CONCURRENCY_LOCK_DIR', os.path.join(app.instance_path, 'locks'))
+    
+    # JSON 序列化（orjson 未安装时使用 Flask 默认实现）和大响应的 gzip 压缩阈值（字节，0表示不压缩）
+    app.config['JSON_PROVIDER'] = os.environ.get('JSON_PROVIDER', 'orjson')
+    app.config['GZIP_MIN_SIZE'] = int(os.environ.get('GZIP_MIN_SIZE', 1024))
+    app.config['GZIP_LEVEL'] = int(os.environ.get('GZIP_LEVEL', 6))
+    
+    # 按需剖析（默认关闭，不注册任何钩子）：开启后管理员用 X-Profile 请求头剖析单个请求，
+    # 以及 /api 请求的随机抽样比例（0表示不抽样）和剖析结果目录
+    app.config['PROFILE_REQUESTS'] = os.environ.get('PROFILE_REQUESTS', '0').lower() in ('1', 'true', 'yes')
+    app.config['PROFILE_SAMPLE_RATE'] = float(os.environ.get('PROFILE_SAMPLE_RATE', 0))
+    app.config['PROFILE_DIR'] = os.environ.get('PROFILE_DIR', os.path.join(app.instance_path, 'profiles'))
+    
+    # 仪表盘事件推送（/api/admin/events）：事件库文件（同一台机器的所有worker必须相同）、保留的事件数、
+    # worker 轮询事件库的间隔、心跳间隔、单个连接的最长时间（到期后浏览器自动重连，0表示不限制）和重连间隔（秒）
+    app.config['EVENTS_ENABLED'] = os.environ.get('EVENTS_ENABLED', '1').lower() in ('1', 'true', 'yes')
+    app.config['EVENTS_DB'] = os.environ.get('EVENTS_DB', os.path.join(app.instance_path, 'events.db'))
+    app.config['EVENTS_RETENTION'] = int(os.environ.get('EVENTS_RETENTION', 10000))
+    app.config['EVENTS_POLL_INTERVAL'] = float(os.environ.get('EVENTS_POLL_INTERVAL', 0.5))
+    app.config['EVENTS_HEARTBEAT'] = float(os.environ.get('EVENTS_HEARTBEAT', 15))
+    app.config['EVENTS_STREAM_SECONDS'] = float(os.environ.get('EVENTS_STREAM_SECONDS', 300))
+    app.config['EVENTS_RETRY_SECONDS'] = float(os.environ.get('EVENTS_RETRY_SECONDS', 3))
+    # 事件令牌（只能订阅事件流，放在 URL 中）的有效期（秒），只需覆盖从签发到建立连接
+    app.config['EVENTS_TOKEN_SECONDS'] = int(os.environ.get('EVENTS_TOKEN_SECONDS', 60))
+    # 批处理进度事件的最小间隔（秒）
+    app.config['EVENTS_PROGRESS_INTERVAL'] = float(os.environ.get('EVENTS_PROGRESS_INTERVAL', 1))
+    
+    from app.utils.serialization import json_provider_class
+    from app.utils.compression import init_compression
+    app.json = json_provider_class(app.config['JSON_PROVIDER'])(app)
+    init_compression(app)
+    
+    from app.utils.profiling import init_profiling
+    init_profiling(app)
+    
     # 初始化扩展
     db.init_app(app)
     migrate.init_app(app, db)
     jwt.init_app(app)
+    from app.utils.events import init_events_tokens
+    init_events_tokens(jwt)
     
     # 允许跨域请求
     CORS(app, resources={r"/api/*": {"origins": "*"}})
@@ -41,6 +115,15 @@ def create_app():
     app.register_blueprint(auth_bp, url_prefix='/api/auth')
     app.register_blueprint(api_bp, url_prefix='/api')
     
+    # 需要时在启动阶段预加载匹配算法（numpy/scikit-learn），否则在第一次用到时加载
+    if app.config['MATCH_PRELOAD']:
+        from app.utils import preload
+        preload()
+    
+    # 注册命令行工具
+    from app.cli import register_cli
+    register_cli(app)
+    
     # 健康检查路由
     @app.route('/api/health')
     def health():
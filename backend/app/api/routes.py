@@ -1,9 +1,18 @@
-from flask import request, jsonify, current_app
+import time
+from datetime import date
+from flask import Response, request, jsonify, current_app
 from app import db
-from app.models import User, CustomerProfile, ManagerProfile, MatchHistory
+from app.models import User, CustomerProfile, ManagerProfile, MatchHistory, OperationRun
 from app.api import api_bp
-from flask_jwt_extended import jwt_required, get_jwt_identity
-from app.utils.clustering import classify_customers, auto_assign_customers, compute_similarity_score, generate_customer_insights
+from app.api.serializers import AI_INTERACTION_ROW, MATCH_CUSTOMER, MATCH_HISTORY_ROW, MATCH_MANAGER, USER_ROW
+from flask_jwt_extended import jwt_required, get_jwt, get_jwt_identity
+from app.utils.admission import limit_concurrency
+from app.utils.ai_feed import conversation_page, mark_all_read, mark_read, unread_count
+from app.utils.events import publish_customer_change
+from app.utils.match_history import daily_stats, history_page, record_matches
+from app.utils.single_flight import MATCH_OPERATION, OperationBusy, single_flight
+
+# 匹配相关的模块依赖 numpy/scikit-learn，在用到的视图函数中再导入，worker 启动时不加载
 
 # 客户相关API
 @api_bp.route('/customers/<int:user_id>/profile', methods=['GET'])
@@ -20,6 +29,10 @@ def get_customer_profile(user_id):
 @api_bp.route('/customers/<int:user_id>/profile', methods=['PUT'])
 @jwt_required()
 def update_customer_profile(user_id):
+    from app.utils.manager_model import notify_managers_changed
+    from app.utils.realtime import rematch_customer
+    from app.utils.score_cache import refresh_customer_scores
+    
     current_user_id = get_jwt_identity()
     
     # 检查权限（只有自己或管理员可以更新自己的资料）
@@ -32,6 +45,7 @@ def update_customer_profile(user_id):
     
     if not customer_profile:
         return jsonify({'msg': '未找到客户资料'}), 404
+    before = (customer_profile.customer_class, customer_profile.manager_id)
     
     # 更新资料字段
     if 'age' in data:
@@ -45,19 +59,49 @@ def update_customer_profile(user_id):
     if 'hobbies' in data:
         customer_profile.hobbies = data['hobbies']
     
-    # 管理员可以更新分类和分配经理
+    # 管理员可以更新分类、分配经理和所属网点
     if current_user.role == 'admin':
         if 'customer_class' in data:
             customer_profile.customer_class = data['customer_class']
+            # 显式指定的等级不随规则变化重新计算，直到下一次分类
+            customer_profile.best_needs_match = None
+            customer_profile.best_hobbies_match = None
         if 'manager_id' in data:
             customer_profile.manager_id = data['manager_id']
+        if 'branch' in data:
+            customer_profile.branch = data['branch']
+    
+    # 需求或爱好变化后立即重新计算等级和最佳经理（管理员显式指定的字段优先）
+    rematch = None
+    if ('needs' in data or 'hobbies' in data) and not (current_user.role == 'admin' and 'customer_class' in data):
+        had_manager = customer_profile.manager_id is not None
+        try:
+            rematch = rematch_customer(customer_profile, assign=not had_manager, created_by=current_user_id)
+            refresh_customer_scores(customer_profile)
+        except Exception as e:
+            current_app.logger.warning(f"实时重新匹配失败: {str(e)}")
+    
+    # 预生成的洞察随等级、需求和爱好一起更新
+    if current_app.config['INSIGHTS_PRECOMPUTED'] and {'needs', 'hobbies', 'customer_class'} & set(data):
+        from app.utils.insights import write_insights
+        write_insights([user_id])
     
     db.session.commit()
     
-    return jsonify(customer_profile.to_dict()), 200
+    # 分配关系变化会改变经理负载
+    if (current_user.role == 'admin' and 'manager_id' in data) or (rematch and rematch['assigned_manager_id']):
+        notify_managers_changed()
+    publish_customer_change(user_id, before, (customer_profile.customer_class, customer_profile.manager_id),
+                            'profile-update')
+    
+    result = customer_profile.to_dict()
+    if rematch:
+        result['rematch'] = rematch
+    return jsonify(result), 200
 
 @api_bp.route('/customers', methods=['GET'])
 @jwt_required()
+@limit_concurrency('customers', 0)
 def get_all_customers():
     # 获取当前用户
     current_user_id = get_jwt_identity()
@@ -69,16 +113,17 @@ def get_all_customers():
     
     # 如果是经理，只返回分配给他的客户
     if current_user.role == 'manager':
-        customers_query = User.query.join(CustomerProfile).filter(
+        customers_query = User.query.join(CustomerProfile, CustomerProfile.user_id == User.id).filter(
             User.role == 'customer',
             CustomerProfile.manager_id == current_user_id
         )
     else:  # 管理员可以查看所有客户
         customers_query = User.query.filter_by(role='customer')
     
-    customers = customers_query.all()
+    # 只查询输出需要的列，直接由结果元组生成响应
+    customers = customers_query.with_entities(*USER_ROW.columns).all()
     
-    return jsonify([c.to_dict() for c in customers]), 200
+    return jsonify(USER_ROW(customers)), 200
 
 @api_bp.route('/customers/classification', methods=['GET'])
 @jwt_required()
@@ -114,6 +159,9 @@ def get_manager_profile(user_id):
 @api_bp.route('/managers/<int:user_id>/profile', methods=['PUT'])
 @jwt_required()
 def update_manager_profile(user_id):
+    from app.utils.manager_model import notify_managers_changed
+    from app.utils.realtime import rescore_manager_customers_async
+    
     current_user_id = get_jwt_identity()
     
     # 检查权限（只有自己或管理员可以更新自己的资料）
@@ -132,8 +180,16 @@ def update_manager_profile(user_id):
         manager_profile.capabilities = data['capabilities']
     if 'hobbies' in data:
         manager_profile.hobbies = data['hobbies']
+    # 只有管理员可以调整经理所属网点
+    if 'branch' in data and current_user.role == 'admin':
+        manager_profile.branch = data['branch']
     
     db.session.commit()
+    notify_managers_changed()
+    
+    # 能力或爱好变化后，在后台只重新打分该经理名下的客户
+    if 'capabilities' in data or 'hobbies' in data:
+        rescore_manager_customers_async(current_app._get_current_object(), user_id)
     
     return jsonify(manager_profile.to_dict()), 200
 
@@ -148,9 +204,9 @@ def get_all_managers():
     if current_user.role != 'admin':
         return jsonify({'msg': '权限不足'}), 403
     
-    managers = User.query.filter_by(role='manager').all()
+    managers = db.session.query(*USER_ROW.columns).filter(User.role == 'manager').all()
     
-    return jsonify([m.to_dict() for m in managers]), 200
+    return jsonify(USER_ROW(managers)), 200
 
 @api_bp.route('/managers/<int:manager_id>/customers', methods=['GET'])
 @jwt_required()
@@ -164,16 +220,46 @@ def get_manager_customers(manager_id):
         return jsonify({'msg': '权限不足'}), 403
     
     # 获取分配给该经理的所有客户
-    customers = User.query.join(CustomerProfile).filter(
+    customers = db.session.query(*USER_ROW.columns).join(CustomerProfile, CustomerProfile.user_id == User.id).filter(
         User.role == 'customer',
         CustomerProfile.manager_id == manager_id
     ).all()
     
-    return jsonify([c.to_dict() for c in customers]), 200
+    return jsonify(USER_ROW(customers)), 200
+
+@api_bp.route('/managers/<int:manager_id>/customers/insights', methods=['GET'])
+@jwt_required()
+def get_manager_customer_insights(manager_id):
+    from app.utils.insights import book_insights, precomputed_book_insights
+    
+    # 获取当前用户
+    current_user_id = get_jwt_identity()
+    current_user = User.query.get(current_user_id)
+    
+    # 检查权限（只有自己或管理员可以查看经理客户簿的洞察）
+    if current_user_id != manager_id and current_user.role != 'admin':
+        return jsonify({'msg': '权限不足'}), 403
+    
+    # 开启预生成时默认读取洞察表，?precomputed=0 强制现场生成
+    precomputed = current_app.config['INSIGHTS_PRECOMPUTED'] and request.args.get('precomputed', '1') != '0'
+    if precomputed:
+        insights, generated = precomputed_book_insights(manager_id)
+    else:
+        insights = book_insights(manager_id)
+        generated = len(insights)
+    
+    return jsonify({
+        'manager_id': manager_id,
+        'count': len(insights),
+        'precomputed': precomputed,
+        'generated': generated,
+        'insights': insights
+    }), 200
 
 # 管理员相关API
 @api_bp.route('/admin/dashboard', methods=['GET'])
 @jwt_required()
+@limit_concurrency('admin_dashboard', 2)
 def get_admin_dashboard():
     # 获取当前用户
     current_user_id = get_jwt_identity()
@@ -202,6 +288,61 @@ def get_admin_dashboard():
         'customer_classes': class_stats
     }), 200
 
+def _match_kernel():
+    """按配置返回分类打分函数，未配置剪枝或 LSH 时为None（精确打分）"""
+    if current_app.config['MATCH_PRUNE']:
+        # 每个客户只与所属聚类的候选经理打分
+        from app.utils.pruning import centroid_kernel
+        return centroid_kernel(current_app.config['MATCH_PRUNE'])
+    if current_app.config['MATCH_LSH']:
+        # 大词表时只对 LSH 候选对精确打分
+        from app.utils.lsh import lsh_kernel
+        return lsh_kernel(current_app.config['MATCH_LSH'])
+    return None
+
+def _run_auto_assign(current_user_id):
+    """执行一次分类加自动分配并记录匹配历史，返回结果摘要"""
+    from app.utils.clustering import auto_assign_customers, classify_customers
+    from app.utils.insights import refresh_insights_after_classification
+    from app.utils.match_history import record_assignments
+    from app.utils.manager_model import notify_managers_changed
+    
+    # 先对客户进行分类
+    classify_results = classify_customers(workers=current_app.config['MATCH_WORKERS'], kernel=_match_kernel())
+    
+    # 自动分配客户给经理（复用上面的分类结果）
+    assignments = auto_assign_customers(classification=classify_results)
+    
+    # 记录匹配历史（同时累加按天汇总），分数优先从缓存读取
+    recorded_matches = record_assignments(assignments, current_user_id)
+    
+    db.session.commit()
+    notify_managers_changed()
+    refresh_insights_after_classification()
+    
+    return {
+        'assigned_count': len(assignments),
+        'recorded_matches': recorded_matches
+    }
+
+def _run_branch_assign(current_user_id, branch=None):
+    """按网点分区执行分类和自动分配：branch 为空时所有网点并发执行，否则只重跑该网点"""
+    from app.utils.insights import refresh_insights_after_classification
+    from app.utils.manager_model import notify_managers_changed
+    from app.utils.partition import match_branch, run_partitions
+    
+    workers = current_app.config['MATCH_WORKERS']
+    if branch is None:
+        result = run_partitions(current_app._get_current_object(), current_user_id,
+                                parallel=current_app.config['MATCH_BRANCH_PARALLEL'],
+                                workers=workers, kernel=_match_kernel())
+    else:
+        result = match_branch(branch, current_user_id, workers=workers, kernel=_match_kernel())
+    
+    notify_managers_changed()
+    refresh_insights_after_classification(branch)
+    return result
+
 @api_bp.route('/admin/auto-assign', methods=['POST'])
 @jwt_required()
 def admin_auto_assign():
@@ -213,58 +354,289 @@ def admin_auto_assign():
     if current_user.role != 'admin':
         return jsonify({'msg': '权限不足'}), 403
     
+    # 可选的 branch 参数只重跑一个网点（未设置网点的资料用空字符串表示）
+    branch = (request.get_json(silent=True) or {}).get('branch')
+    if branch is not None:
+        from app.utils.partition import operation_name
+        name, func = operation_name(branch), lambda: _run_branch_assign(current_user_id, branch)
+    elif current_app.config['MATCH_PARTITION_BY_BRANCH']:
+        name, func = MATCH_OPERATION, lambda: _run_branch_assign(current_user_id)
+    else:
+        name, func = MATCH_OPERATION, lambda: _run_auto_assign(current_user_id)
+    
+    # 所有 worker 上同时发起的自动分配合并为一次执行，后来的请求等待并共享结果；
+    # 锁被再平衡、规则变更或命令行批处理占用时不合并
     try:
-        # 先对客户进行分类
-        classify_results = classify_customers()
-        
-        # 自动分配客户给经理
-        assignments = auto_assign_customers()
-        
-        # 记录匹配历史
-        recorded_matches = 0
-        for customer_id, manager_id in assignments.items():
-            # 获取客户和经理资料
-            customer_profile = CustomerProfile.query.filter_by(user_id=customer_id).first()
-            manager = User.query.get(manager_id)
-            manager_profile = ManagerProfile.query.filter_by(user_id=manager_id).first()
-            
-            if customer_profile and manager_profile:
-                # 计算匹配分数
-                similarity = compute_similarity_score(
-                    customer_profile.needs, 
-                    customer_profile.hobbies,
-                    manager_profile.capabilities,
-                    manager_profile.hobbies
-                )
-                
-                # 记录匹配历史
-                match_history = MatchHistory(
-                    customer_id=customer_id,
-                    manager_id=manager_id,
-                    match_score=similarity['total_match'],
-                    needs_match=similarity['needs_match'],
-                    hobbies_match=similarity['hobbies_match'],
-                    created_by=current_user_id
-                )
-                db.session.add(match_history)
-                recorded_matches += 1
-        
-        db.session.commit()
-        
-        return jsonify({
-            'msg': '自动分配成功',
-            'assigned_count': len(assignments),
-            'recorded_matches': recorded_matches
-        }), 200
-        
+        run, coalesced = single_flight(name, func, kind='auto-assign', started_by=current_user_id)
+    except OperationBusy as busy:
+        return jsonify({'msg': '已有其他分类/分配操作正在执行，请稍后重试', 'run_id': busy.run_id}), 409
+    
+    if run.status == 'running':
+        return jsonify({'msg': '自动分配正在执行中', 'run_id': run.id, 'coalesced': coalesced}), 202
+    if run.status != 'succeeded':
+        return jsonify({'msg': f'自动分配失败: {run.error or run.status}', 'run_id': run.id}), 500
+    
+    return jsonify({
+        'msg': '自动分配成功',
+        **(run.to_dict()['result'] or {}),
+        'run_id': run.id,
+        'coalesced': coalesced
+    }), 200
+
+@api_bp.route('/admin/rebalance', methods=['POST'])
+@jwt_required()
+def admin_rebalance():
+    from app.utils.manager_model import notify_managers_changed
+    from app.utils.rebalance import apply_rebalance, plan_rebalance
+    from app.utils.single_flight import run_exclusive
+    
+    # 获取当前用户
+    current_user_id = get_jwt_identity()
+    current_user = User.query.get(current_user_id)
+    
+    # 只有管理员可以再平衡
+    if current_user.role != 'admin':
+        return jsonify({'msg': '权限不足'}), 403
+    
+    data = request.get_json(silent=True) or {}
+    capacity = data.get('capacity')
+    if capacity is not None and (not isinstance(capacity, int) or isinstance(capacity, bool) or capacity <= 0):
+        return jsonify({'msg': 'capacity 必须是正整数'}), 400
+    branch = data.get('branch')
+    
+    # dry_run 只返回迁移计划
+    if data.get('dry_run'):
+        return jsonify(plan_rebalance(capacity=capacity, branch=branch)), 200
+    
+    # 执行时只接受客户ID（customer_ids，或预览得到的 moves 中的 customer_id），
+    # 目标经理和分数总是在服务端重新计划，只执行计划中包含这些客户的迁移
+    customer_ids = data.get('customer_ids')
+    if customer_ids is None and data.get('moves') is not None:
+        moves = data['moves']
+        if not isinstance(moves, list) or not all(isinstance(move, dict) for move in moves):
+            return jsonify({'msg': 'moves 必须是迁移对象列表'}), 400
+        customer_ids = [move.get('customer_id') for move in moves]
+    if customer_ids is not None and (not isinstance(customer_ids, list) or not all(
+            isinstance(c, int) and not isinstance(c, bool) for c in customer_ids)):
+        return jsonify({'msg': '客户ID必须是整数列表'}), 400
+    
+    def run():
+        moves = plan_rebalance(capacity=capacity, branch=branch)['moves']
+        not_planned = []
+        if customer_ids is not None:
+            requested = set(customer_ids)
+            moves = [move for move in moves if move['customer_id'] in requested]
+            not_planned = sorted(requested - {move['customer_id'] for move in moves})
+        result = apply_rebalance(moves, current_user_id, capacity=capacity)
+        # 重新计划后已不需要迁移的客户也算作跳过
+        result['skipped'] += not_planned
+        notify_managers_changed()
+        return result
+    
+    # 与自动分配共用锁，避免同时改写客户的经理；锁被占用时直接返回，不合并到其他操作的结果上
+    try:
+        run_id, result = run_exclusive(MATCH_OPERATION, run, started_by=current_user_id)
+    except OperationBusy as busy:
+        return jsonify({'msg': '已有分类/分配正在执行，请稍后重试', 'run_id': busy.run_id}), 409
+    except Exception as e:
+        db.session.rollback()
+        current_app.logger.error(f"再平衡失败: {str(e)}")
+        return jsonify({'msg': f'再平衡失败: {str(e)}'}), 500
+    
+    return jsonify({'msg': '再平衡成功', **result, 'run_id': run_id}), 200
+
+@api_bp.route('/admin/operations/<int:run_id>', methods=['GET'])
+@jwt_required()
+def get_operation_run(run_id):
+    # 获取当前用户
+    current_user_id = get_jwt_identity()
+    current_user = User.query.get(current_user_id)
+    
+    # 只有管理员可以查看操作状态
+    if current_user.role != 'admin':
+        return jsonify({'msg': '权限不足'}), 403
+    
+    run = db.session.get(OperationRun, run_id)
+    if not run:
+        return jsonify({'msg': '未找到操作记录'}), 404
+    
+    return jsonify(run.to_dict()), 200
+
+# 签发订阅事件流用的短期令牌（EventSource 不能设置请求头，令牌要放在 URL 中）
+@api_bp.route('/admin/events/token', methods=['POST'])
+@jwt_required()
+def admin_events_token():
+    from app.utils.events import create_events_token
+    
+    # 获取当前用户
+    current_user_id = get_jwt_identity()
+    current_user = User.query.get(current_user_id)
+    
+    # 只有管理员可以订阅仪表盘事件
+    if current_user.role != 'admin':
+        return jsonify({'msg': '权限不足'}), 403
+    
+    return jsonify({
+        'token': create_events_token(current_user_id),
+        'expires_in': current_app.config['EVENTS_TOKEN_SECONDS']
+    }), 200
+
+# 查询参数 ?jwt= 只接受 /admin/events/token 签发的事件令牌；每个 worker 同时保持的连接数有上限，
+# 避免长连接占满 gunicorn 线程
+@api_bp.route('/admin/events', methods=['GET'])
+@jwt_required(locations=['headers', 'query_string'])
+@limit_concurrency('admin_events', 2, retry_after=5, per_worker=True)
+def admin_events():
+    from flask_jwt_extended import get_jwt_request_location
+    from app.utils.events import EVENTS_TOKEN_SCOPE, event_stream
+    
+    # 普通访问令牌不能放在 URL 中（会写入访问日志）
+    events_token = get_jwt().get('scope') == EVENTS_TOKEN_SCOPE
+    if get_jwt_request_location() == 'query_string' and not events_token:
+        return jsonify({'msg': 'URL 中只能使用事件令牌，请先调用 /api/admin/events/token'}), 401
+    
+    # 获取当前用户
+    current_user_id = get_jwt_identity()
+    current_user = User.query.get(current_user_id)
+    
+    # 只有管理员可以订阅仪表盘事件
+    if current_user.role != 'admin':
+        return jsonify({'msg': '权限不足'}), 403
+    if not current_app.config['EVENTS_ENABLED']:
+        return jsonify({'msg': '事件推送未启用'}), 404
+    
+    # 浏览器重连时带 Last-Event-ID 请求头，从该事件之后补发
+    last_event_id = request.headers.get('Last-Event-ID', request.args.get('last_event_id'))
+    try:
+        last_event_id = int(last_event_id) if last_event_id else None
+    except ValueError:
+        last_event_id = None
+    
+    # 连接最长 EVENTS_STREAM_SECONDS 秒，普通令牌过期时也结束连接，由前端换新令牌后重新订阅；
+    # 事件令牌只用于建立连接，不限制连接时长
+    expires_at = None if events_token else get_jwt().get('exp')
+    limits = [s for s in (current_app.config['EVENTS_STREAM_SECONDS'], expires_at and expires_at - time.time()) if s]
+    max_seconds = min(limits) if limits else None
+    
+    stream = event_stream(last_event_id, max_seconds=max_seconds)
+    return Response(stream, mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        # 关闭 nginx 的响应缓冲，事件立即送达
+        'X-Accel-Buffering': 'no',
+    })
+
+@api_bp.route('/admin/profiles', methods=['GET'])
+@jwt_required()
+def list_request_profiles():
+    from app.utils.profiling import list_profiles
+
+    # 获取当前用户
+    current_user_id = get_jwt_identity()
+    current_user = User.query.get(current_user_id)
+
+    # 只有管理员可以查看剖析结果
+    if current_user.role != 'admin':
+        return jsonify({'msg': '权限不足'}), 403
+
+    limit = request.args.get('limit', 50, type=int)
+    return jsonify({'profiles': list_profiles(current_app.config['PROFILE_DIR'], limit=limit)}), 200
+
+@api_bp.route('/admin/profiles/<profile_id>', methods=['GET'])
+@jwt_required()
+def get_request_profile(profile_id):
+    from flask import send_file
+    from app.utils.profiling import load_summary, profile_path
+
+    # 获取当前用户
+    current_user_id = get_jwt_identity()
+    current_user = User.query.get(current_user_id)
+
+    # 只有管理员可以查看剖析结果
+    if current_user.role != 'admin':
+        return jsonify({'msg': '权限不足'}), 403
+
+    profile_dir = current_app.config['PROFILE_DIR']
+    # ?format=pstats 下载原始 pstats 文件，可用 snakeviz 或 python -m pstats 查看
+    if request.args.get('format') == 'pstats':
+        path = profile_path(profile_dir, profile_id, '.prof')
+        if path is None:
+            return jsonify({'msg': '未找到剖析结果'}), 404
+        return send_file(path, mimetype='application/octet-stream', as_attachment=True,
+                         download_name=f'{profile_id}.prof')
+
+    summary = load_summary(profile_dir, profile_id)
+    if summary is None:
+        return jsonify({'msg': '未找到剖析结果'}), 404
+    return jsonify(summary), 200
+
+@api_bp.route('/admin/class-rules', methods=['GET'])
+@jwt_required()
+def get_class_rules():
+    from app.utils.class_rules import active_rules, rule_versions
+
+    # 获取当前用户
+    current_user_id = get_jwt_identity()
+    current_user = User.query.get(current_user_id)
+
+    # 只有管理员可以查看等级规则
+    if current_user.role != 'admin':
+        return jsonify({'msg': '权限不足'}), 403
+
+    return jsonify({'active': active_rules().to_dict(), 'versions': rule_versions()}), 200
+
+@api_bp.route('/admin/class-rules', methods=['POST'])
+@jwt_required()
+def update_class_rules():
+    from app.utils.class_rules import active_rules, apply_class_rules, preview_reclassification
+    from app.utils.engine import ClassRules
+    from app.utils.insights import refresh_insights_after_classification
+    from app.utils.single_flight import run_exclusive
+
+    # 获取当前用户
+    current_user_id = get_jwt_identity()
+    current_user = User.query.get(current_user_id)
+
+    # 只有管理员可以修改等级规则
+    if current_user.role != 'admin':
+        return jsonify({'msg': '权限不足'}), 403
+
+    # 未提供的字段沿用当前规则；upgrade_margin 为 null 表示取消升级规则
+    data = request.get_json(silent=True) or {}
+    current = active_rules()
+    try:
+        rules = ClassRules(data.get('thresholds', current.thresholds.tolist()),
+                           data.get('upgrade_margin', current.upgrade_margin),
+                           data.get('capacity', current.capacity))
+    except (TypeError, ValueError) as e:
+        return jsonify({'msg': f'规则无效: {str(e)}'}), 400
+
+    # dry_run 只预览等级变化
+    if data.get('dry_run'):
+        return jsonify({'rules': rules.to_dict(), **preview_reclassification(rules)}), 200
+    if rules == current:
+        return jsonify({'msg': '规则没有变化', 'rules': current.to_dict(), 'reclassified': 0}), 200
+
+    try:
+        _, result = run_exclusive(MATCH_OPERATION, lambda: apply_class_rules(
+            rules, created_by=current_user_id, note=data.get('note')), started_by=current_user_id)
+    except OperationBusy as busy:
+        return jsonify({'msg': '已有分类/分配正在执行，请稍后重试', 'run_id': busy.run_id}), 409
     except Exception as e:
         db.session.rollback()
-        current_app.logger.error(f"自动分配失败: {str(e)}")
-        return jsonify({'msg': f'自动分配失败: {str(e)}'}), 500
+        current_app.logger.error(f"更新等级规则失败: {str(e)}")
+        return jsonify({'msg': f'更新等级规则失败: {str(e)}'}), 500
+    refresh_insights_after_classification()
+
+    return jsonify({'msg': '等级规则已更新', **result}), 200
 
 @api_bp.route('/admin/manual-assign', methods=['POST'])
 @jwt_required()
 def admin_manual_assign():
+    from app.utils.class_rules import active_rules
+    from app.utils.clustering import compute_similarity_score, similarity_from_counts
+    from app.utils.manager_model import notify_managers_changed
+    from app.utils.score_cache import lookup_scores
+    
     # 获取当前用户
     current_user_id = get_jwt_identity()
     current_user = User.query.get(current_user_id)
@@ -296,33 +668,34 @@ def admin_manual_assign():
             return jsonify({'msg': '未找到有效的经理'}), 404
         
         manager_profile = ManagerProfile.query.filter_by(user_id=manager_id).first()
+        before = (customer_profile.customer_class, customer_profile.manager_id)
         
         # 更新客户的经理ID
         customer_profile.manager_id = manager_id
         
-        # 计算匹配分数
-        similarity = compute_similarity_score(
-            customer_profile.needs, 
-            customer_profile.hobbies,
-            manager_profile.capabilities,
-            manager_profile.hobbies
-        )
+        # 计算匹配分数（优先读取缓存）
+        similarity = lookup_scores([(customer_id, manager_id)]).get((customer_id, manager_id))
+        if similarity is None:
+            similarity = compute_similarity_score(
+                customer_profile.needs, 
+                customer_profile.hobbies,
+                manager_profile.capabilities,
+                manager_profile.hobbies
+            )
         
-        # 更新客户等级
+        # 按当前生效的规则更新客户等级，重合数一并保存供规则变化时重新计算
+        similarity = similarity_from_counts(similarity['needs_match'], similarity['hobbies_match'], active_rules())
         customer_profile.customer_class = similarity['customer_class']
+        customer_profile.best_needs_match = similarity['needs_match']
+        customer_profile.best_hobbies_match = similarity['hobbies_match']
         
-        # 记录匹配历史
-        match_history = MatchHistory(
-            customer_id=customer_id,
-            manager_id=manager_id,
-            match_score=similarity['total_match'],
-            needs_match=similarity['needs_match'],
-            hobbies_match=similarity['hobbies_match'],
-            created_by=current_user_id
-        )
-        db.session.add(match_history)
+        # 记录匹配历史（同时累加按天汇总）
+        record_matches([(customer_id, manager_id, similarity['needs_match'], similarity['hobbies_match'])],
+                       current_user_id)
         
         db.session.commit()
+        notify_managers_changed()
+        publish_customer_change(customer_id, before, (customer_profile.customer_class, manager_id), 'manual-assign')
         
         return jsonify({
             'msg': '手动分配成功',
@@ -338,6 +711,7 @@ def admin_manual_assign():
 
 @api_bp.route('/admin/stats', methods=['GET'])
 @jwt_required()
+@limit_concurrency('admin_stats', 2)
 def get_admin_stats():
     # 获取当前用户
     current_user_id = get_jwt_identity()
@@ -350,7 +724,9 @@ def get_admin_stats():
     # 收集各种统计数据
     total_customers = User.query.filter_by(role='customer').count()
     total_managers = User.query.filter_by(role='manager').count()
-    total_matches = MatchHistory.query.count()
+    # 匹配总数取自按天汇总，归档后的原始记录仍计入；汇总上线前的历史按原始记录补上
+    from app.utils.match_history import total_match_count
+    total_matches = total_match_count()
     
     # 客户分类统计
     class_stats = []
@@ -358,15 +734,16 @@ def get_admin_stats():
         count = CustomerProfile.query.filter_by(customer_class=class_name).count()
         class_stats.append({'class': class_name, 'count': count})
     
-    # 经理负载统计
+    # 经理负载统计（一条 GROUP BY 查询）
+    from app.utils.rebalance import manager_loads as load_counts
+    loads = load_counts()
     manager_loads = []
     managers = User.query.filter_by(role='manager').all()
     for manager in managers:
-        customer_count = CustomerProfile.query.filter_by(manager_id=manager.id).count()
         manager_loads.append({
             'manager_id': manager.id,
             'manager_name': manager.name,
-            'customer_count': customer_count
+            'customer_count': loads.get(manager.id, 0)
         })
     
     return jsonify({
@@ -381,6 +758,8 @@ def get_admin_stats():
 @api_bp.route('/customers/<int:user_id>/insights', methods=['GET'])
 @jwt_required()
 def get_customer_insights(user_id):
+    from app.utils.clustering import generate_customer_insights
+    
     # 获取当前用户
     current_user_id = get_jwt_identity()
     current_user = User.query.get(current_user_id)
@@ -399,3 +778,161 @@ def get_customer_insights(user_id):
     insights = generate_customer_insights(user_id)
     
     return jsonify(insights), 200
+
+
+# 候选经理API（读取分数缓存）
+@api_bp.route('/customers/<int:user_id>/candidates', methods=['GET'])
+@jwt_required()
+def get_customer_candidates(user_id):
+    from app.utils.score_cache import candidate_managers
+    
+    # 获取当前用户
+    current_user_id = get_jwt_identity()
+    current_user = User.query.get(current_user_id)
+    
+    # 只有管理员可以查看候选经理
+    if current_user.role != 'admin':
+        return jsonify({'msg': '权限不足'}), 403
+    
+    limit = request.args.get('limit', type=int)
+    candidates = candidate_managers(user_id, limit=limit)
+    
+    return jsonify([c.to_dict() for c in candidates]), 200
+
+
+# 匹配历史API（键集分页）
+@api_bp.route('/admin/match-history', methods=['GET'])
+@jwt_required()
+def get_match_history():
+    # 获取当前用户
+    current_user_id = get_jwt_identity()
+    current_user = User.query.get(current_user_id)
+    
+    # 只有管理员可以查看匹配历史
+    if current_user.role != 'admin':
+        return jsonify({'msg': '权限不足'}), 403
+    
+    try:
+        # 客户和经理联表在同一行中取出
+        query = db.session.query(*MATCH_HISTORY_ROW.columns) \
+            .join(MATCH_CUSTOMER, MATCH_CUSTOMER.id == MatchHistory.customer_id) \
+            .join(MATCH_MANAGER, MATCH_MANAGER.id == MatchHistory.manager_id)
+        rows, next_cursor = history_page(
+            limit=request.args.get('limit', 50, type=int),
+            cursor=request.args.get('cursor'),
+            manager_id=request.args.get('manager_id', type=int),
+            customer_id=request.args.get('customer_id', type=int),
+            query=query
+        )
+    except ValueError as e:
+        return jsonify({'msg': str(e)}), 400
+    
+    return jsonify({
+        'items': MATCH_HISTORY_ROW(rows),
+        'next_cursor': next_cursor
+    }), 200
+
+
+# 匹配历史按天汇总API
+@api_bp.route('/admin/match-history/daily', methods=['GET'])
+@jwt_required()
+def get_match_history_daily():
+    # 获取当前用户
+    current_user_id = get_jwt_identity()
+    current_user = User.query.get(current_user_id)
+    
+    # 只有管理员可以查看匹配汇总
+    if current_user.role != 'admin':
+        return jsonify({'msg': '权限不足'}), 403
+    
+    try:
+        start = request.args.get('start')
+        end = request.args.get('end')
+        stats = daily_stats(
+            manager_id=request.args.get('manager_id', type=int),
+            start=date.fromisoformat(start) if start else None,
+            end=date.fromisoformat(end) if end else None
+        )
+    except ValueError:
+        return jsonify({'msg': '日期格式应为YYYY-MM-DD'}), 400
+    
+    return jsonify([stat.to_dict() for stat in stats]), 200
+
+
+# AI对话API
+def _ai_target_user(current_user_id):
+    """对话所属的用户：默认为当前用户，管理员可以通过 user_id 参数查看其他用户"""
+    current_user = User.query.get(current_user_id)
+    user_id = request.args.get('user_id', type=int)
+    if user_id is None or user_id == current_user_id:
+        return current_user_id
+    if current_user.role != 'admin':
+        return None
+    return user_id
+
+
+@api_bp.route('/ai/interactions', methods=['GET'])
+@jwt_required()
+def get_ai_interactions():
+    user_id = _ai_target_user(get_jwt_identity())
+    if user_id is None:
+        return jsonify({'msg': '权限不足'}), 403
+    
+    try:
+        rows, next_cursor = conversation_page(
+            user_id,
+            limit=request.args.get('limit', 50, type=int),
+            cursor=request.args.get('cursor'),
+            query=db.session.query(*AI_INTERACTION_ROW.columns)
+        )
+    except ValueError as e:
+        return jsonify({'msg': str(e)}), 400
+    
+    return jsonify({
+        'items': AI_INTERACTION_ROW(rows),
+        'next_cursor': next_cursor
+    }), 200
+
+
+@api_bp.route('/ai/unread-count', methods=['GET'])
+@jwt_required()
+def get_ai_unread_count():
+    user_id = _ai_target_user(get_jwt_identity())
+    if user_id is None:
+        return jsonify({'msg': '权限不足'}), 403
+    
+    return jsonify({'user_id': user_id, 'unread_count': unread_count(user_id)}), 200
+
+
+@api_bp.route('/ai/interactions/read', methods=['POST'])
+@jwt_required()
+def mark_ai_interactions_read():
+    current_user_id = get_jwt_identity()
+    data = request.get_json() or {}
+    ids = data.get('ids') or []
+    
+    try:
+        changed = mark_read(current_user_id, ids)
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        current_app.logger.error(f"标记已读失败: {str(e)}")
+        return jsonify({'msg': f'标记已读失败: {str(e)}'}), 500
+    
+    return jsonify({'marked': changed, 'unread_count': unread_count(current_user_id)}), 200
+
+
+@api_bp.route('/ai/interactions/read-all', methods=['POST'])
+@jwt_required()
+def mark_all_ai_interactions_read():
+    current_user_id = get_jwt_identity()
+    
+    try:
+        changed = mark_all_read(current_user_id)
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        current_app.logger.error(f"全部标记已读失败: {str(e)}")
+        return jsonify({'msg': f'全部标记已读失败: {str(e)}'}), 500
+    
+    return jsonify({'marked': changed, 'unread_count': 0}), 200
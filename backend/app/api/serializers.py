@@ -0,0 +1,53 @@
+
+"""
+列表接口使用的行序列化器
+字段和输出结构与对应模型的 to_dict() 保持一致，接口直接查询这些列，不再构造 ORM 实例。
+"""
+
+from sqlalchemy.orm import aliased
+
+from app.models import User, MatchHistory, AIInteraction
+from app.utils.serialization import DATETIME, RowSerializer
+
+
+def _user_fields(model, prefix=''):
+    return [
+        (f'{prefix}id', model.id),
+        (f'{prefix}username', model.username),
+        (f'{prefix}name', model.name),
+        (f'{prefix}role', model.role),
+        (f'{prefix}created_at', model.created_at, DATETIME),
+    ]
+
+
+# User.to_dict()
+USER_ROW = RowSerializer(_user_fields(User))
+
+# MatchHistory.to_dict()，客户和经理通过联表在同一行中取出
+MATCH_CUSTOMER = aliased(User, name='match_customer')
+MATCH_MANAGER = aliased(User, name='match_manager')
+MATCH_HISTORY_ROW = RowSerializer([
+    ('id', MatchHistory.id),
+    ('customer_id', MatchHistory.customer_id),
+    ('manager_id', MatchHistory.manager_id),
+    ('match_score', MatchHistory.match_score),
+    ('needs_match', MatchHistory.needs_match),
+    ('hobbies_match', MatchHistory.hobbies_match),
+    ('created_by', MatchHistory.created_by),
+    ('created_at', MatchHistory.created_at, DATETIME),
+] + _user_fields(MATCH_CUSTOMER, 'customer.') + _user_fields(MATCH_MANAGER, 'manager.'))
+
+# AIInteraction.to_dict()
+AI_INTERACTION_ROW = RowSerializer([
+    ('id', AIInteraction.id),
+    ('add_time', AIInteraction.add_time, DATETIME),
+    ('user_id', AIInteraction.user_id),
+    ('ad_mind', AIInteraction.ad_mind),
+    ('ask', AIInteraction.ask),
+    ('reply', AIInteraction.reply),
+    ('is_reply', AIInteraction.is_reply),
+    ('is_read', AIInteraction.is_read),
+    ('user_name', AIInteraction.user_name),
+    ('user_image', AIInteraction.user_image),
+    ('type', AIInteraction.type),
+])
@@ -45,6 +45,14 @@ def register():
     
     db.session.commit()
     
+    # 新经理加入后发布新的共享经理模型；新客户计入仪表盘的未分配人数
+    if data['role'] == 'manager':
+        from app.utils.manager_model import notify_managers_changed
+        notify_managers_changed()
+    elif data['role'] == 'customer':
+        from app.utils.events import publish_customer_change
+        publish_customer_change(user.id, None, (None, None), 'register')
+    
     # 生成访问令牌
     access_token = create_access_token(identity=user.id)
     
@@ -0,0 +1,871 @@
+
+"""
+命令行工具
+通过 flask <命令> 调用，用于离线批处理和运维操作
+"""
+
+import functools
+import time
+from datetime import datetime
+
+import click
+from flask.cli import AppGroup
+
+
+def profile_option(command):
+    """为批处理命令加 --profile：在 cProfile 和 tracemalloc 下执行，结果写入 PROFILE_DIR 并打印剖析ID"""
+
+    @click.option('--profile', 'profile_run', is_flag=True, help='在 cProfile 和 tracemalloc 下执行，结果写入 PROFILE_DIR')
+    @functools.wraps(command)
+    def wrapper(*args, profile_run=False, **kwargs):
+        if not profile_run:
+            return command(*args, **kwargs)
+
+        from flask import current_app
+        from app.utils.profiling import profiled
+
+        profile = None
+        try:
+            with profiled(current_app.config['PROFILE_DIR'], click.get_current_context().command_path) as profile:
+                return command(*args, **kwargs)
+        finally:
+            if profile is not None and profile.profile_id:
+                click.echo(f'剖析结果 {profile.profile_id}: {current_app.config["PROFILE_DIR"]} '
+                           f'(耗时{profile.summary["seconds"]:.2f}s, tracemalloc 峰值{profile.summary["peak_traced_mb"]}MB)')
+    return wrapper
+
+
+snapshot_cli = AppGroup('snapshot', help='画像列式快照')
+
+
+@snapshot_cli.command('build')
+@click.option('--dir', 'snapshot_dir', default=None, help='快照目录，默认使用 MATCH_SNAPSHOT_DIR')
+def snapshot_build(snapshot_dir):
+    """从数据库全量构建快照"""
+    from app.utils.snapshot import build_snapshot
+
+    started = time.perf_counter()
+    snapshot = build_snapshot(snapshot_dir)
+    click.echo(f'已构建快照 v{snapshot.version}: {snapshot.customer_count}个客户, '
+               f'{snapshot.manager_count}个经理, {len(snapshot.tags)}个标签 '
+               f'({time.perf_counter() - started:.2f}s)')
+
+
+@snapshot_cli.command('refresh')
+@click.option('--dir', 'snapshot_dir', default=None, help='快照目录，默认使用 MATCH_SNAPSHOT_DIR')
+@click.option('--verify/--no-verify', default=True, help='刷新后与数据库做一致性检查')
+def snapshot_refresh(snapshot_dir, verify):
+    """根据 updated_at 增量刷新快照"""
+    from app.utils.snapshot import refresh_snapshot, verify_snapshot
+
+    started = time.perf_counter()
+    snapshot, stats = refresh_snapshot(snapshot_dir)
+    click.echo(f'已刷新快照 v{snapshot.version}: {stats} ({time.perf_counter() - started:.2f}s)')
+
+    if verify:
+        problems = verify_snapshot(snapshot)
+        for problem in problems:
+            click.echo(f'  不一致: {problem}', err=True)
+        if problems:
+            raise SystemExit(1)
+        click.echo('一致性检查通过')
+
+
+@snapshot_cli.command('verify')
+@click.option('--dir', 'snapshot_dir', default=None, help='快照目录，默认使用 MATCH_SNAPSHOT_DIR')
+@click.option('--sample', default=200, show_default=True, help='逐行比对的抽样客户数')
+def snapshot_verify(snapshot_dir, sample):
+    """检查当前快照与数据库是否一致"""
+    from app.utils.snapshot import load_snapshot, verify_snapshot
+
+    snapshot = load_snapshot(snapshot_dir)
+    problems = verify_snapshot(snapshot, sample_size=sample)
+    for problem in problems:
+        click.echo(f'不一致: {problem}', err=True)
+    if problems:
+        raise SystemExit(1)
+    click.echo(f'快照 v{snapshot.version} 与数据库一致')
+
+
+@snapshot_cli.command('match')
+@click.option('--dir', 'snapshot_dir', required=True, help='快照目录（结果写成该目录的新版本，不写数据库）')
+@click.option('--workers', type=int, default=1, show_default=True, help='打分进程数')
+@profile_option
+def snapshot_match(snapshot_dir, workers):
+    """在列式快照上离线执行分类和分配，结果写成快照的新版本（用于假设分析）"""
+    from collections import Counter
+    from app.utils.class_rules import active_rules
+    from app.utils.engine import run_match
+    from app.utils.repository import ColumnarRepository
+
+    started = time.perf_counter()
+    results, assignments = run_match(ColumnarRepository(snapshot_dir), workers=workers, rules=active_rules())
+    counts = dict(sorted(Counter(r['customer_class'] for r in results.values()).items()))
+    click.echo(f'已分类{len(results)}个客户，分配{len(assignments)}个，各等级人数 {counts} '
+               f'({time.perf_counter() - started:.2f}s)')
+
+
+@snapshot_cli.command('info')
+@click.option('--dir', 'snapshot_dir', default=None, help='快照目录，默认使用 MATCH_SNAPSHOT_DIR')
+def snapshot_info(snapshot_dir):
+    """显示当前快照的版本信息和打开耗时"""
+    from app.utils.snapshot import load_snapshot
+
+    started = time.perf_counter()
+    snapshot = load_snapshot(snapshot_dir)
+    elapsed = (time.perf_counter() - started) * 1000
+    click.echo(f'{snapshot!r} 路径: {snapshot.path}')
+    click.echo(f'构建时间: {snapshot.manifest["built_at"]} 方式: {snapshot.manifest["mode"]}')
+    click.echo(f'打开耗时: {elapsed:.1f}ms')
+
+
+model_cli = AppGroup('model', help='跨worker共享的经理模型')
+
+
+@model_cli.command('publish')
+def model_publish():
+    """从数据库发布新版本的经理模型（部署后或批量修改经理数据后执行）"""
+    from app.utils.manager_model import publish_manager_model
+
+    version = publish_manager_model()
+    click.echo(f'已发布经理模型 v{version}')
+
+
+@model_cli.command('info')
+def model_info():
+    """显示当前挂载的经理模型版本"""
+    from app.utils.manager_model import get_manager_model
+
+    model = get_manager_model()
+    click.echo(f'{model!r} 发布时间: {model.published_at} 标签数: {len(model.tags)}')
+
+
+match_cli = AppGroup('match', help='客户分类与分配批处理')
+
+
+def _refuse_when_partitioned():
+    """开启按网点分区时，全量批处理会跨网点打分和分配，只允许使用 flask match branches"""
+    from flask import current_app
+    if current_app.config['MATCH_PARTITION_BY_BRANCH']:
+        raise click.UsageError('已开启 MATCH_PARTITION_BY_BRANCH，全量命令会跨网点分配，请使用 flask match branches')
+
+
+@match_cli.command('run')
+@click.option('--chunk-size', default=1000, show_default=True, help='每块处理并提交的客户数')
+@click.option('--checkpoint', 'checkpoint_path', default=None, help='检查点文件，默认为 instance/match_run.checkpoint.json')
+@click.option('--restart', is_flag=True, help='忽略已有检查点，从头开始')
+@click.option('--dry-run', is_flag=True, help='只计算建议方案并与当前分配对比，不写数据库')
+@click.option('--diff-out', default=None, help='dry-run 时把完整差异写入该 JSON 文件')
+@click.option('--created-by', type=int, default=None, help='匹配历史的操作人ID，默认为第一个管理员')
+@click.option('--score-cache/--no-score-cache', default=True, help='分类时同时更新分数缓存')
+@profile_option
+def match_run(chunk_size, checkpoint_path, restart, dry_run, diff_out, created_by, score_cache):
+    """分块执行客户分类和自动分配，可从检查点续跑"""
+    import json
+    from flask import current_app
+    from app.utils.batch import MatchRun, default_created_by
+
+    if not dry_run:
+        _refuse_when_partitioned()
+    created_by = created_by or default_created_by()
+    if not dry_run and created_by is None:
+        raise click.UsageError('没有管理员账号，请用 --created-by 指定操作人')
+
+    run = MatchRun(chunk_size=chunk_size, checkpoint_path=checkpoint_path, dry_run=dry_run,
+                   created_by=created_by, echo=click.echo,
+                   score_cache_n=current_app.config['MATCH_SCORE_TOP_N'] if score_cache else None)
+    if not restart and run.load_checkpoint():
+        click.echo(f'从检查点续跑 {run.run_id}: 阶段 {run.stage}, 位置 {run.last_key}')
+
+    if dry_run:
+        report = run.run()
+    else:
+        # 与 /api/admin/auto-assign 共用单飞锁，避免同时改写客户的等级和经理
+        from app.utils.single_flight import MATCH_OPERATION, OperationBusy, run_exclusive
+        try:
+            _, report = run_exclusive(MATCH_OPERATION, run.run, started_by=created_by)
+        except OperationBusy as busy:
+            click.echo(f'已有分类/分配正在执行 (run {busy.run_id})，请稍后重试', err=True)
+            raise SystemExit(1)
+        from app.utils.insights import refresh_insights_after_classification
+        refresh_insights_after_classification()
+
+    click.echo('阶段吞吐量:')
+    for stage, stats in report['stages'].items():
+        click.echo(f'  {stage:<10} {stats["rows"]:>8}行 {stats["chunks"]:>5}块 '
+                   f'{stats["seconds"]:>8.2f}s {stats["rows_per_second"]:>10.1f}行/s')
+
+    if dry_run:
+        click.echo(f'dry-run: {report["manager_changes"]}个客户将变更经理, '
+                   f'{report["class_changes"]}个客户将变更等级')
+        for change in report['diff'][:20]:
+            click.echo(f'  客户{change["customer_id"]}: 等级 {change["current_class"]} -> {change["proposed_class"]}, '
+                       f'经理 {change["current_manager_id"]} -> {change["proposed_manager_id"]}')
+        if diff_out:
+            with open(diff_out, 'w') as f:
+                json.dump(report['diff'], f, ensure_ascii=False, indent=2)
+            click.echo(f'完整差异已写入 {diff_out}')
+
+
+@match_cli.command('stream')
+@click.option('--chunk-size', default=5000, show_default=True, help='每块处理并提交的客户数（设置内存预算时可能被调小）')
+@click.option('--sample-size', default=20000, show_default=True, help='拟合 K-Means 的样本客户数')
+@click.option('--memory-budget', type=int, default=None, help='常驻内存预算（MB），默认使用 MATCH_MEMORY_BUDGET_MB')
+@click.option('--out', 'out_path', default=None, help='把每个客户的分类结果写入该 JSON Lines 文件')
+@click.option('--score-cache/--no-score-cache', default=True, help='分类时同时更新分数缓存')
+@profile_option
+def match_stream(chunk_size, sample_size, memory_budget, out_path, score_cache):
+    """流式分类全部客户，内存只与块大小和经理数有关"""
+    from flask import current_app
+    from app.utils.single_flight import MATCH_OPERATION, OperationBusy, run_exclusive
+    from app.utils.streaming import MemoryBudgetExceeded, stream_classify
+
+    _refuse_when_partitioned()
+
+    def run():
+        return stream_classify(chunk_size=chunk_size, sample_size=sample_size,
+                               memory_budget_mb=memory_budget or current_app.config['MATCH_MEMORY_BUDGET_MB'],
+                               out_path=out_path, echo=click.echo,
+                               score_cache_n=current_app.config['MATCH_SCORE_TOP_N'] if score_cache else None)
+
+    # 与其他分类/分配操作共用单飞锁
+    try:
+        _, report = run_exclusive(MATCH_OPERATION, run)
+    except OperationBusy as busy:
+        click.echo(f'已有分类/分配正在执行 (run {busy.run_id})，请稍后重试', err=True)
+        raise SystemExit(1)
+    except MemoryBudgetExceeded as e:
+        click.echo(f'已中止: {e}', err=True)
+        raise SystemExit(1)
+    from app.utils.insights import refresh_insights_after_classification
+    refresh_insights_after_classification()
+
+    click.echo(f'共分类{report["classified"]}个客户，{report["chunks"]}块（最终块大小{report["chunk_size"]}），'
+               f'耗时{report["seconds"]:.2f}s')
+    click.echo(f'各等级人数: {report["class_counts"]}')
+    budget = f'，预算{report["memory_budget_mb"]}MB' if report['memory_budget_mb'] else ''
+    click.echo(f'常驻内存: 基线{report["baseline_rss_mb"]}MB，峰值{report["peak_rss_mb"]}MB{budget}')
+
+
+@match_cli.command('branches')
+@click.option('--branch', 'branches', multiple=True, help='只执行这些网点（可重复），默认为全部网点；空字符串表示未设置网点的资料')
+@click.option('--parallel', type=int, default=None, help='同时执行的网点数，默认使用 MATCH_BRANCH_PARALLEL')
+@click.option('--created-by', type=int, default=None, help='匹配历史的操作人ID，默认为第一个管理员')
+@profile_option
+def match_branches(branches, parallel, created_by):
+    """按网点分区执行分类和自动分配，各网点并发执行、单独提交"""
+    from flask import current_app
+    from app.utils.batch import default_created_by
+    from app.utils.manager_model import notify_managers_changed
+    from app.utils.partition import list_branches, run_partitions
+
+    created_by = created_by or default_created_by()
+    if created_by is None:
+        raise click.UsageError('没有管理员账号，请用 --created-by 指定操作人')
+
+    def run():
+        return run_partitions(current_app._get_current_object(), created_by,
+                              branches=list(branches) or list_branches(),
+                              parallel=parallel or current_app.config['MATCH_BRANCH_PARALLEL'],
+                              workers=current_app.config['MATCH_WORKERS'])
+
+    started = time.perf_counter()
+    if branches:
+        # 单个网点只持有各自的网点锁，不同网点可以同时重跑
+        report = run()
+    else:
+        # 全量执行与 match run、/api/admin/auto-assign 共用单飞锁
+        from app.utils.single_flight import MATCH_OPERATION, OperationBusy, run_exclusive
+        try:
+            _, report = run_exclusive(MATCH_OPERATION, run, started_by=created_by)
+        except OperationBusy as busy:
+            click.echo(f'已有分类/分配正在执行 (run {busy.run_id})，请稍后重试', err=True)
+            raise SystemExit(1)
+    notify_managers_changed()
+    from app.utils.insights import refresh_insights_after_classification
+    for branch in (branches or [None]):
+        refresh_insights_after_classification(branch)
+
+    for branch, result in sorted(report['branches'].items()):
+        click.echo(f'  {branch or "(未设置)":<12} {result["customer_count"]:>7}客户 {result["manager_count"]:>5}经理 '
+                   f'{result["pair_count"]:>10}对 分配{result["assigned_count"]:>6} {result["seconds"]:>7.2f}s')
+    for branch, error in sorted(report['failed'].items()):
+        click.echo(f'  {branch or "(未设置)":<12} 失败: {error}', err=True)
+    click.echo(f'共分配{report["assigned_count"]}个客户，打分{report["pair_count"]}对，'
+               f'耗时{time.perf_counter() - started:.2f}s')
+    if report['failed']:
+        raise SystemExit(1)
+
+
+@match_cli.command('distributed')
+@click.option('--local-workers', default=4, show_default=True, help='在本机启动的 worker 进程数（可以为0，只用远程 worker）')
+@click.option('--unit-size', default=5000, show_default=True, help='每个工作单元的客户数')
+@click.option('--host', default='127.0.0.1', show_default=True, help='协调者监听地址，远程 worker 加入时改为 0.0.0.0')
+@click.option('--port', default=0, show_default=True, help='协调者端口，0为自动选择')
+@click.option('--token', default=None, help='worker 共享令牌，默认随机生成并打印')
+@click.option('--lease-timeout', default=120, show_default=True, help='租约超时秒数，超时的单元重新分发')
+@click.option('--max-attempts', default=3, show_default=True, help='单元最多被租出的次数')
+@click.option('--timeout', type=int, default=None, help='等待全部单元完成的最长秒数，默认不限（worker 全部失联时仍会失败）')
+@click.option('--verify', is_flag=True, help='合并后与单进程打分逐元素比对')
+@click.option('--dry-run', is_flag=True, help='只计算不写回数据库')
+@click.option('--created-by', type=int, default=None, help='匹配历史的操作人ID，默认为第一个管理员')
+@click.option('--die-after', type=int, default=None, hidden=True, help='测试用：第一个本地 worker 领取第N个单元后退出')
+@profile_option
+def match_distributed(local_workers, unit_size, host, port, token, lease_timeout, max_attempts, timeout, verify,
+                      dry_run, created_by, die_after):
+    """协调者模式：把客户分成工作单元分发给 worker 打分，合并后一次写回"""
+    import numpy as np
+    from app.utils.batch import default_created_by
+    from app.utils.distributed import DistributedError, distributed_match
+    from app.utils.manager_model import notify_managers_changed
+    from app.utils.single_flight import MATCH_OPERATION, OperationBusy, run_exclusive
+
+    if not dry_run:
+        _refuse_when_partitioned()
+    created_by = created_by or default_created_by()
+    if not dry_run and created_by is None:
+        raise click.UsageError('没有管理员账号，请用 --created-by 指定操作人')
+
+    inputs = {}
+
+    def run():
+        # 锁记录只保存可序列化的摘要，输入和打分结果留给 --verify
+        summary, inputs['data'], inputs['classification'] = distributed_match(
+            created_by, commit=not dry_run, local_workers=local_workers, unit_size=unit_size,
+            lease_timeout=lease_timeout, max_attempts=max_attempts, token=token, timeout=timeout,
+            host=host, port=port, echo=click.echo, die_after=die_after)
+        return summary
+
+    # 与其他分类/分配操作共用单飞锁
+    try:
+        _, summary = run_exclusive(MATCH_OPERATION, run, started_by=created_by)
+    except OperationBusy as busy:
+        click.echo(f'已有分类/分配正在执行 (run {busy.run_id})，请稍后重试', err=True)
+        raise SystemExit(1)
+    except DistributedError as e:
+        click.echo(f'分布式运行失败: {e}', err=True)
+        raise SystemExit(1)
+    if not dry_run:
+        from app.utils.insights import refresh_insights_after_classification
+        notify_managers_changed()
+        refresh_insights_after_classification()
+
+    click.echo(f'{summary["units"]}个单元，重试{summary["retries"]}次，各 worker 完成: {summary["completed_by"]}')
+    click.echo(f'分类{summary["customer_count"]}个客户，分配{summary["assigned_count"]}个，'
+               f'写入匹配历史{summary["recorded_matches"]}条 ({summary["seconds"]:.2f}s)' + ('（dry-run）' if dry_run else ''))
+
+    data, classification = inputs['data'], inputs['classification']
+    if verify and len(classification):
+        from app.utils.engine import best_manager_matches
+        expected = best_manager_matches(data.customer_needs, data.customer_hobbies,
+                                        data.manager_capabilities, data.manager_hobbies)
+        actual = (classification.best, classification.needs_match, classification.hobbies_match)
+        if not all(np.array_equal(a, b) for a, b in zip(expected, actual)):
+            click.echo('校验失败: 与单进程打分结果不一致', err=True)
+            raise SystemExit(1)
+        click.echo('校验通过: 与单进程打分结果逐元素一致')
+
+
+@match_cli.command('sweep')
+@click.option('--dir', 'snapshot_dir', default=None, help='读取该列式快照目录，默认从数据库构造只读的内存快照')
+@click.option('--thresholds', 'threshold_options', multiple=True, help='阈值方案，如 4,7,10,13（可重复）')
+@click.option('--upgrade-margin', 'margin_options', multiple=True, help='升级差值方案，none 表示不升级（可重复）')
+@click.option('--capacity', 'capacity_options', type=int, multiple=True, help='经理容量方案（可重复）')
+@click.option('--workers', type=int, default=None, help='并行评估的进程数，默认为CPU核数')
+@click.option('--from-scratch', is_flag=True, help='假设所有客户都未分配，比较重新全量分配的结果')
+@click.option('--out', 'out_path', default=None, help='把比较结果写入该文件（.csv 或 .json）')
+def match_sweep(snapshot_dir, threshold_options, margin_options, capacity_options, workers, from_scratch, out_path):
+    """在一份快照上并行比较多组等级规则和经理容量（不写数据库）
+
+    各参数的候选值取全部组合，未给出的参数沿用当前生效的规则；第一行是当前规则作为基线。
+    """
+    import csv
+    import json
+    from app.utils.class_rules import active_rules
+    from app.utils.snapshot import load_snapshot, snapshot_from_database
+    from app.utils.sweep import TABLE_COLUMNS, format_table, scenario_grid, sweep
+
+    try:
+        scenarios = scenario_grid(
+            thresholds=[[int(v) for v in option.split(',')] for option in threshold_options],
+            upgrade_margins=[None if option.lower() == 'none' else int(option) for option in margin_options],
+            capacities=list(capacity_options), base=active_rules())
+    except ValueError as e:
+        raise click.UsageError(f'方案无效: {e}')
+
+    data = load_snapshot(snapshot_dir) if snapshot_dir else snapshot_from_database()
+    try:
+        results, stats = sweep(data, scenarios, workers=workers, from_scratch=from_scratch)
+    except ValueError as e:
+        click.echo(str(e), err=True)
+        raise SystemExit(1)
+
+    click.echo(f'{stats["customer_count"]}个客户 x {stats["manager_count"]}个经理，{len(results)}个方案；'
+               f'打分一次 {stats["score_seconds"]:.2f}s，{stats["workers"]}个进程评估 {stats["evaluate_seconds"]:.2f}s'
+               + ('（全部重新分配）' if from_scratch else ''))
+    click.echo(format_table(results))
+
+    if out_path:
+        with open(out_path, 'w', newline='', encoding='utf-8') as f:
+            if out_path.endswith('.json'):
+                json.dump({'stats': stats, 'scenarios': results}, f, ensure_ascii=False, indent=2)
+            else:
+                writer = csv.DictWriter(f, fieldnames=[key for _, key in TABLE_COLUMNS])
+                writer.writeheader()
+                writer.writerows(results)
+        click.echo(f'比较结果已写入 {out_path}')
+
+
+@match_cli.command('worker')
+@click.option('--coordinator', 'coordinator_url', required=True, help='协调者地址，如 http://10.0.0.5:8700')
+@click.option('--token', required=True, help='协调者打印的共享令牌')
+@click.option('--name', default=None, help='worker 名称，默认为 主机名:进程号')
+def match_worker(coordinator_url, token, name):
+    """作为 worker 加入协调者，领取单元打分直到运行结束（不访问数据库）"""
+    from app.utils.distributed import run_worker
+
+    completed = run_worker(coordinator_url, token, worker=name)
+    click.echo(f'已完成{completed}个单元')
+
+
+@match_cli.command('insights')
+@click.option('--branch', default=None, help='只刷新该网点的客户；空字符串表示未设置网点的资料')
+def match_insights(branch):
+    """重新生成预生成的客户洞察表（INSIGHTS_PRECOMPUTED 开启时分类批处理结束后会自动刷新）"""
+    from app.utils.insights import rebuild_insights
+
+    started = time.perf_counter()
+    written = rebuild_insights(branch=branch)
+    click.echo(f'已生成{written}个客户的洞察 ({time.perf_counter() - started:.2f}s)')
+
+
+@match_cli.command('rebalance')
+@click.option('--capacity', type=int, default=None, help='每个经理的客户上限，默认为当前生效规则中的经理容量')
+@click.option('--branch', default=None, help='只处理该网点的经理；空字符串表示未设置网点的资料')
+@click.option('--apply', 'apply_moves', is_flag=True, help='执行迁移计划（默认只预览）')
+@click.option('--created-by', type=int, default=None, help='匹配历史的操作人ID，默认为第一个管理员')
+def match_rebalance(capacity, branch, apply_moves, created_by):
+    """把超载经理名下的客户迁到同网点有空位的经理，迁移数和总分损失尽量小"""
+    from app.utils.batch import default_created_by
+    from app.utils.rebalance import apply_rebalance, plan_rebalance
+
+    created_by = created_by or default_created_by()
+    if apply_moves and created_by is None:
+        raise click.UsageError('没有管理员账号，请用 --created-by 指定操作人')
+
+    started = time.perf_counter()
+    plan = plan_rebalance(capacity=capacity, branch=branch)
+    click.echo(f'容量{plan["capacity"]}，超载经理{plan["overloaded_managers"]}个，迁移{len(plan["moves"])}个客户，'
+               f'总分损失{plan["total_loss"]} ({time.perf_counter() - started:.2f}s)')
+    for move in plan['moves'][:20]:
+        click.echo(f'  客户{move["customer_id"]}: 经理 {move["from_manager_id"]} -> {move["to_manager_id"]}, '
+                   f'总分 {move["score_before"]} -> {move["score_after"]}')
+    for manager_id, count in plan['unresolved'].items():
+        click.echo(f'  经理{manager_id}: 同网点没有空位，仍超出{count}个客户', err=True)
+    if not apply_moves or not plan['moves']:
+        return
+
+    # 与其他分类/分配操作共用单飞锁
+    from app.utils.manager_model import notify_managers_changed
+    from app.utils.single_flight import MATCH_OPERATION, OperationBusy, run_exclusive
+    try:
+        _, result = run_exclusive(MATCH_OPERATION, lambda: apply_rebalance(plan['moves'], created_by, capacity=capacity),
+                                  started_by=created_by)
+    except OperationBusy as busy:
+        click.echo(f'已有分类/分配正在执行 (run {busy.run_id})，请稍后重试', err=True)
+        raise SystemExit(1)
+    notify_managers_changed()
+    click.echo(f'已迁移{result["applied"]}个客户，跳过{len(result["skipped"])}个，写入匹配历史{result["recorded_matches"]}条')
+
+
+scores_cli = AppGroup('scores', help='客户×经理分数缓存')
+
+
+@scores_cli.command('rebuild')
+@click.option('--top-n', type=int, default=None, help='每个客户保留的候选经理数，默认使用 MATCH_SCORE_TOP_N')
+@click.option('--chunk-size', default=2000, show_default=True, help='每块处理的客户数（决定峰值内存）')
+@click.option('--verify/--no-verify', default=True, help='重建后抽样校验')
+@click.option('--sample', default=500, show_default=True, help='校验抽样的客户数')
+def scores_rebuild(top_n, chunk_size, verify, sample):
+    """全量重建分数缓存"""
+    from app.utils.score_cache import rebuild_score_cache, verify_score_cache
+
+    started = time.perf_counter()
+    written = rebuild_score_cache(n=top_n, chunk_size=chunk_size)
+    click.echo(f'已写入{written}行缓存 ({time.perf_counter() - started:.2f}s)')
+
+    if verify:
+        checked, mismatched = verify_score_cache(n=top_n, sample_size=sample)
+        if mismatched:
+            click.echo(f'校验失败: {len(mismatched)}/{checked}个客户不一致, 例如 {mismatched[:10]}', err=True)
+            raise SystemExit(1)
+        click.echo(f'校验通过: 抽样{checked}个客户')
+
+
+@scores_cli.command('verify')
+@click.option('--top-n', type=int, default=None, help='每个客户保留的候选经理数，默认使用 MATCH_SCORE_TOP_N')
+@click.option('--sample', default=500, show_default=True, help='抽样的客户数')
+def scores_verify(top_n, sample):
+    """抽样重算并校验分数缓存"""
+    from app.utils.score_cache import verify_score_cache
+
+    checked, mismatched = verify_score_cache(n=top_n, sample_size=sample)
+    if mismatched:
+        click.echo(f'{len(mismatched)}/{checked}个客户的缓存与重算结果不一致, 例如 {mismatched[:10]}', err=True)
+        raise SystemExit(1)
+    click.echo(f'抽样{checked}个客户, 缓存全部一致')
+
+
+rules_cli = AppGroup('rules', help='版本化的客户等级规则')
+
+
+def _echo_reclassification(preview):
+    click.echo(f'{preview["changed"]}个客户的等级将变化，新的各等级人数 {preview["class_counts"]}')
+    for transition, count in preview['transitions'].items():
+        click.echo(f'  {transition}: {count}')
+    if preview['missing_counts']:
+        click.echo(f'{preview["missing_counts"]}个客户没有保存重合数，保持原等级（全量分类一次后即可覆盖）')
+
+
+@rules_cli.command('show')
+@click.option('--limit', default=10, show_default=True, help='显示的历史版本数')
+def rules_show(limit):
+    """显示当前生效的规则和最近的版本"""
+    from app.utils.class_rules import active_rules, rule_versions
+
+    click.echo(f'当前生效: {active_rules().to_dict()}')
+    for version in rule_versions(limit):
+        click.echo(f'  v{version["version"]} {version["created_at"]} 阈值{version["thresholds"]} '
+                   f'升级差值{version["upgrade_margin"]} 容量{version["capacity"]} {version["note"] or ""}')
+
+
+@rules_cli.command('set')
+@click.option('--thresholds', default=None, help='D、C、B、A 的总重合数下限，逗号分隔，如 4,7,10,13；默认沿用当前规则')
+@click.option('--upgrade-margin', type=int, default=None, help='需求重合数比爱好重合数多这么多时升一级；默认沿用当前规则')
+@click.option('--no-upgrade', is_flag=True, help='取消需求优先的升级规则')
+@click.option('--capacity', type=int, default=None, help='每个经理最多负责的客户数；默认沿用当前规则')
+@click.option('--note', default=None, help='版本说明')
+@click.option('--dry-run', is_flag=True, help='只预览等级变化，不发布')
+@click.option('--created-by', type=int, default=None, help='操作人ID，默认为第一个管理员')
+def rules_set(thresholds, upgrade_margin, no_upgrade, capacity, note, dry_run, created_by):
+    """发布新版本规则，并用已保存的重合数重新计算全部客户的等级（不重新打分）"""
+    from app.utils.batch import default_created_by
+    from app.utils.class_rules import active_rules, apply_class_rules, preview_reclassification
+    from app.utils.engine import ClassRules
+
+    current = active_rules()
+    try:
+        rules = ClassRules(
+            [int(v) for v in thresholds.split(',')] if thresholds else current.thresholds,
+            None if no_upgrade else (upgrade_margin if upgrade_margin is not None else current.upgrade_margin),
+            capacity or current.capacity)
+    except ValueError as e:
+        raise click.UsageError(str(e))
+    if rules == current:
+        click.echo('规则没有变化')
+        return
+
+    started = time.perf_counter()
+    _echo_reclassification(preview_reclassification(rules))
+    if dry_run:
+        return
+
+    from app.utils.single_flight import MATCH_OPERATION, OperationBusy, run_exclusive
+    created_by = created_by or default_created_by()
+    try:
+        _, result = run_exclusive(MATCH_OPERATION, lambda: apply_class_rules(rules, created_by=created_by, note=note),
+                                  started_by=created_by)
+    except OperationBusy as busy:
+        click.echo(f'已有分类/分配正在执行 (run {busy.run_id})，请稍后重试', err=True)
+        raise SystemExit(1)
+    from app.utils.insights import refresh_insights_after_classification
+    refresh_insights_after_classification()
+    click.echo(f'已发布规则 v{result["rules"]["version"]}，更新{result["reclassified"]}个客户的等级 '
+               f'({time.perf_counter() - started:.2f}s)')
+    if rules.capacity < current.capacity:
+        click.echo('经理容量已调小，已超出的经理可以用 flask match rebalance 调整')
+
+
+history_cli = AppGroup('history', help='匹配历史汇总与归档')
+
+
+@history_cli.command('rollup')
+@click.option('--archive-dir', default=None, help='归档目录，默认使用 MATCH_HISTORY_ARCHIVE_DIR')
+@click.option('--force', is_flag=True, help='存在归档时也重建归档截止日及之前仍有原始记录的日期')
+def history_rollup(archive_dir, force):
+    """由现存匹配历史按天重建汇总，没有原始记录的日期保留原汇总"""
+    from app.utils.match_history import rebuild_daily_stats
+
+    written, skipped_through = rebuild_daily_stats(archive_dir=archive_dir, force=force)
+    click.echo(f'已写入{written}行按天汇总')
+    if skipped_through is not None:
+        click.echo(f'已存在归档，{skipped_through.isoformat()}及之前的日期保留原汇总（--force 强制重建）')
+
+
+@history_cli.command('archive')
+@click.option('--days', default=180, show_default=True, help='归档多少天之前的原始记录')
+@click.option('--batch-size', default=5000, show_default=True, help='每批归档并删除的记录数')
+@click.option('--out', 'archive_dir', default=None, help='归档目录，默认使用 MATCH_HISTORY_ARCHIVE_DIR')
+def history_archive(days, batch_size, archive_dir):
+    """把过期的原始匹配历史分批归档到 gzip 文件并删除（按天汇总保留）"""
+    from app.utils.match_history import archive_match_history
+
+    archived, path = archive_match_history(days, archive_dir=archive_dir, batch_size=batch_size, echo=click.echo)
+    if not archived:
+        click.echo(f'没有{days}天之前的匹配历史')
+        return
+    click.echo(f'共归档{archived}条记录到 {path}')
+
+
+ai_cli = AppGroup('ai', help='AI对话')
+
+
+@ai_cli.command('rebuild-unread')
+def ai_rebuild_unread():
+    """由对话记录重新统计每个用户的未读数（初始化或与外部写入对账）"""
+    from app.utils.ai_feed import rebuild_unread_counts
+
+    click.echo(f'已重建{rebuild_unread_counts()}个用户的未读数')
+
+
+bench_cli = AppGroup('bench', help='基准测试（匹配算法使用合成数据，不访问数据库）')
+
+
+def _worker_counts(value):
+    return [int(v) for v in value.split(',') if v.strip()]
+
+
+@bench_cli.command('parallel')
+@click.option('--customers', default=200000, show_default=True, help='合成客户数')
+@click.option('--managers', default=2000, show_default=True, help='合成经理数')
+@click.option('--workers', default='1,2,4,8,16,32', show_default=True, help='逗号分隔的进程数列表')
+@click.option('--shard-size', type=int, default=None, help='每个分片的客户数，默认自动计算')
+@click.option('--repeat', default=1, show_default=True, help='每组重复次数，取最快一次')
+def bench_parallel_command(customers, managers, workers, shard_size, repeat):
+    """多进程分片打分的扩展效率"""
+    from app.utils.benchmark import bench_parallel, synthetic_profiles
+
+    data = synthetic_profiles(customers, managers)
+    rows = bench_parallel(data, _worker_counts(workers), repeat=repeat, shard_size=shard_size)
+
+    click.echo(f'{customers}个客户 x {managers}个经理')
+    click.echo(f'{"workers":>8} {"seconds":>9} {"speedup":>8} {"efficiency":>10} {"identical":>9}')
+    for row in rows:
+        click.echo(f'{row["workers"]:>8} {row["seconds"]:>9.3f} {row["speedup"]:>8.2f} '
+                   f'{row["efficiency"]:>10.1%} {str(row["identical"]):>9}')
+
+
+@bench_cli.command('tiles')
+@click.option('--customers', default=200000, show_default=True, help='合成客户数')
+@click.option('--managers', default=5000, show_default=True, help='合成经理数')
+@click.option('--tiles', 'tile_settings', default='1000000,4000000,16000000', show_default=True,
+              help='逗号分隔的每块 客户×经理 单元数')
+def bench_tiles_command(customers, managers, tile_settings):
+    """分块打分在不同块大小下相对不分块的耗时和峰值内存"""
+    from app.utils.benchmark import bench_tiles, synthetic_profiles
+
+    data = synthetic_profiles(customers, managers)
+    rows = bench_tiles(data, [int(x) for x in tile_settings.split(',') if x.strip()])
+
+    click.echo(f'{customers}个客户 x {managers}个经理')
+    click.echo(f'{"tile_cells":>12} {"seconds":>9} {"peak_mb":>9} {"identical":>9}')
+    for row in rows:
+        click.echo(f'{row["tile_cells"]:>12} {row["seconds"]:>9.3f} {row["peak_mb"]:>9.1f} {str(row["identical"]):>9}')
+
+
+@bench_cli.command('engine')
+@click.option('--customers', default=20000, show_default=True, help='合成客户数')
+@click.option('--managers', default=200, show_default=True, help='合成经理数')
+@click.option('--repeat', default=1, show_default=True, help='每个阶段重复次数，取最快一次')
+def bench_engine_command(customers, managers, repeat):
+    """匹配引擎在内存数组上的分类、结果转换和分配耗时"""
+    from app.utils.benchmark import bench_engine, synthetic_profiles
+
+    report = bench_engine(synthetic_profiles(customers, managers), repeat=repeat)
+    click.echo(f'{customers}个客户 x {managers}个经理')
+    click.echo(f'分类(K-Means + 打分) {report["classify"]:.3f}s, 结果转换 {report["results"]:.3f}s, '
+               f'分配 {report["assign"]:.3f}s（分配{report["assigned"]}个客户）')
+    click.echo(f'各等级人数: {report["class_counts"]}')
+
+
+@bench_cli.command('lsh')
+@click.option('--customers', default=50000, show_default=True, help='合成客户数')
+@click.option('--managers', default=2000, show_default=True, help='合成经理数')
+@click.option('--needs-vocab', default=1000, show_default=True, help='需求/能力标签数')
+@click.option('--hobbies-vocab', default=3000, show_default=True, help='爱好标签数')
+@click.option('--tags-scale', default=4, show_default=True, help='每人标签数相对 data_generator 的倍数')
+@click.option('--bands', 'band_settings', default='16x1,32x2,16x2,8x2', show_default=True,
+              help='逗号分隔的 分段数x每段行数 设置')
+@click.option('-k', default=5, show_default=True, help='Recall@K 的 K')
+def bench_lsh_command(customers, managers, needs_vocab, hobbies_vocab, tags_scale, band_settings, k):
+    """MinHash/LSH 候选生成相对精确打分的召回率和加速比"""
+    from app.utils.benchmark import bench_lsh, synthetic_profiles
+
+    settings = [tuple(int(x) for x in item.split('x')) for item in band_settings.split(',') if item.strip()]
+    data = synthetic_profiles(customers, managers, needs_vocab=needs_vocab,
+                              hobbies_vocab=hobbies_vocab, tags_scale=tags_scale)
+    exact_seconds, rows = bench_lsh(data, settings, k=k)
+
+    click.echo(f'{customers}个客户 x {managers}个经理, {needs_vocab + hobbies_vocab}个标签, 精确打分 {exact_seconds:.3f}s')
+    click.echo(f'{"bands":>6} {"rows":>5} {"seconds":>9} {"speedup":>8} {"recall@" + str(k):>9} '
+               f'{"best_agree":>10} {"pairs":>8}')
+    for row in rows:
+        click.echo(f'{row["bands"]:>6} {row["rows"]:>5} {row["seconds"]:>9.3f} {row["speedup"]:>8.2f} '
+                   f'{row["recall_at_k"]:>9.1%} {row["best_agreement"]:>10.1%} {row["pair_fraction"]:>8.2%}')
+
+
+@bench_cli.command('prune')
+@click.option('--customers', default=50000, show_default=True, help='合成客户数')
+@click.option('--managers', default=2000, show_default=True, help='合成经理数')
+@click.option('--clusters', default=200, show_default=True, help='K-Means 聚类数')
+@click.option('--settings', 'prune_settings', default='5,10,20,20:1,50,50:1', show_default=True,
+              help='逗号分隔的 候选数[:退回阈值差] 设置')
+def bench_prune_command(customers, managers, clusters, prune_settings):
+    """聚类中心剪枝相对精确打分的一致率和加速比"""
+    from app.utils.benchmark import bench_prune, synthetic_profiles
+    from app.utils.class_rules import active_rules
+
+    settings = []
+    for item in filter(None, (part.strip() for part in prune_settings.split(','))):
+        top_n, _, margin = item.partition(':')
+        settings.append((int(top_n), int(margin) if margin else None))
+    data = synthetic_profiles(customers, managers)
+    exact_seconds, rows = bench_prune(data, settings, n_clusters=clusters, rules=active_rules())
+
+    click.echo(f'{customers}个客户 x {managers}个经理, {clusters}个聚类, 精确打分 {exact_seconds:.3f}s')
+    click.echo(f'{"top_n":>6} {"margin":>6} {"seconds":>9} {"speedup":>8} {"best_agree":>10} '
+               f'{"total_agree":>11} {"class_agree":>11} {"fallback":>8} {"pairs":>8}')
+    for row in rows:
+        margin = '-' if row['margin'] is None else row['margin']
+        click.echo(f'{row["top_n"]:>6} {margin:>6} {row["seconds"]:>9.3f} {row["speedup"]:>8.2f} '
+                   f'{row["best_agreement"]:>10.1%} {row["total_agreement"]:>11.1%} {row["class_agreement"]:>11.1%} '
+                   f'{row["fallback_customers"]:>8} {row["pair_fraction"]:>8.2%}')
+
+
+@bench_cli.command('load')
+@click.option('--url', default=None, help='压测已经运行的服务（不生成数据、不启动 gunicorn），账号需已由本命令生成')
+@click.option('--database-url', default=None, help='压测库，默认为 instance/loadtest.db（SQLite），也可以是 MySQL 兼容的库')
+@click.option('--reseed', is_flag=True, help='清空压测库后重新生成数据')
+@click.option('--customers', default=2000, show_default=True, help='生成的客户数')
+@click.option('--managers', default=50, show_default=True, help='生成的经理数')
+@click.option('--gunicorn-workers', default=4, show_default=True, help='gunicorn worker 数')
+@click.option('--env', 'extra_env', multiple=True, help='传给 gunicorn 的环境变量 KEY=VALUE（可重复）')
+@click.option('--pool', default=20, show_default=True, help='每种角色登录的账号数')
+@click.option('--mix', default=None, help='接口比例，如 customers=30,login=10（默认见 loadtest.DEFAULT_MIX）')
+@click.option('--rate', default=50.0, show_default=True, help='目标请求速率（每秒）')
+@click.option('--duration', default=30.0, show_default=True, help='持续秒数')
+@click.option('--concurrency', default=64, show_default=True, help='客户端最大并发请求数')
+@click.option('--out-dir', default=None, help='结果目录，默认为 instance/loadtest')
+@click.option('--compare', 'compare_path', default=None, help='与之前保存的结果文件对比')
+def bench_load_command(url, database_url, reseed, customers, managers, gunicorn_workers, extra_env, pool,
+                       mix, rate, duration, concurrency, out_dir, compare_path):
+    """按真实流量比例压测接口，输出每个接口的吞吐量、p50/p95/p99 延迟和错误率"""
+    import contextlib
+    import json
+    import os
+    from flask import current_app
+    from app.utils import loadtest
+
+    mix = loadtest.parse_mix(mix or loadtest.DEFAULT_MIX)
+    database_url = database_url or f'sqlite:///{os.path.join(current_app.instance_path, "loadtest.db")}'
+    server = contextlib.nullcontext()
+    if url is None:
+        os.makedirs(current_app.instance_path, exist_ok=True)
+        started = time.perf_counter()
+        if loadtest.seed_database(database_url, customers, managers, reseed=reseed):
+            click.echo(f'已生成压测数据 ({time.perf_counter() - started:.1f}s)')
+        env = dict(item.split('=', 1) for item in extra_env)
+        server = loadtest.GunicornServer(os.path.dirname(current_app.root_path), database_url,
+                                         workers=gunicorn_workers, extra_env=env)
+
+    with server:
+        base_url = url or server.base_url
+        sessions = loadtest.login_pool(base_url, pool)
+        click.echo('已登录: ' + ', '.join(f'{role} {len(items)}个' for role, items in sessions.items()))
+        samples, elapsed = loadtest.run_load(base_url, sessions, mix, rate, duration, concurrency=concurrency)
+
+    endpoints = loadtest.summarize(samples, elapsed)
+    results = {
+        'started_at': datetime.utcnow().isoformat(),
+        'config': {'url': url, 'database': database_url if url is None else None, 'gunicorn_workers': gunicorn_workers,
+                   'env': list(extra_env), 'mix': mix, 'rate': rate, 'duration': duration,
+                   'concurrency': concurrency, 'pool': pool},
+        'elapsed': round(elapsed, 3),
+        'achieved_rate': round(sum(len(rows) for rows in samples.values()) / elapsed, 2),
+        'endpoints': endpoints,
+    }
+
+    click.echo(f'目标 {rate}/s，实际 {results["achieved_rate"]}/s，耗时 {elapsed:.1f}s')
+    click.echo(f'{"endpoint":<20} {"reqs":>6} {"rps":>7} {"p50":>8} {"p95":>8} {"p99":>8} {"max":>8} '
+               f'{"errors":>7} {"429":>6}')
+    for name, stats in endpoints.items():
+        click.echo(f'{name:<20} {stats["requests"]:>6} {stats["throughput"]:>7.1f} {stats["p50_ms"]:>8.1f} '
+                   f'{stats["p95_ms"]:>8.1f} {stats["p99_ms"]:>8.1f} {stats["max_ms"]:>8.1f} '
+                   f'{stats["error_rate"]:>7.1%} {stats["throttled_rate"]:>6.1%}')
+
+    path = loadtest.save_results(results, out_dir or os.path.join(current_app.instance_path, 'loadtest'))
+    click.echo(f'结果已保存到 {path}')
+
+    if compare_path:
+        with open(compare_path) as f:
+            previous = json.load(f)
+        click.echo(f'与 {compare_path} 对比（之前 -> 现在）:')
+        for name, change in loadtest.compare_results(previous, results).items():
+            click.echo(f'  {name:<20} ' + '  '.join(f'{key} {before} -> {after}' for key, (before, after) in change.items()))
+
+
+@bench_cli.command('startup')
+@click.option('--budget', default=1.0, show_default=True, help='create_app 耗时上限（秒，取中位数）')
+@click.option('--repeat', default=5, show_default=True, help='启动次数')
+@click.option('--top', default=10, show_default=True, help='列出耗时最多的顶层导入数')
+def bench_startup_command(budget, repeat, top):
+    """测量 create_app 的导入耗时，超出预算或加载了重量级模块时以非零状态退出（可用于 CI）"""
+    import os
+    from flask import current_app
+    from app.utils.benchmark import bench_startup
+
+    result = bench_startup(os.path.dirname(current_app.root_path), repeat=repeat, top=top)
+
+    click.echo('耗时最多的顶层导入:')
+    for name, seconds in result['top_imports']:
+        click.echo(f'  {name:<24} {seconds * 1000:>8.1f}ms')
+    click.echo(f'create_app: 中位数 {result["median"] * 1000:.1f}ms '
+               f'({", ".join(f"{s * 1000:.0f}" for s in result["runs"])}ms), 预算 {budget * 1000:.0f}ms')
+
+    failed = False
+    if result['loaded']:
+        click.echo(f'启动时加载了重量级模块: {", ".join(result["loaded"])}', err=True)
+        failed = True
+    if result['median'] > budget:
+        click.echo('超出启动耗时预算', err=True)
+        failed = True
+    if failed:
+        raise SystemExit(1)
+
+
+@bench_cli.command('serialize')
+@click.option('--limit', default=2000, show_default=True, help='每个响应的行数')
+@click.option('--repeat', default=5, show_default=True, help='重复次数，取平均')
+def bench_serialize_command(limit, repeat):
+    """列表接口序列化前后对比：ORM + to_dict + json 与 结果元组 + 行序列化器 + orjson（读取当前数据库）"""
+    from flask import current_app
+    from app.utils.benchmark import bench_serialization
+
+    rows = bench_serialization(current_app._get_current_object(), limit=limit, repeat=repeat,
+                               gzip_level=current_app.config['GZIP_LEVEL'])
+    click.echo(f'{"接口":<14} {"路径":<16} {"CPU ms":>8} {"字节":>10} {"MB/s":>8} {"gzip字节":>10} {"gzip ms":>8}')
+    for row in rows:
+        click.echo(f'{row["endpoint"]:<14} {row["path"]:<16} {row["cpu_ms"]:>8.2f} {row["bytes"]:>10} '
+                   f'{row["mb_per_second"]:>8.1f} {row["gzip_bytes"]:>10} {row["gzip_ms"]:>8.2f}')
+
+
+def register_cli(app):
+    """注册所有命令行工具"""
+    app.cli.add_command(snapshot_cli)
+    app.cli.add_command(model_cli)
+    app.cli.add_command(match_cli)
+    app.cli.add_command(scores_cli)
+    app.cli.add_command(rules_cli)
+    app.cli.add_command(history_cli)
+    app.cli.add_command(ai_cli)
+    app.cli.add_command(bench_cli)
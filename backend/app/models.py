@@ -51,7 +51,11 @@ class CustomerProfile(db.Model):
     _needs = db.Column(db.Text, nullable=True)  # 存储为JSON字符串
     _hobbies = db.Column(db.Text, nullable=True)  # 存储为JSON字符串
     customer_class = db.Column(db.String(1), nullable=True)  # A, B, C, D, E
+    # 分类时与最佳经理的需求/爱好重合数，等级规则变化时据此重新计算等级，不需要重新打分
+    best_needs_match = db.Column(db.Integer, nullable=True)
+    best_hobbies_match = db.Column(db.Integer, nullable=True)
     manager_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=True)
+    branch = db.Column(db.String(40), nullable=True, index=True)  # 所属网点，分配不跨网点
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     
@@ -85,6 +89,7 @@ class CustomerProfile(db.Model):
             'hobbies': self.hobbies,
             'customer_class': self.customer_class,
             'manager_id': self.manager_id,
+            'branch': self.branch,
             'created_at': self.created_at.isoformat(),
             'updated_at': self.updated_at.isoformat()
         }
@@ -95,6 +100,7 @@ class ManagerProfile(db.Model):
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     _capabilities = db.Column(db.Text, nullable=True)  # 存储为JSON字符串
     _hobbies = db.Column(db.Text, nullable=True)  # 存储为JSON字符串
+    branch = db.Column(db.String(40), nullable=True, index=True)  # 所属网点
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     
@@ -127,6 +133,7 @@ class ManagerProfile(db.Model):
             'capabilities': self.capabilities,
             'hobbies': self.hobbies,
             'customer_count': self.customer_count,
+            'branch': self.branch,
             'created_at': self.created_at.isoformat(),
             'updated_at': self.updated_at.isoformat()
         }
@@ -147,6 +154,13 @@ class MatchHistory(db.Model):
     manager = db.relationship('User', foreign_keys=[manager_id])
     creator = db.relationship('User', foreign_keys=[created_by])
     
+    # 按 (created_at, id) 键集分页，可叠加经理/客户过滤
+    __table_args__ = (
+        db.Index('ix_match_history_created', 'created_at', 'id'),
+        db.Index('ix_match_history_manager_created', 'manager_id', 'created_at', 'id'),
+        db.Index('ix_match_history_customer_created', 'customer_id', 'created_at', 'id'),
+    )
+    
     def to_dict(self):
         return {
             'id': self.id,
@@ -161,6 +175,97 @@ class MatchHistory(db.Model):
             'manager': self.manager.to_dict() if self.manager else None
         }
 
+# 客户×经理匹配分数缓存（每个客户只保留分数最高的前N个经理）
+class MatchScore(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    customer_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    manager_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
+    rank = db.Column(db.Integer, nullable=False)  # 0为最佳
+    total_match = db.Column(db.Integer, nullable=False)
+    needs_match = db.Column(db.Integer, nullable=False)
+    hobbies_match = db.Column(db.Integer, nullable=False)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    
+    __table_args__ = (
+        db.UniqueConstraint('customer_id', 'manager_id', name='uq_match_score_pair'),
+        db.Index('ix_match_score_customer_rank', 'customer_id', 'rank'),
+    )
+    
+    def to_dict(self):
+        return {
+            'customer_id': self.customer_id,
+            'manager_id': self.manager_id,
+            'rank': self.rank,
+            'total_match': self.total_match,
+            'needs_match': self.needs_match,
+            'hobbies_match': self.hobbies_match,
+            'updated_at': self.updated_at.isoformat()
+        }
+
+# 版本化的客户等级规则和经理容量，最新的一行生效，旧版本保留用于审计和回滚
+class ClassRuleSet(db.Model):
+    id = db.Column(db.Integer, primary_key=True)  # 即规则版本号
+    _thresholds = db.Column('thresholds', db.Text, nullable=False)  # JSON，从低到高的4个总重合数阈值
+    upgrade_margin = db.Column(db.Integer, nullable=True)  # 需求比爱好多这么多时升一级，为空表示不升级
+    capacity = db.Column(db.Integer, nullable=False)  # 每个经理最多负责的客户数
+    note = db.Column(db.String(200), nullable=True)
+    created_by = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    @property
+    def thresholds(self):
+        return json.loads(self._thresholds)
+    
+    @thresholds.setter
+    def thresholds(self, value):
+        self._thresholds = json.dumps([int(v) for v in value])
+    
+    def to_dict(self):
+        return {
+            'version': self.id,
+            'thresholds': self.thresholds,
+            'upgrade_margin': self.upgrade_margin,
+            'capacity': self.capacity,
+            'note': self.note,
+            'created_by': self.created_by,
+            'created_at': self.created_at.isoformat() if self.created_at else None
+        }
+
+# 预先生成的客户洞察（分类批处理结束后刷新，经理客户簿接口可以直接读取）
+class CustomerInsight(db.Model):
+    customer_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    _payload = db.Column('payload', db.Text, nullable=False)  # JSON，与 generate_customer_insights 的结果相同
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    
+    @property
+    def payload(self):
+        return json.loads(self._payload)
+    
+    @payload.setter
+    def payload(self, value):
+        self._payload = json.dumps(value, ensure_ascii=False)
+
+# 匹配历史按天、按经理的汇总（写入匹配历史时同步维护，归档原始记录后仍保留）
+class MatchDailyStat(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    day = db.Column(db.Date, nullable=False)
+    manager_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    match_count = db.Column(db.Integer, nullable=False, default=0)
+    score_sum = db.Column(db.Float, nullable=False, default=0)
+    
+    __table_args__ = (
+        db.UniqueConstraint('day', 'manager_id', name='uq_match_daily_stat'),
+        db.Index('ix_match_daily_stat_manager_day', 'manager_id', 'day'),
+    )
+    
+    def to_dict(self):
+        return {
+            'day': self.day.isoformat(),
+            'manager_id': self.manager_id,
+            'match_count': self.match_count,
+            'average_score': round(self.score_sum / self.match_count, 4) if self.match_count else None
+        }
+
 # 人工智能表
 class AIInteraction(db.Model):
     id = db.Column(db.BigInteger, primary_key=True)
@@ -175,6 +280,11 @@ class AIInteraction(db.Model):
     user_image = db.Column(db.Text, nullable=False)  # 用户头像
     type = db.Column(db.Integer, nullable=False)  # 内容类型
     
+    # 按用户的会话流按 (add_time, id) 键集分页
+    __table_args__ = (
+        db.Index('ix_ai_interaction_user_time', 'user_id', 'add_time', 'id'),
+    )
+    
     def __repr__(self):
         return f'<AIInteraction {self.id}>'
     
@@ -192,3 +302,46 @@ class AIInteraction(db.Model):
             'user_image': self.user_image,
             'type': self.type
         }
+
+# 每个用户未读回复数（已回复且未读的 AIInteraction 条数），修改已读状态时同步维护
+class AIUnreadCounter(db.Model):
+    user_id = db.Column(db.BigInteger, primary_key=True, autoincrement=False)
+    unread_count = db.Column(db.Integer, nullable=False, default=0)
+    
+    def to_dict(self):
+        return {
+            'user_id': self.user_id,
+            'unread_count': self.unread_count
+        }
+
+# 跨 worker 的单飞锁：每种耗时操作一行，run_id 指向正在执行的 OperationRun，为空表示空闲
+class OperationLock(db.Model):
+    name = db.Column(db.String(50), primary_key=True)
+    run_id = db.Column(db.Integer, db.ForeignKey('operation_run.id'), nullable=True)
+    holder = db.Column(db.String(100), nullable=True)  # 主机名:进程号
+    heartbeat_at = db.Column(db.DateTime, nullable=True)
+
+# 耗时操作的执行记录，并发的调用方等待同一条记录并共享其结果
+class OperationRun(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(50), nullable=False, index=True)
+    kind = db.Column(db.String(50), nullable=True)  # 操作类型，只有类型相同的并发调用才合并到同一次执行
+    status = db.Column(db.String(20), nullable=False, default='running')  # running, succeeded, failed, abandoned
+    result = db.Column(db.Text, nullable=True)  # JSON
+    error = db.Column(db.Text, nullable=True)
+    started_by = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=True)
+    started_at = db.Column(db.DateTime, default=datetime.utcnow)
+    finished_at = db.Column(db.DateTime, nullable=True)
+    
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'name': self.name,
+            'kind': self.kind,
+            'status': self.status,
+            'result': json.loads(self.result) if self.result else None,
+            'error': self.error,
+            'started_by': self.started_by,
+            'started_at': self.started_at.isoformat() if self.started_at else None,
+            'finished_at': self.finished_at.isoformat() if self.finished_at else None
+        }
@@ -1,7 +1,9 @@
 
 # 初始化utils包
+# 聚类函数依赖 numpy/scikit-learn，按名称第一次访问时才导入 clustering 模块，
+# 避免 create_app 和与匹配无关的命令行工具在启动时加载它们
 
-from app.utils.clustering import compute_similarity_score, feature_engineering, classify_customers, auto_assign_customers, generate_customer_insights
+import importlib
 
 __all__ = [
     'compute_similarity_score',
@@ -10,3 +12,26 @@ __all__ = [
     'auto_assign_customers',
     'generate_customer_insights'
 ]
+
+# 预加载时导入的模块：匹配算法及其依赖的重量级库
+PRELOAD_MODULES = [
+    'numpy',
+    'sklearn.cluster',
+    'app.utils.engine',
+    'app.utils.clustering',
+    'app.utils.manager_model',
+    'app.utils.realtime',
+    'app.utils.score_cache',
+]
+
+
+def __getattr__(name):
+    if name in __all__:
+        return getattr(importlib.import_module('app.utils.clustering'), name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def preload():
+    """提前导入匹配相关的模块，配合 gunicorn --preload 时由 master 进程加载一次后 fork 给所有 worker"""
+    for module in PRELOAD_MODULES:
+        importlib.import_module(module)
@@ -0,0 +1,103 @@
+
+"""
+按端点的并发限制
+每个端点有若干个"槽位"文件，请求进来时非阻塞地对其中一个加 flock 排他锁，全部被占用时立即返回 429，
+避免耗时的统计请求占满 gunicorn worker。flock 在同一台机器的所有 worker 进程之间生效，
+进程退出时锁由内核自动释放，不会残留。
+per_worker 的端点（如 SSE 事件流）改为按进程计数，限制的是每个 worker 中被长连接占用的线程数；
+返回流式响应时，槽位在连接关闭后才释放。
+"""
+
+import fcntl
+import os
+import threading
+from functools import wraps
+
+from flask import Response, current_app, jsonify
+
+# per_worker 端点在本进程内的槽位：{端点名称: BoundedSemaphore}
+_worker_slots = {}
+_worker_slots_lock = threading.Lock()
+
+
+def parse_limits(value):
+    """解析 "admin_stats=2,admin_dashboard=4" 形式的配置"""
+    limits = {}
+    for item in filter(None, (part.strip() for part in value.split(','))):
+        name, _, limit = item.partition('=')
+        limits[name.strip()] = int(limit)
+    return limits
+
+
+def _try_acquire(lock_dir, name, limit):
+    """尝试占用一个槽位，返回打开的文件；全部被占用时返回None"""
+    os.makedirs(lock_dir, exist_ok=True)
+    for slot in range(limit):
+        f = open(os.path.join(lock_dir, f'{name}.{slot}.lock'), 'a')
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return f
+        except BlockingIOError:
+            f.close()
+    return None
+
+
+def _try_acquire_worker(name, limit):
+    """尝试占用本进程内的一个槽位，返回释放函数；全部被占用时返回None"""
+    with _worker_slots_lock:
+        semaphore = _worker_slots.setdefault(name, threading.BoundedSemaphore(limit))
+    if not semaphore.acquire(blocking=False):
+        return None
+    return semaphore.release
+
+
+def _try_acquire_shared(lock_dir, name, limit):
+    """尝试占用所有 worker 共用的一个槽位，返回释放函数；全部被占用时返回None"""
+    slot = _try_acquire(lock_dir, name, limit)
+    if slot is None:
+        return None
+
+    def release():
+        fcntl.flock(slot, fcntl.LOCK_UN)
+        slot.close()
+    return release
+
+
+def limit_concurrency(name, default_limit, retry_after=1, per_worker=False):
+    """限制端点在所有 worker 上的并发请求数，超出时直接返回 429
+
+    Args:
+        name: 端点名称，CONCURRENCY_LIMITS 中可以按名称覆盖上限（0表示不限制）
+        default_limit: 默认并发上限
+        retry_after: 429 响应中 Retry-After 的秒数
+        per_worker: 为真时上限按每个 worker 进程计算（用于长时间占用线程的流式响应）
+    """
+
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            limit = current_app.config['CONCURRENCY_LIMITS'].get(name, default_limit)
+            if not limit:
+                return view(*args, **kwargs)
+
+            if per_worker:
+                release = _try_acquire_worker(name, limit)
+            else:
+                release = _try_acquire_shared(current_app.config['CONCURRENCY_LOCK_DIR'], name, limit)
+            if release is None:
+                response = jsonify({'msg': '请求过多，请稍后重试'})
+                response.headers['Retry-After'] = str(retry_after)
+                return response, 429
+            try:
+                response = view(*args, **kwargs)
+            except BaseException:
+                release()
+                raise
+            # 流式响应的生成器在视图返回后才执行，连接关闭时再释放槽位
+            if isinstance(response, Response) and response.is_streamed:
+                response.call_on_close(release)
+            else:
+                release()
+            return response
+        return wrapper
+    return decorator
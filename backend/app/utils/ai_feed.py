@@ -0,0 +1,111 @@
+
+"""
+AI 对话流与未读计数
+会话流按 (user_id, add_time, id) 复合索引键集分页；未读数存放在 AIUnreadCounter 中，
+凡是改变"已回复且未读"状态的写入都经过这里并在同一事务内调整计数，角标只需读一行。
+"""
+
+from sqlalchemy import and_, case, func, or_
+
+from app import db
+from app.models import AIInteraction, AIUnreadCounter
+from app.utils.counters import increment_counters
+from app.utils.pagination import keyset_page
+
+
+def _unread():
+    """已回复且未读（is_read 为空或0）"""
+    return and_(AIInteraction.is_reply == 1,
+                or_(AIInteraction.is_read.is_(None), AIInteraction.is_read == 0))
+
+
+def _is_unread(interaction):
+    return interaction.is_reply == 1 and not interaction.is_read
+
+
+def _decrement(user_id, count):
+    """未读数减 count，不低于0（不提交）"""
+    if count:
+        AIUnreadCounter.query.filter_by(user_id=user_id).update({
+            AIUnreadCounter.unread_count: case(
+                (AIUnreadCounter.unread_count > count, AIUnreadCounter.unread_count - count), else_=0)
+        }, synchronize_session=False)
+
+
+def add_interaction(**fields):
+    """新增一条对话记录并维护未读数（不提交）"""
+    interaction = AIInteraction(**fields)
+    if interaction.is_reply is None:
+        interaction.is_reply = 0
+    db.session.add(interaction)
+    if _is_unread(interaction):
+        increment_counters(AIUnreadCounter, ['user_id'], [{'user_id': interaction.user_id, 'unread_count': 1}])
+    return interaction
+
+
+def reply_interaction(interaction, reply):
+    """写入回复；原来未回复的记录变为未读（不提交）"""
+    was_unread = _is_unread(interaction)
+    interaction.reply = reply
+    interaction.is_reply = 1
+    interaction.is_read = 0
+    if not was_unread:
+        increment_counters(AIUnreadCounter, ['user_id'], [{'user_id': interaction.user_id, 'unread_count': 1}])
+    return interaction
+
+
+def conversation_page(user_id, limit=50, cursor=None, query=None):
+    """按 (add_time, id) 倒序读取用户的对话流，返回 (记录列表, 下一页游标)
+
+    query 可以是只选取所需列的查询（结果行需要带 add_time 和 id 两列），默认返回 ORM 实例。
+    """
+    query = (query if query is not None else AIInteraction.query).filter(AIInteraction.user_id == user_id)
+    return keyset_page(query, AIInteraction.add_time, AIInteraction.id, limit=limit, cursor=cursor)
+
+
+def unread_count(user_id):
+    counter = db.session.get(AIUnreadCounter, user_id)
+    return counter.unread_count if counter else 0
+
+
+def mark_read(user_id, interaction_ids):
+    """把用户的指定记录标记为已读（一条 UPDATE，不提交）
+
+    Returns:
+        实际由未读变为已读的条数
+    """
+    if not interaction_ids:
+        return 0
+    changed = AIInteraction.query.filter(
+        AIInteraction.user_id == user_id, AIInteraction.id.in_(interaction_ids), _unread()
+    ).update({AIInteraction.is_read: 1}, synchronize_session=False)
+    _decrement(user_id, changed)
+    return changed
+
+
+def mark_all_read(user_id):
+    """把用户的全部未读记录标记为已读（一条 UPDATE，不提交）
+
+    Returns:
+        标记的条数
+    """
+    changed = AIInteraction.query.filter(AIInteraction.user_id == user_id, _unread()) \
+        .update({AIInteraction.is_read: 1}, synchronize_session=False)
+    _decrement(user_id, changed)
+    return changed
+
+
+def rebuild_unread_counts():
+    """由 AIInteraction 重新统计全部用户的未读数（初始化或与外部写入对账）
+
+    Returns:
+        有未读记录的用户数
+    """
+    rows = db.session.query(AIInteraction.user_id, func.count(AIInteraction.id)) \
+        .filter(_unread()).group_by(AIInteraction.user_id).all()
+    AIUnreadCounter.query.delete(synchronize_session=False)
+    db.session.bulk_insert_mappings(AIUnreadCounter, [
+        {'user_id': user_id, 'unread_count': count} for user_id, count in rows
+    ])
+    db.session.commit()
+    return len(rows)
@@ -0,0 +1,296 @@
+
+"""
+可断点续跑的离线分类与分配批处理
+按客户分块处理，每提交一块就写一次检查点；进程崩溃后从最后一个检查点继续。
+dry-run 模式只计算建议的分配方案并与当前 manager_id 做对比，不写数据库。
+"""
+
+import json
+import os
+import time
+import uuid
+from datetime import datetime
+
+import numpy as np
+from sqlalchemy import and_, or_
+
+from app import db
+from app.models import User, CustomerProfile
+from app.utils.class_rules import active_rules
+from app.utils.events import report_progress
+from app.utils.manager_model import build_manager_model
+from app.utils.match_history import record_matches
+from app.utils.score_cache import replace_rows, top_n_rows
+from app.utils.snapshot import customer_rows_query, decode_customer_rows, manager_loads
+
+STAGES = ['classify', 'assign']
+
+
+def default_checkpoint_path():
+    """当前应用配置下的默认检查点文件"""
+    from flask import current_app
+    return os.path.join(current_app.instance_path, 'match_run.checkpoint.json')
+
+
+class StageStats:
+    """单个阶段的吞吐量统计（跨续跑累计）"""
+
+    def __init__(self, rows=0, chunks=0, seconds=0.0):
+        self.rows = rows
+        self.chunks = chunks
+        self.seconds = seconds
+
+    def add(self, rows, seconds):
+        self.rows += rows
+        self.chunks += 1
+        self.seconds += seconds
+
+    @property
+    def rows_per_second(self):
+        return self.rows / self.seconds if self.seconds else 0.0
+
+    def to_dict(self):
+        return {
+            'rows': self.rows,
+            'chunks': self.chunks,
+            'seconds': round(self.seconds, 3),
+            'rows_per_second': round(self.rows_per_second, 1)
+        }
+
+
+class MatchRun:
+    """一次分类+分配批处理
+
+    Args:
+        chunk_size: 每块处理的客户数
+        checkpoint_path: 检查点文件路径，dry-run 时不使用
+        dry_run: 只计算建议方案，不写数据库
+        created_by: 记录匹配历史时使用的操作人ID
+        echo: 进度输出函数
+        score_cache_n: 分类阶段同时写入的分数缓存深度，为空时不更新缓存
+    """
+
+    def __init__(self, chunk_size=1000, checkpoint_path=None, dry_run=False, created_by=None, echo=None,
+                 score_cache_n=None):
+        self.chunk_size = chunk_size
+        self.score_cache_n = score_cache_n
+        self.checkpoint_path = checkpoint_path or default_checkpoint_path()
+        self.dry_run = dry_run
+        self.created_by = created_by
+        self.echo = echo or (lambda message: None)
+
+        self.run_id = uuid.uuid4().hex[:12]
+        self.stage = STAGES[0]
+        self.last_key = None
+        self.stats = {stage: StageStats() for stage in STAGES}
+        self.resumed = False
+
+        # dry-run 时在内存中保存分类结果和建议分配
+        self.proposed_classes = {}
+        self.proposed_best = {}
+        self.diff = []
+
+    # 检查点
+
+    def load_checkpoint(self):
+        """读取未完成的检查点，返回是否续跑"""
+        if self.dry_run or not os.path.exists(self.checkpoint_path):
+            return False
+        with open(self.checkpoint_path) as f:
+            checkpoint = json.load(f)
+        if checkpoint.get('stage') == 'done':
+            return False
+
+        self.run_id = checkpoint['run_id']
+        self.stage = checkpoint['stage']
+        self.last_key = checkpoint['last_key']
+        self.stats = {stage: StageStats(**checkpoint['stats'][stage]) for stage in STAGES}
+        self.resumed = True
+        return True
+
+    def save_checkpoint(self):
+        if self.dry_run:
+            return
+        checkpoint = {
+            'run_id': self.run_id,
+            'stage': self.stage,
+            'last_key': self.last_key,
+            'chunk_size': self.chunk_size,
+            'saved_at': datetime.utcnow().isoformat(),
+            'stats': {stage: vars(s) for stage, s in self.stats.items()}
+        }
+        os.makedirs(os.path.dirname(self.checkpoint_path) or '.', exist_ok=True)
+        tmp_path = f'{self.checkpoint_path}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(checkpoint, f)
+        os.replace(tmp_path, self.checkpoint_path)
+
+    def _advance(self, stage):
+        self.stage = stage
+        self.last_key = None
+        self.save_checkpoint()
+
+    # 执行
+
+    def run(self):
+        """执行（或续跑）全部阶段
+
+        Returns:
+            报告字典：各阶段吞吐量、dry-run 时的差异列表
+        """
+        self.model = build_manager_model()
+        self.rules = active_rules()
+        if not self.model.manager_count:
+            self.echo('没有可用的经理，跳过')
+            return self.report()
+
+        if self.stage == 'classify':
+            self._classify_stage()
+            self._advance('assign')
+        if self.stage == 'assign':
+            self._assign_stage()
+            self._advance('done')
+
+        if not self.dry_run:
+            from app.utils.manager_model import notify_managers_changed
+            notify_managers_changed()
+        return self.report()
+
+    def _score(self, rows):
+        """对一块客户计算与所有经理的重合数和最佳经理"""
+        needs_overlap, hobbies_overlap = self.model.score_many(
+            [r[1] for r in rows], [r[2] for r in rows])
+        best = np.argmax(needs_overlap + hobbies_overlap, axis=1)
+        index = np.arange(len(rows))
+        classes = self.rules.classify(needs_overlap[index, best], hobbies_overlap[index, best])
+        return needs_overlap, hobbies_overlap, best, classes
+
+    def _classify_stage(self):
+        while True:
+            started = time.perf_counter()
+            query = customer_rows_query().order_by(CustomerProfile.user_id)
+            if self.last_key is not None:
+                query = query.filter(CustomerProfile.user_id > self.last_key)
+            chunk = decode_customer_rows(query.limit(self.chunk_size).all())
+            if not chunk:
+                break
+
+            customer_ids = list(chunk)
+            rows = list(chunk.values())
+            needs_overlap, hobbies_overlap, best, classes = self._score(rows)
+
+            if self.dry_run:
+                for customer_id, row, manager_index, customer_class in zip(customer_ids, rows, best, classes):
+                    self.proposed_classes[customer_id] = (row[3] or None, str(customer_class), row[4] if row[4] > 0 else None)
+                    self.proposed_best[customer_id] = int(manager_index)
+            else:
+                index = np.arange(len(rows))
+                db.session.bulk_update_mappings(CustomerProfile, [
+                    {'id': row[0], 'customer_class': str(customer_class),
+                     'best_needs_match': int(needs_match), 'best_hobbies_match': int(hobbies_match)}
+                    for row, customer_class, needs_match, hobbies_match
+                    in zip(rows, classes, needs_overlap[index, best], hobbies_overlap[index, best])
+                ])
+                if self.score_cache_n:
+                    replace_rows(customer_ids, top_n_rows(customer_ids, needs_overlap, hobbies_overlap,
+                                                          self.model.manager_ids, self.score_cache_n))
+                db.session.commit()
+
+            self.last_key = customer_ids[-1]
+            self.stats['classify'].add(len(rows), time.perf_counter() - started)
+            self.save_checkpoint()
+            self.echo(f'classify: 已处理至客户{self.last_key} (累计{self.stats["classify"].rows})')
+            report_progress('classify', self.stats['classify'].rows)
+
+    def _assign_stage(self):
+        if self.dry_run:
+            self._assign_dry_run(np.array(self.model.manager_loads, dtype=np.int64))
+            return
+
+        # 负载从数据库重新读取，续跑时已提交块的分配已经计入
+        loads = manager_loads(self.model.manager_ids)
+        while True:
+            started = time.perf_counter()
+            # 按 (客户等级, 用户ID) 排序的键集分页，与 auto_assign_customers 的分配顺序一致
+            query = customer_rows_query().filter(CustomerProfile.manager_id.is_(None)) \
+                .order_by(CustomerProfile.customer_class, CustomerProfile.user_id)
+            if self.last_key is not None:
+                last_class, last_id = self.last_key
+                query = query.filter(or_(
+                    CustomerProfile.customer_class > last_class,
+                    and_(CustomerProfile.customer_class == last_class, CustomerProfile.user_id > last_id)
+                ))
+            chunk = decode_customer_rows(query.limit(self.chunk_size).all())
+            if not chunk:
+                break
+
+            customer_ids = list(chunk)
+            rows = list(chunk.values())
+            needs_overlap, hobbies_overlap, best, _ = self._score(rows)
+
+            updates = []
+            matches = []
+            for i, (customer_id, row) in enumerate(zip(customer_ids, rows)):
+                j = _choose_manager(best[i], loads, self.rules.capacity)
+                loads[j] += 1
+                manager_id = int(self.model.manager_ids[j])
+                updates.append({'id': row[0], 'manager_id': manager_id})
+                matches.append((customer_id, manager_id, needs_overlap[i, j], hobbies_overlap[i, j]))
+            record_matches(matches, self.created_by)
+            db.session.bulk_update_mappings(CustomerProfile, updates)
+            db.session.commit()
+
+            last_row = rows[-1]
+            self.last_key = [last_row[3], customer_ids[-1]]
+            self.stats['assign'].add(len(rows), time.perf_counter() - started)
+            self.save_checkpoint()
+            self.echo(f'assign: 已处理至{self.last_key} (累计{self.stats["assign"].rows})')
+            report_progress('assign', self.stats['assign'].rows)
+
+    def _assign_dry_run(self, loads):
+        started = time.perf_counter()
+        class_priority = {'A': 0, 'B': 1, 'C': 2, 'D': 3, 'E': 4}
+        order = sorted(self.proposed_classes, key=lambda c: (class_priority.get(self.proposed_classes[c][1], 5), c))
+
+        for customer_id in order:
+            current_class, proposed_class, current_manager = self.proposed_classes[customer_id]
+            proposed_manager = current_manager
+            if current_manager is None:
+                j = _choose_manager(self.proposed_best[customer_id], loads, self.rules.capacity)
+                loads[j] += 1
+                proposed_manager = int(self.model.manager_ids[j])
+            if proposed_manager != current_manager or proposed_class != current_class:
+                self.diff.append({
+                    'customer_id': customer_id,
+                    'current_class': current_class,
+                    'proposed_class': proposed_class,
+                    'current_manager_id': current_manager,
+                    'proposed_manager_id': proposed_manager
+                })
+        self.stats['assign'].add(len(order), time.perf_counter() - started)
+
+    def report(self):
+        report = {
+            'run_id': self.run_id,
+            'dry_run': self.dry_run,
+            'resumed': self.resumed,
+            'stages': {stage: s.to_dict() for stage, s in self.stats.items()}
+        }
+        if self.dry_run:
+            report['diff'] = self.diff
+            report['manager_changes'] = sum(1 for d in self.diff if d['proposed_manager_id'] != d['current_manager_id'])
+            report['class_changes'] = sum(1 for d in self.diff if d['proposed_class'] != d['current_class'])
+        return report
+
+
+def _choose_manager(best_index, loads, capacity):
+    """最佳经理未满员时分配给他，否则分配给负载最小的经理（并列取第一个）"""
+    if loads[best_index] < capacity:
+        return int(best_index)
+    return int(np.argmin(loads))
+
+
+def default_created_by():
+    """未指定操作人时使用第一个管理员账号"""
+    admin = User.query.filter_by(role='admin').order_by(User.id).first()
+    return admin.id if admin else None
@@ -0,0 +1,410 @@
+
+"""
+匹配算法基准测试
+使用与 data_generator 相同分布的合成画像，直接在矩阵上测量，不依赖数据库；
+另有启动耗时和接口序列化的测量
+"""
+
+import gzip
+import json
+import os
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+from app.utils.data_generator import FINANCIAL_NEEDS, HOBBIES
+
+
+def _random_tag_rows(rng, rows, vocab, low, high, offset, width):
+    """每行随机选择 [low, high] 个不重复标签，写入 offset 开始的列"""
+    matrix = np.zeros((rows, width), dtype=np.uint8)
+    counts = rng.integers(low, high + 1, size=rows)
+    if vocab <= 64:
+        # 小词表：对随机键排序取前k个，保证不重复
+        picks = np.argsort(rng.random((rows, vocab)), axis=1)[:, :high]
+    else:
+        # 大词表：直接随机取列，重复的概率可以忽略
+        picks = rng.integers(0, vocab, size=(rows, high))
+    mask = np.arange(high) < counts[:, None]
+    row_index = np.repeat(np.arange(rows), high).reshape(rows, high)
+    matrix[row_index[mask], picks[mask] + offset] = 1
+    return matrix
+
+
+def synthetic_profiles(n_customers, n_managers, needs_vocab=len(FINANCIAL_NEEDS),
+                       hobbies_vocab=len(HOBBIES), tags_scale=1, seed=42):
+    """生成合成的客户/经理标签矩阵
+
+    标签数量区间与 data_generator 一致（客户2-5个需求、3-7个爱好；经理3-7个能力、2-5个爱好），
+    tags_scale 用于放大大词表场景下每人的标签数。需求和爱好共用一个列空间，需求在前。
+
+    Returns:
+        包含 customer_needs、customer_hobbies、manager_capabilities、manager_hobbies 的字典
+    """
+    rng = np.random.default_rng(seed)
+    width = needs_vocab + hobbies_vocab
+
+    def counts(low, high, vocab):
+        return min(low * tags_scale, vocab), min(high * tags_scale, vocab)
+
+    return {
+        'customer_needs': _random_tag_rows(rng, n_customers, needs_vocab, *counts(2, 5, needs_vocab), 0, width),
+        'customer_hobbies': _random_tag_rows(rng, n_customers, hobbies_vocab, *counts(3, 7, hobbies_vocab), needs_vocab, width),
+        'manager_capabilities': _random_tag_rows(rng, n_managers, needs_vocab, *counts(3, 7, needs_vocab), 0, width),
+        'manager_hobbies': _random_tag_rows(rng, n_managers, hobbies_vocab, *counts(2, 5, hobbies_vocab), needs_vocab, width),
+    }
+
+
+def _timed(func, repeat):
+    best = None
+    result = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def bench_parallel(data, worker_counts, repeat=1, shard_size=None):
+    """测量多进程打分在不同进程数下的扩展效率
+
+    以串行 best_manager_matches 为基准，每个进程数都校验结果与串行逐元素一致。
+
+    Returns:
+        每个进程数一行：耗时、加速比、扩展效率、结果是否一致
+    """
+    from app.utils.clustering import best_manager_matches
+    from app.utils.parallel import parallel_best_matches
+
+    args = (data['customer_needs'], data['customer_hobbies'],
+            data['manager_capabilities'], data['manager_hobbies'])
+    serial_seconds, expected = _timed(lambda: best_manager_matches(*args), repeat)
+
+    rows = [{'workers': 'serial', 'seconds': serial_seconds, 'speedup': 1.0, 'efficiency': 1.0, 'identical': True}]
+    for workers in worker_counts:
+        seconds, result = _timed(
+            lambda: parallel_best_matches(*args, workers=workers, shard_size=shard_size), repeat)
+        speedup = serial_seconds / seconds
+        rows.append({
+            'workers': workers,
+            'seconds': seconds,
+            'speedup': speedup,
+            'efficiency': speedup / workers,
+            'identical': all(np.array_equal(a, b) for a, b in zip(expected, result))
+        })
+    return rows
+
+
+def bench_tiles(data, tile_cells_list, repeat=1):
+    """测量分块打分在不同块大小下的耗时和峰值内存
+
+    以不分块（块大小为 客户数×经理数）为基准，逐元素校验结果一致；峰值内存用 tracemalloc 统计
+    numpy 在调用期间的分配，不含输入矩阵本身。
+
+    Returns:
+        每个块大小一行：耗时、峰值内存（MB）、结果是否一致
+    """
+    import tracemalloc
+    from app.utils.clustering import best_manager_matches
+
+    args = (data['customer_needs'], data['customer_hobbies'],
+            data['manager_capabilities'], data['manager_hobbies'])
+    full = len(args[0]) * len(args[2])
+
+    def measure(tile_cells):
+        seconds, result = _timed(lambda: best_manager_matches(*args, tile_cells=tile_cells), repeat)
+        tracemalloc.start()
+        try:
+            best_manager_matches(*args, tile_cells=tile_cells)
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        return seconds, peak / 1024 / 1024, result
+
+    full_seconds, full_peak, expected = measure(full)
+    rows = [{'tile_cells': full, 'seconds': full_seconds, 'peak_mb': full_peak, 'identical': True}]
+    for tile_cells in tile_cells_list:
+        seconds, peak, result = measure(tile_cells)
+        rows.append({
+            'tile_cells': tile_cells,
+            'seconds': seconds,
+            'peak_mb': peak,
+            'identical': all(np.array_equal(a, b) for a, b in zip(expected, result))
+        })
+    return rows
+
+
+def bench_engine(data, repeat=1, seed=42):
+    """测量与存储无关的匹配引擎各阶段的耗时（不经过 ORM 和数据库）
+
+    合成数据中约三分之一的客户已有经理，经理负载由这些客户统计，
+    分配阶段同时测试跳过已分配客户和容量已满时的回退。
+
+    Returns:
+        {'classify': 秒, 'results': 秒, 'assign': 秒, 'assigned': 分配的客户数, 'class_counts': 各等级人数}
+    """
+    from collections import Counter
+    from app.utils.engine import MatchData, assign, classification_results, classify
+
+    n_customers = len(data['customer_needs'])
+    n_managers = len(data['manager_capabilities'])
+    rng = np.random.default_rng(seed)
+    manager_ids = np.arange(1, n_managers + 1) + n_customers
+    customer_managers = np.where(rng.random(n_customers) < 1 / 3, rng.choice(manager_ids, n_customers), -1)
+    loads = Counter(customer_managers[customer_managers != -1].tolist())
+    match_data = MatchData(
+        np.arange(1, n_customers + 1), manager_ids,
+        customer_needs=data['customer_needs'], customer_hobbies=data['customer_hobbies'],
+        manager_capabilities=data['manager_capabilities'], manager_hobbies=data['manager_hobbies'],
+        customer_managers=customer_managers, manager_loads=[loads.get(int(m), 0) for m in manager_ids])
+
+    classify_seconds, classification = _timed(lambda: classify(match_data), repeat)
+    results_seconds, results = _timed(lambda: classification_results(match_data, classification), repeat)
+    assign_seconds, assignments = _timed(lambda: assign(
+        match_data, list(results), [r['customer_class'] for r in results.values()],
+        [r['best_manager_id'] for r in results.values()]), repeat)
+    return {
+        'classify': classify_seconds,
+        'results': results_seconds,
+        'assign': assign_seconds,
+        'assigned': len(assignments),
+        'class_counts': dict(sorted(Counter(classification.classes.tolist()).items())),
+    }
+
+
+def exact_top_k(data, k, block=20000):
+    """精确计算每个客户总分最高的 k 个经理（并列按经理行号）"""
+    needs = data['customer_needs'].astype(np.float32)
+    hobbies = data['customer_hobbies'].astype(np.float32)
+    capabilities = data['manager_capabilities'].astype(np.float32).T
+    manager_hobbies = data['manager_hobbies'].astype(np.float32).T
+
+    top = np.empty((len(needs), k), dtype=np.int64)
+    for start in range(0, len(needs), block):
+        total = needs[start:start + block] @ capabilities + hobbies[start:start + block] @ manager_hobbies
+        top[start:start + block] = np.argsort(-total, axis=1, kind='stable')[:, :k]
+    return top
+
+
+def bench_lsh(data, settings, k=5, repeat=1, seed=42):
+    """比较 LSH 候选 + 精确打分与全量精确打分
+
+    Args:
+        settings: (bands, rows) 列表
+        k: 计算 Recall@K 时的 K
+
+    Returns:
+        每组设置一行：耗时、加速比、Recall@K、最佳总分一致率、候选对比例
+    """
+    from app.utils.clustering import best_manager_matches
+    from app.utils.lsh import lsh_best_matches, lsh_candidate_pairs
+    from scipy import sparse
+
+    args = (data['customer_needs'], data['customer_hobbies'],
+            data['manager_capabilities'], data['manager_hobbies'])
+    exact_seconds, (_, exact_needs, exact_hobbies) = _timed(lambda: best_manager_matches(*args), repeat)
+    exact_total = exact_needs + exact_hobbies
+    top = exact_top_k(data, k)
+
+    customer_sets = sparse.hstack([sparse.csr_matrix(data['customer_needs']),
+                                   sparse.csr_matrix(data['customer_hobbies'])], format='csr')
+    manager_sets = sparse.hstack([sparse.csr_matrix(data['manager_capabilities']),
+                                  sparse.csr_matrix(data['manager_hobbies'])], format='csr')
+    n_managers = manager_sets.shape[0]
+
+    rows = []
+    for bands, band_rows in settings:
+        stats = {}
+        seconds, (_, needs, hobbies) = _timed(
+            lambda: lsh_best_matches(*args, bands=bands, rows=band_rows, seed=seed, fallback=False, stats=stats),
+            repeat)
+
+        customer_index, manager_index = lsh_candidate_pairs(customer_sets, manager_sets, bands, band_rows, seed)
+        candidates = np.sort(customer_index * n_managers + manager_index)
+        wanted = (np.arange(len(top))[:, None] * n_managers + top).ravel()
+        position = np.clip(np.searchsorted(candidates, wanted), 0, max(len(candidates) - 1, 0))
+        found = candidates[position] == wanted if len(candidates) else np.zeros(len(wanted), dtype=bool)
+
+        rows.append({
+            'bands': bands,
+            'rows': band_rows,
+            'seconds': seconds,
+            'speedup': exact_seconds / seconds,
+            'recall_at_k': float(found.mean()),
+            'best_agreement': float(((needs + hobbies) == exact_total).mean()),
+            'pair_fraction': stats['pair_fraction'],
+        })
+    return exact_seconds, rows
+
+
+def bench_prune(data, settings, n_clusters, repeat=1, seed=42, rules=None):
+    """比较聚类中心剪枝与全量精确打分
+
+    聚类在 classify_customers 中本来就要计算，这里先拟合一次 K-Means，计时只包含打分部分。
+
+    Args:
+        settings: (候选数, 退回阈值差或None) 列表
+        n_clusters: K-Means 聚类数
+        rules: 退回判断和等级一致率使用的等级规则，默认为 DEFAULT_RULES
+
+    Returns:
+        (精确打分耗时, 每组设置一行：耗时、加速比、最佳经理/总分/等级一致率、退回数、打分对比例)
+    """
+    from sklearn.cluster import KMeans
+    from app.utils.clustering import best_manager_matches, classify_match_counts
+    from app.utils.pruning import centroid_best_matches
+
+    args = (data['customer_needs'], data['customer_hobbies'],
+            data['manager_capabilities'], data['manager_hobbies'])
+    exact_seconds, (exact_best, exact_needs, exact_hobbies) = _timed(lambda: best_manager_matches(*args), repeat)
+    exact_classes = classify_match_counts(exact_needs, exact_hobbies, rules)
+
+    features = (data['customer_needs'] | data['customer_hobbies']).astype(np.float64)
+    clusters = KMeans(n_clusters=n_clusters, init='k-means++', random_state=seed, n_init=1).fit_predict(features)
+
+    rows = []
+    for top_n, margin in settings:
+        stats = {}
+        seconds, (best, needs, hobbies) = _timed(
+            lambda: centroid_best_matches(*args, clusters, top_n=top_n, margin=margin, sample=0, stats=stats,
+                                          rules=rules), repeat)
+        rows.append({
+            'top_n': top_n,
+            'margin': margin,
+            'seconds': seconds,
+            'speedup': exact_seconds / seconds,
+            'best_agreement': float((best == exact_best).mean()),
+            'total_agreement': float(((needs + hobbies) == (exact_needs + exact_hobbies)).mean()),
+            'class_agreement': float((classify_match_counts(needs, hobbies, rules) == exact_classes).mean()),
+            'fallback_customers': stats['fallback_customers'],
+            'pair_fraction': stats['pair_fraction'],
+        })
+    return exact_seconds, rows
+
+
+# create_app 时不应加载的重量级模块（只在第一次匹配时加载）
+HEAVY_MODULES = ['numpy', 'scipy', 'sklearn', 'pandas']
+
+_STARTUP_PROBE = """
+import json, sys, time
+started = time.perf_counter()
+from app import create_app
+create_app()
+elapsed = time.perf_counter() - started
+print(json.dumps({'seconds': elapsed, 'loaded': [m for m in %r if m in sys.modules]}))
+""" % (HEAVY_MODULES,)
+
+
+def _parse_importtime(stderr, top):
+    """从 -X importtime 的输出中取累计耗时最多的顶层包（不含子模块，包之间可能互相包含）"""
+    rows = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = (part.strip() for part in line[len('import time:'):].split('|'))
+        if '.' not in name:
+            rows.append((name, int(cumulative) / 1e6))
+    return sorted(rows, key=lambda row: -row[1])[:top]
+
+
+def bench_startup(app_dir, repeat=5, top=10):
+    """在全新的解释器中测量 import app + create_app() 的耗时
+
+    每次都启动新进程，避免模块缓存影响结果；子进程中关闭 MATCH_PRELOAD，测量的是默认启动路径。
+
+    Returns:
+        {'runs': 每次耗时, 'median': 中位数, 'loaded': 启动后已加载的重量级模块, 'top_imports': [(模块, 秒)]}
+    """
+    env = dict(os.environ, MATCH_PRELOAD='')
+    runs = []
+    loaded = set()
+    top_imports = []
+    for i in range(repeat):
+        command = [sys.executable] + (['-X', 'importtime'] if i == 0 else []) + ['-c', _STARTUP_PROBE]
+        completed = subprocess.run(command, cwd=app_dir, env=env, capture_output=True, text=True, check=True)
+        result = json.loads(completed.stdout.strip().splitlines()[-1])
+        runs.append(result['seconds'])
+        loaded.update(result['loaded'])
+        if i == 0:
+            top_imports = _parse_importtime(completed.stderr, top)
+    return {
+        'runs': runs,
+        'median': float(np.median(runs)),
+        'loaded': sorted(loaded),
+        'top_imports': top_imports,
+    }
+
+
+def _measure_response(build, repeat):
+    """重复执行 build() 生成响应体，返回每次的CPU/墙钟耗时和响应体"""
+    cpu = wall = 0.0
+    body = b''
+    for _ in range(repeat):
+        wall_started, cpu_started = time.perf_counter(), time.process_time()
+        body = build()
+        wall += time.perf_counter() - wall_started
+        cpu += time.process_time() - cpu_started
+    return cpu / repeat, wall / repeat, body
+
+
+def bench_serialization(app, limit=2000, repeat=5, gzip_level=6):
+    """比较列表接口的旧序列化路径（ORM + to_dict + 标准库 json）和新路径（结果元组 + 行序列化器 + orjson）
+
+    需要在应用上下文中调用，读取当前数据库中的客户和匹配历史。
+
+    Returns:
+        每个 (接口, 路径) 一行：每次响应的CPU毫秒、字节数、吞吐量、gzip 后字节数和压缩耗时
+    """
+    from flask.json.provider import DefaultJSONProvider
+    from app import db
+    from app.api.serializers import MATCH_CUSTOMER, MATCH_HISTORY_ROW, MATCH_MANAGER, USER_ROW
+    from app.models import MatchHistory, User
+    from app.utils.serialization import OrjsonProvider, orjson
+
+    std = DefaultJSONProvider(app)
+    providers = [('json', std, False)]
+    if orjson is not None:
+        providers.append(('orjson', OrjsonProvider(app), True))
+
+    def orm_customers():
+        db.session.expunge_all()
+        return [u.to_dict() for u in User.query.filter_by(role='customer').limit(limit)]
+
+    def orm_history():
+        db.session.expunge_all()
+        return [h.to_dict() for h in MatchHistory.query.order_by(MatchHistory.created_at.desc()).limit(limit)]
+
+    def row_customers(native):
+        rows = db.session.query(*USER_ROW.columns).filter(User.role == 'customer').limit(limit).all()
+        return USER_ROW.serialize(rows, native_datetime=native)
+
+    def row_history(native):
+        rows = db.session.query(*MATCH_HISTORY_ROW.columns) \
+            .join(MATCH_CUSTOMER, MATCH_CUSTOMER.id == MatchHistory.customer_id) \
+            .join(MATCH_MANAGER, MATCH_MANAGER.id == MatchHistory.manager_id) \
+            .order_by(MatchHistory.created_at.desc()).limit(limit).all()
+        return MATCH_HISTORY_ROW.serialize(rows, native_datetime=native)
+
+    cases = [('customers', 'to_dict + json', lambda: std.dumps(orm_customers()).encode())]
+    cases += [('customers', f'rows + {name}', lambda p=p, n=n: p.dumps(row_customers(n)).encode()) for name, p, n in providers]
+    cases.append(('match-history', 'to_dict + json', lambda: std.dumps(orm_history()).encode()))
+    cases += [('match-history', f'rows + {name}', lambda p=p, n=n: p.dumps(row_history(n)).encode()) for name, p, n in providers]
+
+    rows = []
+    for endpoint, path, build in cases:
+        build()  # 预热
+        cpu, wall, body = _measure_response(build, repeat)
+        gzip_cpu, _, compressed = _measure_response(lambda: gzip.compress(body, compresslevel=gzip_level), repeat)
+        rows.append({
+            'endpoint': endpoint,
+            'path': path,
+            'cpu_ms': cpu * 1000,
+            'bytes': len(body),
+            'mb_per_second': len(body) / wall / 1e6 if wall else float('inf'),
+            'gzip_bytes': len(compressed),
+            'gzip_ms': gzip_cpu * 1000,
+        })
+    return rows
@@ -0,0 +1,117 @@
+
+"""
+版本化的客户等级规则
+等级阈值、需求优先升级的差值和经理容量保存在 ClassRuleSet 表中，最新的版本生效，
+没有发布过版本时使用 engine.DEFAULT_RULES。分类时每个客户与最佳经理的需求/爱好重合数
+写入 CustomerProfile.best_needs_match / best_hobbies_match，规则变化后：
+- 预览：一次读出全部重合数，用规则的查找表 table[需求, 爱好] 向量化算出新等级，统计等级变化
+- 执行：一条 UPDATE ... SET customer_class = CASE ... 在数据库中重新计算等级，只改等级变化的行
+都不需要重新读取画像或与经理打分。还没有保存重合数的客户（规则上线前分类的）保持原等级，
+全量分类（flask match run 等）一次之后即可覆盖。
+经理容量只影响之后的分配，已超出新容量的经理用 flask match rebalance 调整。
+"""
+
+from collections import Counter
+from datetime import datetime
+
+import numpy as np
+from sqlalchemy import case, or_
+
+from app import db
+from app.models import ClassRuleSet, CustomerProfile
+from app.utils.engine import CLASS_LEVELS, DEFAULT_RULES, ClassRules
+
+
+def _to_rules(rule_set):
+    return ClassRules(rule_set.thresholds, rule_set.upgrade_margin, rule_set.capacity, version=rule_set.id)
+
+
+def active_rules():
+    """当前生效的规则（最新版本），没有发布过时为 DEFAULT_RULES"""
+    rule_set = ClassRuleSet.query.order_by(ClassRuleSet.id.desc()).first()
+    return _to_rules(rule_set) if rule_set else DEFAULT_RULES
+
+
+def rule_versions(limit=20):
+    """最近发布的规则版本（新的在前）"""
+    return [r.to_dict() for r in ClassRuleSet.query.order_by(ClassRuleSet.id.desc()).limit(limit)]
+
+
+def publish_rules(rules, created_by=None, note=None):
+    """把规则保存为新版本（不提交）
+
+    Returns:
+        带版本号的 ClassRules
+    """
+    rule_set = ClassRuleSet(upgrade_margin=rules.upgrade_margin, capacity=rules.capacity,
+                            note=note, created_by=created_by)
+    rule_set.thresholds = rules.thresholds.tolist()
+    db.session.add(rule_set)
+    db.session.flush()
+    return _to_rules(rule_set)
+
+
+def class_expression(rules, needs_column=CustomerProfile.best_needs_match,
+                     hobbies_column=CustomerProfile.best_hobbies_match):
+    """按规则由重合数计算等级的 SQL CASE 表达式，与 ClassRules.classify 的结果相同"""
+    total = needs_column + hobbies_column
+    level = sum(case((total >= int(threshold), 1), else_=0) for threshold in rules.thresholds)
+    if rules.upgrade_margin is not None:
+        level = level + case((needs_column >= hobbies_column + rules.upgrade_margin, 1), else_=0)
+    # 升级后超过最高一级的仍为最高级
+    return case(*[(level == i, str(CLASS_LEVELS[i])) for i in range(len(CLASS_LEVELS) - 1)],
+                else_=str(CLASS_LEVELS[-1]))
+
+
+def preview_reclassification(rules):
+    """统计按 rules 重新计算等级后的变化（只读）
+
+    Returns:
+        {'changed': 等级会变化的客户数, 'transitions': {'旧->新': 人数}, 'class_counts': 新的各等级人数,
+         'missing_counts': 没有保存重合数、保持原等级的客户数}
+    """
+    rows = db.session.query(CustomerProfile.customer_class, CustomerProfile.best_needs_match,
+                            CustomerProfile.best_hobbies_match).all()
+    stored = [row for row in rows if row[1] is not None and row[2] is not None]
+    report = {'changed': 0, 'transitions': {}, 'class_counts': {}, 'missing_counts': len(rows) - len(stored)}
+    if not stored:
+        return report
+
+    current = np.array([row[0] or '' for row in stored])
+    needs_match = np.array([row[1] for row in stored], dtype=np.int64)
+    hobbies_match = np.array([row[2] for row in stored], dtype=np.int64)
+    proposed = rules.lookup_table(int(needs_match.max()), int(hobbies_match.max()))[needs_match, hobbies_match]
+
+    changed = current != proposed
+    transitions = Counter(zip(current[changed].tolist(), proposed[changed].tolist()))
+    report['changed'] = int(changed.sum())
+    report['transitions'] = {f'{old or "-"}->{new}': count for (old, new), count in sorted(transitions.items())}
+    report['class_counts'] = dict(sorted(Counter(proposed.tolist()).items()))
+    return report
+
+
+def reclassify(rules):
+    """按 rules 在数据库中重新计算等级，只更新等级变化的行（不提交）
+
+    Returns:
+        更新的客户数
+    """
+    expression = class_expression(rules)
+    return CustomerProfile.query.filter(
+        CustomerProfile.best_needs_match.isnot(None),
+        CustomerProfile.best_hobbies_match.isnot(None),
+        or_(CustomerProfile.customer_class.is_(None), CustomerProfile.customer_class != expression),
+    ).update({CustomerProfile.customer_class: expression, CustomerProfile.updated_at: datetime.utcnow()},
+             synchronize_session=False)
+
+
+def apply_class_rules(rules, created_by=None, note=None):
+    """发布新版本并用一条 UPDATE 重新计算全部已保存重合数的客户的等级，然后提交
+
+    Returns:
+        {'rules': 新版本, 'reclassified': 等级变化的客户数}
+    """
+    rules = publish_rules(rules, created_by=created_by, note=note)
+    reclassified = reclassify(rules)
+    db.session.commit()
+    return {'rules': rules.to_dict(), 'reclassified': reclassified}
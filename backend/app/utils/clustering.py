@@ -5,11 +5,13 @@ K-Means++聚类算法和自动匹配功能
 """
 
 import numpy as np
-from sklearn.cluster import KMeans
-from app import db
-from app.models import User, CustomerProfile, ManagerProfile
+from app.models import User, CustomerProfile
+from app.utils import engine
+# 向量化规则和打分已移到与存储无关的 engine 模块，这里保留原有的导入路径
+from app.utils.engine import (CLASS_LEVELS, CLASS_THRESHOLDS, MANAGER_CAPACITY, TILE_CELLS,
+                              best_manager_matches, classify_match_counts)
 
-def compute_similarity_score(customer_needs, customer_hobbies, manager_capabilities, manager_hobbies):
+def compute_similarity_score(customer_needs, customer_hobbies, manager_capabilities, manager_hobbies, rules=None):
     """计算客户和经理之间的相似度分数
     
     Args:
@@ -17,6 +19,7 @@ def compute_similarity_score(customer_needs, customer_hobbies, manager_capabilit
         customer_hobbies: 客户的爱好列表
         manager_capabilities: 经理的能力列表
         manager_hobbies: 经理的爱好列表
+        rules: 等级规则（engine.ClassRules），默认为内置规则；按当前生效的规则分级时传入 class_rules.active_rules()
         
     Returns:
         包含总匹配分数、需求匹配数、爱好匹配数和客户等级的字典
@@ -27,37 +30,18 @@ def compute_similarity_score(customer_needs, customer_hobbies, manager_capabilit
     # 计算爱好的重合数
     hobbies_match = len(set(customer_hobbies).intersection(set(manager_hobbies)))
     
-    # 总重合数
-    total_match = needs_match + hobbies_match
-    
-    # 确定客户类别
-    if total_match >= 13:
-        customer_class = 'A'
-    elif total_match >= 10:
-        customer_class = 'B'
-    elif total_match >= 7:
-        customer_class = 'C'
-    elif total_match >= 4:
-        customer_class = 'D'
-    else:
-        customer_class = 'E'
-    
-    # 升级规则：如果需求重合数比爱好重合数多2及以上，客户类别自动升级
-    if needs_match >= hobbies_match + 2 and customer_class != 'A':
-        if customer_class == 'B':
-            customer_class = 'A'
-        elif customer_class == 'C':
-            customer_class = 'B'
-        elif customer_class == 'D':
-            customer_class = 'C'
-        elif customer_class == 'E':
-            customer_class = 'D'
-    
+    # 确定客户类别：总重合数按阈值分级，需求重合数比爱好重合数多出升级差值时升一级
+    return similarity_from_counts(needs_match, hobbies_match, rules)
+
+def similarity_from_counts(needs_match, hobbies_match, rules=None):
+    """由已知的重合数构造与 compute_similarity_score 相同结构的结果"""
+    needs_match = int(needs_match)
+    hobbies_match = int(hobbies_match)
     return {
-        'total_match': total_match,
+        'total_match': needs_match + hobbies_match,
         'needs_match': needs_match,
         'hobbies_match': hobbies_match,
-        'customer_class': customer_class
+        'customer_class': str(classify_match_counts(needs_match, hobbies_match, rules))
     }
 
 def feature_engineering(customers_data, managers_data):
@@ -105,172 +89,71 @@ def feature_engineering(customers_data, managers_data):
     
     return customer_features, manager_features, feature_names
 
-def classify_customers():
+def classify_customers(snapshot=None, workers=1, kernel=None, branch=None, score_cache=True):
     """对所有客户进行分类
     
-    使用K-Means++算法对客户进行聚类，并根据与经理的匹配度确定客户等级
+    使用K-Means++算法对客户进行聚类，并根据与经理的匹配度确定客户等级。
+    计算由 engine.classify 完成，这里只负责从数据库读取和写回客户等级。
+    
+    Args:
+        snapshot: 可选的 ProfileSnapshot，提供时直接使用快照中的标签矩阵
+        workers: 大于1时把客户分片后在多进程中并行打分，结果与串行完全一致
+        kernel: 可选的最佳经理计算函数，签名与 best_manager_matches 相同，
+            例如 lsh.lsh_kernel("32x2") 返回的近似候选打分，或 pruning.centroid_kernel("20:1")
+            返回的按聚类中心剪枝的打分
+        branch: 只对该网点的客户分类，且只与该网点的经理打分（见 partition 模块）
+        score_cache: 分类后同时重写这些客户的分数缓存（深度为 MATCH_SCORE_TOP_N）
     
     Returns:
         包含客户分类结果的字典
     """
-    # 获取所有客户资料
-    customers = User.query.filter_by(role='customer').all()
-    customer_profiles = {}
-    customers_data = []
-    
-    for customer in customers:
-        profile = CustomerProfile.query.filter_by(user_id=customer.id).first()
-        if profile:
-            customer_profiles[customer.id] = profile
-            customers_data.append({
-                'id': customer.id,
-                'needs': profile.needs,
-                'hobbies': profile.hobbies
-            })
-    
-    # 获取所有经理资料
-    managers = User.query.filter_by(role='manager').all()
-    manager_profiles = {}
-    managers_data = []
-    
-    for manager in managers:
-        profile = ManagerProfile.query.filter_by(user_id=manager.id).first()
-        if profile:
-            manager_profiles[manager.id] = profile
-            managers_data.append({
-                'id': manager.id,
-                'capabilities': profile.capabilities,
-                'hobbies': profile.hobbies
-            })
-    
-    # 如果没有客户或经理，则返回空结果
-    if not customers_data or not managers_data:
-        return {}
-    
-    # 特征工程：将客户和经理的特征转换为数值向量
-    customer_features, manager_features, feature_names = feature_engineering(customers_data, managers_data)
-    
-    # 使用K-Means++算法对客户进行聚类
-    # 聚类数量取决于经理数量，但不少于5（对应A-E五个等级）
-    n_clusters = max(5, min(len(managers_data), len(customers_data) // 10 + 1))
-    
-    # 如果客户数量太少，则不进行聚类
-    if len(customers_data) < 5:
-        n_clusters = min(len(customers_data), len(managers_data))
+    from app.utils.class_rules import active_rules
+    from app.utils.repository import SQLAlchemyRepository
     
-    # 执行K-Means++聚类
-    kmeans = KMeans(n_clusters=n_clusters, init='k-means++', random_state=42, n_init=10)
-    customer_clusters = kmeans.fit_predict(customer_features)
-    
-    # 对每个客户计算最佳匹配
-    results = {}
-    
-    for i, customer_data in enumerate(customers_data):
-        customer_id = customer_data['id']
-        customer_needs = customer_data['needs']
-        customer_hobbies = customer_data['hobbies']
-        
-        best_match = None
-        best_score = -1
-        best_manager_id = None
-        
-        for manager_data in managers_data:
-            manager_id = manager_data['id']
-            manager_capabilities = manager_data['capabilities']
-            manager_hobbies = manager_data['hobbies']
-            
-            similarity = compute_similarity_score(
-                customer_needs, customer_hobbies, 
-                manager_capabilities, manager_hobbies
-            )
-            
-            if similarity['total_match'] > best_score:
-                best_score = similarity['total_match']
-                best_match = similarity
-                best_manager_id = manager_id
-        
-        # 更新客户类别
-        customer_profile = customer_profiles.get(customer_id)
-        if customer_profile and best_match:
-            customer_profile.customer_class = best_match['customer_class']
-            
-        results[customer_id] = {
-            'cluster': int(customer_clusters[i]),
-            'customer_class': best_match['customer_class'] if best_match else 'E',
-            'best_manager_id': best_manager_id,
-            'similarity_score': best_match
-        }
-    
-    # 提交数据库更改
-    db.session.commit()
+    repository = SQLAlchemyRepository(branch)
+    data = snapshot if snapshot is not None else repository.load()
+    classification = engine.classify(data, workers=workers, kernel=kernel, rules=active_rules())
+    if not len(classification):
+        return {}
     
-    return results
+    repository.save(data, classes=classification.classes,
+                    match_counts=(classification.needs_match, classification.hobbies_match))
+    if score_cache:
+        from app.utils.score_cache import write_scores_from_data
+        write_scores_from_data(data)
+    return engine.classification_results(data, classification)
 
-def auto_assign_customers():
+def auto_assign_customers(workers=1, kernel=None, classification=None, branch=None):
     """自动分配客户给经理
     
-    基于客户分类和经理负载自动分配客户
+    基于客户分类和经理负载自动分配客户，规则见 engine.assign
+    
+    Args:
+        workers, kernel: 分类打分方式，见 classify_customers
+        classification: 同一请求中已经得到的 classify_customers 结果，提供时不再重复分类
+        branch: 只在该网点内分配，经理负载也只统计该网点的经理
     
     Returns:
         包含分配结果的字典，键为客户ID，值为经理ID
     """
+    from app.utils.class_rules import active_rules
+    from app.utils.repository import SQLAlchemyRepository
+    
     # 先对客户进行分类
-    classification = classify_customers()
-    
-    # 获取所有客户和经理
-    customers = User.query.filter_by(role='customer').all()
-    customer_profiles = {c.id: CustomerProfile.query.filter_by(user_id=c.id).first() for c in customers}
-    
-    managers = User.query.filter_by(role='manager').all()
-    
-    # 初始化经理的当前分配数
-    manager_load = {}
-    for manager in managers:
-        profile = ManagerProfile.query.filter_by(user_id=manager.id).first()
-        if profile:
-            customer_count = CustomerProfile.query.filter_by(manager_id=manager.id).count()
-            manager_load[manager.id] = customer_count
-    
-    # 按客户类别排序（A, B, C, D, E）
-    # 将客户ID和分类结果组合在一起
-    sorted_customers = []
-    for customer_id, info in classification.items():
-        customer_class = info.get('customer_class', 'E')
-        sorted_customers.append((customer_id, customer_class, info.get('best_manager_id')))
-    
-    # 按照客户类别排序
-    class_priority = {'A': 0, 'B': 1, 'C': 2, 'D': 3, 'E': 4}
-    sorted_customers.sort(key=lambda x: class_priority.get(x[1], 5))
-    
-    # 分配客户
-    assignments = {}
-    
-    for customer_id, customer_class, best_manager_id in sorted_customers:
-        # 跳过已分配的客户
-        if customer_profiles.get(customer_id) and customer_profiles[customer_id].manager_id:
-            continue
-            
-        # 找到负载最小的经理
-        min_load_manager = min(manager_load.items(), key=lambda x: x[1])[0] if manager_load else None
-        
-        # 如果最佳匹配的经理负载过大(超过50个客户)，或者没有最佳匹配，选择负载最小的经理
-        if not best_manager_id or best_manager_id not in manager_load or manager_load.get(best_manager_id, 0) >= 50:
-            assigned_manager = min_load_manager
-        else:
-            assigned_manager = best_manager_id
-        
-        # 确保有可用的经理
-        if assigned_manager:
-            # 更新客户的经理ID
-            customer_profile = customer_profiles.get(customer_id)
-            if customer_profile:
-                customer_profile.manager_id = assigned_manager
-                manager_load[assigned_manager] = manager_load.get(assigned_manager, 0) + 1
-            
-            assignments[customer_id] = assigned_manager
+    if classification is None:
+        classification = classify_customers(workers=workers, kernel=kernel, branch=branch)
+    
+    repository = SQLAlchemyRepository(branch)
+    data = repository.load_assignment_state()
+    assignments = engine.assign(
+        data, list(classification),
+        [info.get('customer_class', 'E') for info in classification.values()],
+        [info.get('best_manager_id') for info in classification.values()],
+        capacity=active_rules().capacity
+    )
     
     # 提交数据库更改
-    db.session.commit()
+    repository.save(data, assignments=assignments)
     
     return assignments
 
@@ -292,21 +175,51 @@ def generate_customer_insights(customer_id):
     
     # 获取客户资料
     customer = User.query.get(customer_id)
-    needs = customer_profile.needs
-    hobbies = customer_profile.hobbies
-    customer_class = customer_profile.customer_class or 'E'
+    
+    # 分数缓存中的候选经理
+    from app.utils.score_cache import candidate_managers
+    recommended_managers = [
+        {'manager_id': s.manager_id, 'total_match': s.total_match} for s in candidate_managers(customer_id, limit=3)
+    ]
+    
+    return build_customer_insights(customer.name, customer_profile.needs, customer_profile.hobbies,
+                                   customer_profile.customer_class, recommended_managers)
+
+# 客户等级说明
+CLASS_DESCRIPTIONS = {
+    'A': '优质客户，需求与银行服务高度匹配',
+    'B': '高价值客户，满足大部分银行服务需求',
+    'C': '中等价值客户，部分服务匹配',
+    'D': '潜力客户，少量服务匹配',
+    'E': '基础客户，需进一步了解需求'
+}
+
+# 需求对应的金融产品
+FINANCIAL_PRODUCTS = {
+    'savings': '储蓄产品',
+    'investment': '投资产品',
+    'insurance': '保险服务',
+    'loan': '贷款服务',
+    'mortgage': '住房贷款',
+    'retirement': '退休规划',
+    'tax': '税务规划',
+    'education': '教育基金',
+    'wealthManagement': '财富管理',
+}
+
+def build_customer_insights(customer_name, needs, hobbies, customer_class, recommended_managers):
+    """由已经读出的客户数据生成洞察，不访问数据库（单个客户和整本客户簿共用）
+    
+    Args:
+        recommended_managers: 候选经理列表，每项为 {'manager_id', 'total_match'}
+    """
+    customer_class = customer_class or 'E'
     
     # 生成洞察
     insights = {
-        'customer_name': customer.name,
+        'customer_name': customer_name,
         'customer_class': customer_class,
-        'class_description': {
-            'A': '优质客户，需求与银行服务高度匹配',
-            'B': '高价值客户，满足大部分银行服务需求',
-            'C': '中等价值客户，部分服务匹配',
-            'D': '潜力客户，少量服务匹配',
-            'E': '基础客户，需进一步了解需求'
-        }.get(customer_class, '未知类别'),
+        'class_description': CLASS_DESCRIPTIONS.get(customer_class, '未知类别'),
         'needs_analysis': f'客户有{len(needs)}项明确金融需求',
         'hobbies_analysis': f'客户有{len(hobbies)}项个人兴趣爱好',
         'recommendations': []
@@ -324,20 +237,10 @@ def generate_customer_insights(customer_id):
         insights['recommendations'].append('通过问卷或访谈进一步了解需求')
     
     # 基于具体需求的建议
-    financial_products = {
-        'savings': '储蓄产品',
-        'investment': '投资产品',
-        'insurance': '保险服务',
-        'loan': '贷款服务',
-        'mortgage': '住房贷款',
-        'retirement': '退休规划',
-        'tax': '税务规划',
-        'education': '教育基金',
-        'wealthManagement': '财富管理',
-    }
-    
     for need in needs:
-        if need in financial_products:
-            insights['recommendations'].append(f'推荐{financial_products[need]}相关咨询和服务')
+        if need in FINANCIAL_PRODUCTS:
+            insights['recommendations'].append(f'推荐{FINANCIAL_PRODUCTS[need]}相关咨询和服务')
+    
+    insights['recommended_managers'] = list(recommended_managers)
     
     return insights
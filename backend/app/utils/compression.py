@@ -0,0 +1,37 @@
+
+"""
+JSON 响应的 gzip 压缩
+客户端在 Accept-Encoding 中接受 gzip 且响应体超过阈值时才压缩，小响应压缩得不偿失。
+流式响应（如 SSE）和已经编码过的响应保持原样。
+"""
+
+import gzip
+
+from flask import request
+
+
+def should_compress(response, min_size):
+    if response.status_code != 200 or response.direct_passthrough or response.is_streamed:
+        return False
+    if response.mimetype != 'application/json' or 'Content-Encoding' in response.headers:
+        return False
+    return response.content_length is not None and response.content_length >= min_size
+
+
+def init_compression(app):
+    """注册压缩钩子，阈值和压缩级别分别由 GZIP_MIN_SIZE、GZIP_LEVEL 配置（阈值为0时不压缩）"""
+
+    @app.after_request
+    def compress_response(response):
+        min_size = app.config['GZIP_MIN_SIZE']
+        if not min_size or not should_compress(response, min_size):
+            return response
+
+        # 是否压缩取决于请求头，缓存需要按 Accept-Encoding 区分
+        response.vary.add('Accept-Encoding')
+        if not request.accept_encodings['gzip']:
+            return response
+
+        response.set_data(gzip.compress(response.get_data(), compresslevel=app.config['GZIP_LEVEL']))
+        response.headers['Content-Encoding'] = 'gzip'
+        return response
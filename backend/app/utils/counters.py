@@ -0,0 +1,48 @@
+
+"""
+计数器表的原子累加
+按唯一键插入或累加计数列（MySQL 使用 ON DUPLICATE KEY UPDATE，SQLite/PostgreSQL 使用 ON CONFLICT），
+并发写入同一键时依靠唯一约束合并，避免先查后插的竞争。
+"""
+
+from app import db
+
+
+def increment_counters(model, key_columns, rows):
+    """把 rows 中的计数累加到计数器表（不提交）
+
+    Args:
+        model: 计数器模型，key_columns 上必须有唯一约束
+        key_columns: 唯一键列名列表
+        rows: 字典列表，除键列外的字段都是要累加的增量
+    """
+    if not rows:
+        return
+    table = model.__table__
+    counter_columns = [name for name in rows[0] if name not in key_columns]
+    dialect = db.session.get_bind().dialect.name
+
+    if dialect == 'mysql':
+        from sqlalchemy.dialects.mysql import insert
+        stmt = insert(table)
+        stmt = stmt.on_duplicate_key_update({
+            name: table.c[name] + stmt.inserted[name] for name in counter_columns
+        })
+        db.session.execute(stmt, rows)
+    elif dialect in ('sqlite', 'postgresql'):
+        if dialect == 'sqlite':
+            from sqlalchemy.dialects.sqlite import insert
+        else:
+            from sqlalchemy.dialects.postgresql import insert
+        stmt = insert(table)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=key_columns,
+            set_={name: table.c[name] + stmt.excluded[name] for name in counter_columns})
+        db.session.execute(stmt, rows)
+    else:
+        for row in rows:
+            updated = model.query.filter_by(**{name: row[name] for name in key_columns}).update({
+                getattr(model, name): getattr(model, name) + row[name] for name in counter_columns
+            }, synchronize_session=False)
+            if not updated:
+                db.session.add(model(**row))
@@ -42,6 +42,9 @@ HOBBIES = [
     'wine',            # 品酒
 ]
 
+# 网点列表
+BRANCHES = ['north', 'south', 'east', 'west']
+
 # 职业列表
 OCCUPATIONS = [
     '工程师', '教师', '医生', '律师', '会计', '销售', '设计师',
@@ -129,7 +132,8 @@ def create_customers(count):
             user_id=customer.id,
             age=age,
             occupation=occupation,
-            total_assets=total_assets
+            total_assets=total_assets,
+            branch=random.choice(BRANCHES)
         )
         profile.needs = needs
         profile.hobbies = hobbies
@@ -176,7 +180,8 @@ def create_managers(count):
         hobbies_count = random.randint(2, 5)
         hobbies = random.sample(HOBBIES, hobbies_count)
         
-        profile = ManagerProfile(user_id=manager.id)
+        # 经理轮流分到各网点，保证每个网点都有经理
+        profile = ManagerProfile(user_id=manager.id, branch=BRANCHES[(i - 1) % len(BRANCHES)])
         profile.capabilities = capabilities
         profile.hobbies = hobbies
         
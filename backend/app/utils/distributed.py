@@ -0,0 +1,473 @@
+
+"""
+多节点分布式打分
+协调者把客户按行切成工作单元，通过一个简单的 HTTP 协议分发给 worker 进程（本机或其他主机），
+worker 只做 best_manager_matches，不需要数据库和应用上下文：
+- GET  /managers            经理能力/爱好矩阵（npz），worker 启动时取一次
+- POST /lease               领取一个单元：200 返回该单元客户的标签矩阵（npz，响应头 X-Unit / X-Lease），
+                            204 表示暂时没有可领的单元（都已租出），410 表示已经结束
+- POST /complete?unit=&lease=  提交单元的最佳经理行号和重合数（npz）
+所有请求都要带 X-Match-Token。租约超时未提交的单元（worker 崩溃或失联）重新租给其他 worker，
+超过最大尝试次数时整个运行失败；本机 worker 全部退出且一个租约周期内没有任何 worker 活动时也失败。
+提交必须带上该单元租出时的某个租约，无法解析、行号越界或重合数为负的结果返回400。单元结果与由谁、第几次计算无关，重复提交时保留第一份，
+按单元顺序拼接后与单进程结果逐元素相同；合并后由协调者在一个事务里写回等级、分配和匹配历史。
+"""
+
+import io
+import secrets
+import threading
+import time
+import urllib.error
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+
+from app.utils.engine import best_manager_matches
+
+# 每个工作单元的客户数
+DEFAULT_UNIT_SIZE = 5000
+
+# 租约超时（秒），超时未提交的单元重新分发
+DEFAULT_LEASE_TIMEOUT = 120
+
+# 单元最多被租出的次数
+DEFAULT_MAX_ATTEMPTS = 3
+
+# 协调者等待时检查租约和 worker 存活的间隔（秒）
+WAIT_POLL_INTERVAL = 1.0
+
+TOKEN_HEADER = 'X-Match-Token'
+
+
+class DistributedError(Exception):
+    """分布式运行失败（单元超过最大尝试次数、worker 全部失联或等待超时）"""
+
+
+def _pack(**arrays):
+    buffer = io.BytesIO()
+    np.savez(buffer, **arrays)
+    return buffer.getvalue()
+
+
+def _unpack(data):
+    with np.load(io.BytesIO(data), allow_pickle=False) as archive:
+        return {name: archive[name] for name in archive.files}
+
+
+class WorkUnit:
+    def __init__(self, index, start, stop):
+        self.index = index
+        self.start = start
+        self.stop = stop
+        self.attempts = 0
+        self.lease = None
+        self.leases = set()
+        self.leased_at = None
+        self.worker = None
+        self.result = None
+
+
+class Coordinator:
+    """持有全部输入和单元状态，在后台线程中提供 HTTP 服务
+
+    Args:
+        unit_size: 每个单元的客户数
+        lease_timeout: 租约超时秒数
+        max_attempts: 单元最多被租出的次数
+        token: 共享令牌，默认随机生成（远程 worker 启动时需要传入）
+        host, port: 监听地址，port 为0时自动选择
+    """
+
+    def __init__(self, customer_needs, customer_hobbies, manager_capabilities, manager_hobbies,
+                 unit_size=DEFAULT_UNIT_SIZE, lease_timeout=DEFAULT_LEASE_TIMEOUT,
+                 max_attempts=DEFAULT_MAX_ATTEMPTS, token=None, host='127.0.0.1', port=0):
+        self.customer_needs = customer_needs
+        self.customer_hobbies = customer_hobbies
+        self.manager_count = len(manager_capabilities)
+        self.managers_payload = _pack(manager_capabilities=np.asarray(manager_capabilities),
+                                      manager_hobbies=np.asarray(manager_hobbies))
+        total = len(customer_needs)
+        self.units = [WorkUnit(i, start, min(start + unit_size, total))
+                      for i, start in enumerate(range(0, total, unit_size))]
+        self.lease_timeout = lease_timeout
+        self.max_attempts = max_attempts
+        self.token = token or secrets.token_hex(16)
+        self.host = host
+        self.port = port
+        self.error = None
+        self.retries = 0
+        self.completed_by = {}
+        self.last_activity = time.monotonic()
+        self._lock = threading.Lock()
+        self._finished = threading.Event()
+        self._server = None
+        if not self.units:
+            self._finished.set()
+
+    @property
+    def url(self):
+        return f'http://{self.host}:{self._server.server_port}'
+
+    def start(self):
+        coordinator = self
+
+        class Handler(_Handler):
+            pass
+
+        Handler.coordinator = coordinator
+        self._server = ThreadingHTTPServer((self.host, self.port), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+
+    def _fail(self, error):
+        self.error = error
+        self._finished.set()
+        raise DistributedError(error)
+
+    def _check_exhausted(self, now):
+        """租约已超时且没有剩余尝试次数的单元使整个运行失败（需持有锁）"""
+        for unit in self.units:
+            if (unit.result is None and unit.lease is not None and now - unit.leased_at >= self.lease_timeout
+                    and unit.attempts >= self.max_attempts):
+                self._fail(f'单元{unit.index}已尝试{unit.attempts}次仍未完成（最后由 {unit.worker} 领取）')
+
+    def lease(self, worker):
+        """租出一个单元：优先从未租出的单元，其次是租约已超时的单元
+
+        Returns:
+            (单元, 租约)；暂时没有可租的单元时为 (None, None)
+        """
+        with self._lock:
+            if self._finished.is_set():
+                raise DistributedError(self.error or '已结束')
+            now = time.monotonic()
+            self.last_activity = now
+            self._check_exhausted(now)
+            for unit in self.units:
+                if unit.result is not None:
+                    continue
+                if unit.lease is not None and now - unit.leased_at < self.lease_timeout:
+                    continue
+                if unit.lease is not None:
+                    self.retries += 1
+                unit.attempts += 1
+                unit.lease = secrets.token_hex(8)
+                unit.leases.add(unit.lease)
+                unit.leased_at = now
+                unit.worker = worker
+                return unit, unit.lease
+            return None, None
+
+    def complete(self, index, lease, result, worker):
+        """记录单元结果；单元已完成时忽略（结果确定，第一份即可）
+
+        租约必须是该单元租出过的租约之一：租约超时后重新租出的单元，原 worker 迟到的结果同样有效。
+
+        Returns:
+            是否被采用
+        """
+        if not 0 <= index < len(self.units):
+            raise ValueError(f'单元编号无效: {index}')
+        unit = self.units[index]
+        size = unit.stop - unit.start
+        if any(len(result.get(name, ())) != size for name in ('best', 'needs_match', 'hobbies_match')):
+            raise ValueError(f'单元{index}的结果长度不是{size}')
+        best = np.asarray(result['best'])
+        if size and (not np.issubdtype(best.dtype, np.integer) or best.min() < 0 or best.max() >= self.manager_count):
+            raise ValueError(f'单元{index}的最佳经理行号不在 [0, {self.manager_count}) 内')
+        for name in ('needs_match', 'hobbies_match'):
+            counts = np.asarray(result[name])
+            if size and (not np.issubdtype(counts.dtype, np.integer) or counts.min() < 0):
+                raise ValueError(f'单元{index}的{name}不是非负整数')
+        with self._lock:
+            if lease not in unit.leases:
+                raise ValueError(f'单元{index}的租约无效')
+            self.last_activity = time.monotonic()
+            if unit.result is not None:
+                return False
+            unit.result = result
+            self.completed_by[worker] = self.completed_by.get(worker, 0) + 1
+            if all(u.result is not None for u in self.units):
+                self._finished.set()
+            return True
+
+    def wait(self, timeout=None, processes=None):
+        """等待全部单元完成，失败或超时时抛出 DistributedError
+
+        等待期间定期检查：租约超时且尝试次数已用完的单元直接判定失败（不依赖 worker 再来领取）；
+        传入本机 worker 进程时，它们全部退出且一个租约周期内没有任何 worker 领取或提交也判定失败。
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            remaining = WAIT_POLL_INTERVAL if deadline is None else min(WAIT_POLL_INTERVAL, deadline - time.monotonic())
+            if self._finished.wait(max(remaining, 0)):
+                break
+            if deadline is not None and time.monotonic() >= deadline:
+                raise DistributedError(f'等待超时，已完成{sum(u.result is not None for u in self.units)}/{len(self.units)}个单元')
+            with self._lock:
+                if self._finished.is_set():
+                    break
+                now = time.monotonic()
+                try:
+                    self._check_exhausted(now)
+                    if processes and not any(p.is_alive() for p in processes) \
+                            and now - self.last_activity >= self.lease_timeout:
+                        self._fail(f'本机 worker 已全部退出，且{self.lease_timeout}秒内没有 worker 活动')
+                except DistributedError:
+                    break
+        if self.error:
+            raise DistributedError(self.error)
+
+    def merged(self):
+        """按单元顺序拼接结果，返回 (最佳经理行号, 需求匹配数, 爱好匹配数)"""
+        if not self.units:
+            return (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.int32))
+        return tuple(
+            np.concatenate([np.asarray(u.result[name], dtype=dtype) for u in self.units])
+            for name, dtype in (('best', np.int64), ('needs_match', np.int32), ('hobbies_match', np.int32))
+        )
+
+    def stats(self):
+        return {
+            'units': len(self.units),
+            'retries': self.retries,
+            'completed_by': dict(sorted(self.completed_by.items())),
+        }
+
+
+class _Handler(BaseHTTPRequestHandler):
+    coordinator = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def _reply(self, status, body=b'', headers=None):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _authorized(self):
+        if secrets.compare_digest(self.headers.get(TOKEN_HEADER, ''), self.coordinator.token):
+            return True
+        self._reply(403)
+        return False
+
+    def do_GET(self):
+        if not self._authorized():
+            return
+        if urlparse(self.path).path == '/managers':
+            self._reply(200, self.coordinator.managers_payload)
+        else:
+            self._reply(404)
+
+    def do_POST(self):
+        if not self._authorized():
+            return
+        url = urlparse(self.path)
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        worker = self.headers.get('X-Worker', self.client_address[0])
+        coordinator = self.coordinator
+
+        if url.path == '/lease':
+            try:
+                unit, lease = coordinator.lease(worker)
+            except DistributedError:
+                return self._reply(410)
+            if unit is None:
+                return self._reply(204)
+            payload = _pack(customer_needs=np.asarray(coordinator.customer_needs[unit.start:unit.stop]),
+                            customer_hobbies=np.asarray(coordinator.customer_hobbies[unit.start:unit.stop]))
+            return self._reply(200, payload, {'X-Unit': str(unit.index), 'X-Lease': lease})
+
+        if url.path == '/complete':
+            params = parse_qs(url.query)
+            try:
+                result = _unpack(body)
+            except Exception as e:
+                # 截断或损坏的 npz（BadZipFile、OSError 等）
+                return self._reply(400, f'结果无法解析: {e}'.encode('utf-8'))
+            try:
+                accepted = coordinator.complete(int(params['unit'][0]), params.get('lease', [''])[0], result, worker)
+            except (KeyError, ValueError) as e:
+                return self._reply(400, str(e).encode('utf-8'))
+            return self._reply(200 if accepted else 409)
+
+        self._reply(404)
+
+
+def _call(url, token, worker, body=None, timeout=60):
+    request = urllib.request.Request(url, data=body, method='POST' if body is not None else 'GET',
+                                     headers={TOKEN_HEADER: token, 'X-Worker': worker})
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            return response.status, dict(response.headers), response.read()
+    except urllib.error.HTTPError as e:
+        return e.code, dict(e.headers), e.read()
+
+
+def run_worker(coordinator_url, token, worker=None, poll_interval=0.5, connect_retries=10, die_after=None):
+    """worker 主循环：领取单元、打分、提交，直到协调者返回 410
+
+    Args:
+        worker: worker 名称（出现在协调者的统计中），默认为 主机名:进程号
+        connect_retries: 连续连接失败的重试次数，超过后认为协调者已经退出
+        die_after: 测试用，领取到第 N 个单元后不提交直接退出，模拟崩溃的 worker
+
+    Returns:
+        本 worker 完成的单元数
+    """
+    import os
+    import socket
+
+    worker = worker or f'{socket.gethostname()}:{os.getpid()}'
+    coordinator_url = coordinator_url.rstrip('/')
+    managers = None
+    completed = 0
+    leased = 0
+    failures = 0
+    while True:
+        try:
+            if managers is None:
+                status, _, body = _call(f'{coordinator_url}/managers', token, worker)
+                if status != 200:
+                    raise DistributedError(f'读取经理矩阵失败: HTTP {status}')
+                managers = _unpack(body)
+
+            status, headers, body = _call(f'{coordinator_url}/lease', token, worker, body=b'')
+            failures = 0
+        except (urllib.error.URLError, ConnectionError, TimeoutError):
+            failures += 1
+            if failures > connect_retries:
+                return completed
+            time.sleep(poll_interval)
+            continue
+
+        if status == 410:
+            return completed
+        if status == 204:
+            time.sleep(poll_interval)
+            continue
+        if status != 200:
+            raise DistributedError(f'领取单元失败: HTTP {status}')
+
+        leased += 1
+        if die_after is not None and leased >= die_after:
+            os._exit(1)
+
+        unit = _unpack(body)
+        best, needs_match, hobbies_match = best_manager_matches(
+            unit['customer_needs'], unit['customer_hobbies'],
+            managers['manager_capabilities'], managers['manager_hobbies'])
+        query = f'unit={headers["X-Unit"]}&lease={headers["X-Lease"]}'
+        status, _, _ = _call(f'{coordinator_url}/complete?{query}', token, worker,
+                             body=_pack(best=best, needs_match=needs_match, hobbies_match=hobbies_match))
+        if status == 200:
+            completed += 1
+
+
+def start_local_workers(coordinator_url, token, count, die_after=None):
+    """在本机启动 count 个 worker 进程（spawn，不继承数据库连接）
+
+    Args:
+        die_after: 只对第一个 worker 生效，用于演示单元重试
+    """
+    import multiprocessing
+
+    context = multiprocessing.get_context('spawn')
+    processes = []
+    for i in range(count):
+        process = context.Process(
+            target=run_worker, args=(coordinator_url, token),
+            kwargs={'worker': f'local-{i}', 'die_after': die_after if i == 0 else None}, daemon=True)
+        process.start()
+        processes.append(process)
+    return processes
+
+
+def distributed_classify(data, local_workers=4, unit_size=DEFAULT_UNIT_SIZE, lease_timeout=DEFAULT_LEASE_TIMEOUT,
+                         max_attempts=DEFAULT_MAX_ATTEMPTS, token=None, host='127.0.0.1', port=0,
+                         timeout=None, echo=None, die_after=None, rules=None):
+    """分布式打分 + 协调者本地聚类，返回与 engine.classify 相同的 Classification
+
+    K-Means 在协调者上与 worker 打分同时进行；远程 worker 可以用 flask match worker 随时加入。
+    worker 只返回重合数，等级由协调者按 rules 计算。
+
+    Returns:
+        (Classification, 统计信息)
+    """
+    from app.utils.engine import Classification, fit_clusters
+
+    echo = echo or (lambda message: None)
+    if not len(data.customer_ids) or not len(data.manager_ids):
+        return Classification.empty(), {'units': 0, 'retries': 0, 'completed_by': {}}
+
+    coordinator = Coordinator(data.customer_needs, data.customer_hobbies,
+                              data.manager_capabilities, data.manager_hobbies,
+                              unit_size=unit_size, lease_timeout=lease_timeout, max_attempts=max_attempts,
+                              token=token, host=host, port=port).start()
+    processes = []
+    try:
+        echo(f'协调者 {coordinator.url}（令牌 {coordinator.token}），{len(coordinator.units)}个单元')
+        processes = start_local_workers(coordinator.url, coordinator.token, local_workers, die_after=die_after)
+        started = time.perf_counter()
+        clusters = fit_clusters(data)
+        echo(f'聚类完成 ({time.perf_counter() - started:.2f}s)，等待打分')
+        coordinator.wait(timeout, processes=processes)
+        best, needs_match, hobbies_match = coordinator.merged()
+    finally:
+        coordinator.stop()
+        for process in processes:
+            process.join(timeout=10)
+            if process.is_alive():
+                process.terminate()
+    return Classification(clusters, best, needs_match, hobbies_match, rules), coordinator.stats()
+
+
+def distributed_match(created_by, commit=True, **options):
+    """分布式分类和自动分配：打分结果合并后在一个事务里写回等级、经理和匹配历史
+
+    Args:
+        created_by: 匹配历史的操作人ID
+        commit: 为 False 时只计算不写回
+        options: 传给 distributed_classify
+
+    Returns:
+        (结果摘要, 输入数据, Classification)，后两者供调用方校验
+    """
+    from app import db
+    from app.utils.class_rules import active_rules
+    from app.utils.engine import assign, classification_results
+    from app.utils.match_history import record_assignments
+    from app.utils.repository import SQLAlchemyRepository
+
+    started = time.perf_counter()
+    repository = SQLAlchemyRepository()
+    data = repository.load()
+    rules = active_rules()
+    classification, stats = distributed_classify(data, rules=rules, **options)
+    results = classification_results(data, classification)
+    assignments = assign(data, list(results), [r['customer_class'] for r in results.values()],
+                         [r['best_manager_id'] for r in results.values()], capacity=rules.capacity)
+
+    recorded_matches = 0
+    if commit and len(classification):
+        recorded_matches = record_assignments(assignments, created_by)
+        repository.save(data, classes=classification.classes, assignments=assignments,
+                        match_counts=(classification.needs_match, classification.hobbies_match))
+    else:
+        db.session.rollback()
+
+    summary = dict(stats, customer_count=len(data.customer_ids), assigned_count=len(assignments),
+                   recorded_matches=recorded_matches, seconds=round(time.perf_counter() - started, 3))
+    return summary, data, classification
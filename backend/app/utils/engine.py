@@ -0,0 +1,407 @@
+
+"""
+与存储无关的匹配引擎
+输入是ID数组和按同一标签列编码的0/1矩阵，输出是客户等级、最佳经理和分配结果，
+不依赖 Flask 应用上下文、ORM 或数据库，可以直接用于快照、进程池 worker 和基准测试。
+数据的读取和写回由 repository 模块中的适配器负责（数据库、内存、列式快照文件），
+clustering 中的 classify_customers / auto_assign_customers 是数据库适配器上的包装。
+"""
+
+import heapq
+from collections import Counter
+
+import numpy as np
+
+# 默认等级阈值（从低到高），实际生效的规则见 ClassRules 和 class_rules 模块中的版本化配置
+CLASS_THRESHOLDS = np.array([4, 7, 10, 13])
+CLASS_LEVELS = np.array(['E', 'D', 'C', 'B', 'A'])
+
+# 需求重合数比爱好重合数多这么多及以上时升一级
+CLASS_UPGRADE_MARGIN = 2
+
+# 每个经理最多负责的客户数，超过后新客户改为分配给负载最小的经理
+MANAGER_CAPACITY = 50
+
+# 分配时按客户等级的先后顺序
+CLASS_PRIORITY = {'A': 0, 'B': 1, 'C': 2, 'D': 3, 'E': 4}
+
+# 分块打分时每块的 客户×经理 单元数上限（float32 时每个矩阵约16MB），峰值内存只取决于它
+TILE_CELLS = 4_000_000
+
+# 引擎输入需要的数组，ProfileSnapshot 和 MatchData 都提供这些属性
+INPUT_ARRAYS = [
+    'customer_ids', 'customer_needs', 'customer_hobbies', 'customer_managers',
+    'manager_ids', 'manager_capabilities', 'manager_hobbies', 'manager_loads'
+]
+
+
+class ClassRules:
+    """客户等级规则和经理容量
+
+    等级只取决于最佳经理的需求重合数和爱好重合数：总数按阈值分为 E–A 五级，
+    需求重合数比爱好重合数多 upgrade_margin 及以上时再升一级（upgrade_margin 为None时不升级）。
+
+    Args:
+        thresholds: 从低到高的4个总重合数阈值，分别是 D、C、B、A 的下限
+        capacity: 每个经理最多负责的客户数
+        version: 规则版本号，0表示内置的默认规则
+    """
+
+    def __init__(self, thresholds=CLASS_THRESHOLDS, upgrade_margin=CLASS_UPGRADE_MARGIN,
+                 capacity=MANAGER_CAPACITY, version=0):
+        thresholds = np.asarray(thresholds, dtype=np.int64)
+        if thresholds.shape != (len(CLASS_LEVELS) - 1,) or np.any(np.diff(thresholds) <= 0) or thresholds[0] < 0:
+            raise ValueError(f'等级阈值必须是{len(CLASS_LEVELS) - 1}个严格递增的非负整数')
+        if upgrade_margin is not None and upgrade_margin < 0:
+            raise ValueError('升级差值不能为负数')
+        if capacity <= 0:
+            raise ValueError('经理容量必须大于0')
+        self.thresholds = thresholds
+        self.upgrade_margin = None if upgrade_margin is None else int(upgrade_margin)
+        self.capacity = int(capacity)
+        self.version = version
+
+    def classify(self, needs_match, hobbies_match):
+        """按规则计算等级，输入为重合数数组（或标量），返回形状相同的等级数组"""
+        needs_match = np.asarray(needs_match)
+        hobbies_match = np.asarray(hobbies_match)
+        level = np.searchsorted(self.thresholds, needs_match + hobbies_match, side='right')
+        if self.upgrade_margin is not None:
+            level = np.minimum(level + (needs_match >= hobbies_match + self.upgrade_margin), len(CLASS_LEVELS) - 1)
+        return CLASS_LEVELS[level]
+
+    def lookup_table(self, max_needs, max_hobbies):
+        """(max_needs+1)×(max_hobbies+1) 的等级查找表，table[需求重合数, 爱好重合数] 即等级"""
+        needs_match, hobbies_match = np.meshgrid(np.arange(max_needs + 1), np.arange(max_hobbies + 1), indexing='ij')
+        return self.classify(needs_match, hobbies_match)
+
+    def to_dict(self):
+        return {
+            'version': self.version,
+            'thresholds': self.thresholds.tolist(),
+            'upgrade_margin': self.upgrade_margin,
+            'capacity': self.capacity,
+        }
+
+    def __eq__(self, other):
+        return isinstance(other, ClassRules) and np.array_equal(self.thresholds, other.thresholds) \
+            and self.upgrade_margin == other.upgrade_margin and self.capacity == other.capacity
+
+    def __repr__(self):
+        return f'<ClassRules v{self.version} {self.thresholds.tolist()} +{self.upgrade_margin} cap={self.capacity}>'
+
+
+# 没有发布过版本化配置时使用的规则，与 compute_similarity_score 原来写死的规则相同
+DEFAULT_RULES = ClassRules()
+
+
+def classify_match_counts(needs_match, hobbies_match, rules=None):
+    """等级规则的向量化版本
+
+    Args:
+        needs_match: 需求匹配数数组
+        hobbies_match: 爱好匹配数数组
+        rules: ClassRules，默认为 DEFAULT_RULES
+
+    Returns:
+        与输入形状相同的客户等级数组
+    """
+    return (rules or DEFAULT_RULES).classify(needs_match, hobbies_match)
+
+
+def best_manager_matches(customer_needs, customer_hobbies, manager_capabilities, manager_hobbies, tile_cells=TILE_CELLS):
+    """用矩阵运算为每个客户找出匹配度最高的经理
+
+    输入为按同一标签列顺序编码的0/1矩阵。并列最高时取第一个经理，
+    与 classify_customers 中逐个比较的结果一致。
+
+    客户按行分块、经理按块依次与之计算重合数，每块算完立即归约为块内最佳并与之前的结果合并，
+    不会构造完整的 客户数×经理数 矩阵；输入可以是 mmap 数组，每次只转换当前块。
+    等级只取决于最佳经理的重合数，由调用方对归约结果调用 classify_match_counts。
+
+    Args:
+        tile_cells: 每块的 客户×经理 单元数上限
+
+    Returns:
+        (最佳经理行号, 需求匹配数, 爱好匹配数) 三个长度为客户数的数组
+    """
+    n_customers = len(customer_needs)
+    n_managers = len(manager_capabilities)
+    # 用 float32 走BLAS矩阵乘法，重合数远小于 2^24，结果是精确整数
+    capabilities = np.asarray(manager_capabilities, dtype=np.float32)
+    manager_hobbies = np.asarray(manager_hobbies, dtype=np.float32)
+    manager_block = max(1, min(n_managers, tile_cells))
+    customer_tile = max(1, tile_cells // manager_block)
+
+    best = np.zeros(n_customers, dtype=np.int64)
+    needs_match = np.zeros(n_customers, dtype=np.int32)
+    hobbies_match = np.zeros(n_customers, dtype=np.int32)
+    for start in range(0, n_customers, customer_tile):
+        stop = min(start + customer_tile, n_customers)
+        needs_tile = np.asarray(customer_needs[start:stop], dtype=np.float32)
+        hobbies_tile = np.asarray(customer_hobbies[start:stop], dtype=np.float32)
+        rows = np.arange(stop - start)
+        best_total = np.full(stop - start, -1, dtype=np.int32)
+
+        for m_start in range(0, n_managers, manager_block):
+            m_stop = min(m_start + manager_block, n_managers)
+            needs_overlap = (needs_tile @ capabilities[m_start:m_stop].T).astype(np.int32)
+            hobbies_overlap = (hobbies_tile @ manager_hobbies[m_start:m_stop].T).astype(np.int32)
+            local = np.argmax(needs_overlap + hobbies_overlap, axis=1)
+            block_needs = needs_overlap[rows, local]
+            block_hobbies = hobbies_overlap[rows, local]
+
+            # 严格大于才替换：并列时保留前面块中的经理
+            better = block_needs + block_hobbies > best_total
+            best_total[better] = block_needs[better] + block_hobbies[better]
+            best[start:stop][better] = local[better] + m_start
+            needs_match[start:stop][better] = block_needs[better]
+            hobbies_match[start:stop][better] = block_hobbies[better]
+
+    return best, needs_match, hobbies_match
+
+
+def cluster_count(customer_count, manager_count):
+    # 聚类数量取决于经理数量，但不少于5（对应A-E五个等级）
+    n_clusters = max(5, min(manager_count, customer_count // 10 + 1))
+
+    # 如果客户数量太少，则不进行聚类
+    if customer_count < 5:
+        n_clusters = min(customer_count, manager_count)
+    return n_clusters
+
+
+def tag_matrix(tag_lists, tag_index):
+    """把标签列表编码为 uint8 的0/1矩阵，不在 tag_index 中的标签被忽略"""
+    matrix = np.zeros((len(tag_lists), len(tag_index)), dtype=np.uint8)
+    for i, tags in enumerate(tag_lists):
+        for tag in tags:
+            j = tag_index.get(tag)
+            if j is not None:
+                matrix[i, j] = 1
+    return matrix
+
+
+class MatchData:
+    """引擎的内存输入
+
+    客户和经理各自按ID升序排列；customer_managers 中未分配的客户为 -1，
+    manager_loads 为各经理当前的客户数。只做分配时标签矩阵可以为空。
+    """
+
+    def __init__(self, customer_ids, manager_ids, customer_needs=None, customer_hobbies=None,
+                 manager_capabilities=None, manager_hobbies=None, customer_managers=None,
+                 manager_loads=None, customer_profile_ids=None, tags=None):
+        self.customer_ids = np.asarray(customer_ids, dtype=np.int64)
+        self.manager_ids = np.asarray(manager_ids, dtype=np.int64)
+        self.customer_needs = customer_needs
+        self.customer_hobbies = customer_hobbies
+        self.manager_capabilities = manager_capabilities
+        self.manager_hobbies = manager_hobbies
+        self.customer_managers = np.full(len(self.customer_ids), -1, dtype=np.int64) \
+            if customer_managers is None else np.asarray(customer_managers, dtype=np.int64)
+        self.manager_loads = np.zeros(len(self.manager_ids), dtype=np.int64) \
+            if manager_loads is None else np.asarray(manager_loads, dtype=np.int64)
+        self.customer_profile_ids = customer_profile_ids
+        self.tags = tags or []
+
+    @classmethod
+    def from_profiles(cls, customers, managers):
+        """由标签列表构造
+
+        Args:
+            customers: {客户ID: {'needs': [...], 'hobbies': [...], 'manager_id': 经理ID或None}}
+            managers: {经理ID: {'capabilities': [...], 'hobbies': [...]}}
+        """
+        customer_ids = sorted(customers)
+        manager_ids = sorted(managers)
+        # 与 feature_engineering 相同：所有需求、能力和爱好的并集并排序
+        all_tags = set()
+        for customer in customers.values():
+            all_tags.update(customer.get('needs', []))
+            all_tags.update(customer.get('hobbies', []))
+        for manager in managers.values():
+            all_tags.update(manager.get('capabilities', []))
+            all_tags.update(manager.get('hobbies', []))
+        tags = sorted(all_tags)
+        tag_index = {tag: j for j, tag in enumerate(tags)}
+
+        loads = Counter(c.get('manager_id') for c in customers.values() if c.get('manager_id'))
+        return cls(
+            customer_ids, manager_ids,
+            customer_needs=tag_matrix([customers[c].get('needs', []) for c in customer_ids], tag_index),
+            customer_hobbies=tag_matrix([customers[c].get('hobbies', []) for c in customer_ids], tag_index),
+            manager_capabilities=tag_matrix([managers[m].get('capabilities', []) for m in manager_ids], tag_index),
+            manager_hobbies=tag_matrix([managers[m].get('hobbies', []) for m in manager_ids], tag_index),
+            customer_managers=[customers[c].get('manager_id') or -1 for c in customer_ids],
+            manager_loads=[loads.get(m, 0) for m in manager_ids],
+            tags=tags,
+        )
+
+    @property
+    def customer_count(self):
+        return len(self.customer_ids)
+
+    @property
+    def manager_count(self):
+        return len(self.manager_ids)
+
+    def __repr__(self):
+        return f'<MatchData {self.customer_count}x{self.manager_count}>'
+
+
+class Classification:
+    """分类结果，各数组与输入的客户顺序一致（best 为经理行号），等级按 rules 计算"""
+
+    def __init__(self, clusters, best, needs_match, hobbies_match, rules=None):
+        self.clusters = np.asarray(clusters, dtype=np.int64)
+        self.best = np.asarray(best, dtype=np.int64)
+        self.needs_match = np.asarray(needs_match, dtype=np.int32)
+        self.hobbies_match = np.asarray(hobbies_match, dtype=np.int32)
+        self.classes = classify_match_counts(self.needs_match, self.hobbies_match, rules) \
+            if len(self.best) else np.array([], dtype='<U1')
+
+    @classmethod
+    def empty(cls):
+        return cls([], [], [], [])
+
+    def __len__(self):
+        return len(self.best)
+
+
+def fit_clusters(data):
+    """对客户做 K-Means++ 聚类，返回每个客户的聚类编号（与打分互相独立，可以和打分并行）"""
+    # 客户特征为需求和爱好的并集，列顺序与 feature_engineering 相同
+    customer_features = (np.asarray(data.customer_needs) | np.asarray(data.customer_hobbies)).astype(np.float64)
+    n_clusters = cluster_count(len(data.customer_ids), len(data.manager_ids))
+    # scikit-learn 导入较慢，第一次分类时才加载
+    from sklearn.cluster import KMeans
+    kmeans = KMeans(n_clusters=n_clusters, init='k-means++', random_state=42, n_init=10)
+    return kmeans.fit_predict(customer_features)
+
+
+def classify(data, workers=1, kernel=None, rules=None):
+    """K-Means++ 聚类并为每个客户找出最佳经理和等级
+
+    Args:
+        data: MatchData 或 ProfileSnapshot
+        workers: 大于1时在多进程中分片打分，结果与串行完全一致
+        kernel: 可选的最佳经理计算函数，签名与 best_manager_matches 相同；
+            带 uses_clusters 属性的函数（如 pruning.centroid_kernel）额外接收聚类结果，带 uses_rules 属性的额外接收 rules
+        rules: 等级规则，默认为 DEFAULT_RULES
+
+    Returns:
+        Classification，没有客户或经理时为空
+    """
+    if not len(data.customer_ids) or not len(data.manager_ids):
+        return Classification.empty()
+
+    clusters = fit_clusters(data)
+
+    if kernel is not None:
+        extra = {'clusters': clusters} if getattr(kernel, 'uses_clusters', False) else {}
+        if getattr(kernel, 'uses_rules', False):
+            extra['rules'] = rules
+        best, needs_match, hobbies_match = kernel(
+            data.customer_needs, data.customer_hobbies, data.manager_capabilities, data.manager_hobbies, **extra)
+    elif workers > 1:
+        from app.utils.parallel import parallel_best_matches
+        best, needs_match, hobbies_match = parallel_best_matches(
+            data.customer_needs, data.customer_hobbies, data.manager_capabilities, data.manager_hobbies,
+            workers=workers)
+    else:
+        best, needs_match, hobbies_match = best_manager_matches(
+            data.customer_needs, data.customer_hobbies, data.manager_capabilities, data.manager_hobbies)
+    return Classification(clusters, best, needs_match, hobbies_match, rules)
+
+
+def classification_results(data, classification):
+    """转换为 classify_customers 的返回格式：{客户ID: {'cluster', 'customer_class', 'best_manager_id', 'similarity_score'}}"""
+    results = {}
+    for i, customer_id in enumerate(data.customer_ids[:len(classification)].tolist()):
+        needs_match = int(classification.needs_match[i])
+        hobbies_match = int(classification.hobbies_match[i])
+        customer_class = str(classification.classes[i])
+        results[customer_id] = {
+            'cluster': int(classification.clusters[i]),
+            'customer_class': customer_class,
+            'best_manager_id': int(data.manager_ids[classification.best[i]]),
+            'similarity_score': {
+                'total_match': needs_match + hobbies_match,
+                'needs_match': needs_match,
+                'hobbies_match': hobbies_match,
+                'customer_class': customer_class
+            }
+        }
+    return results
+
+
+def assign(data, customer_ids, classes, best_manager_ids, capacity=MANAGER_CAPACITY):
+    """按等级从高到低把未分配的客户分给经理
+
+    与原 auto_assign_customers 的规则相同：同等级保持输入顺序；最佳经理不存在或已达到容量时
+    改为分给当前负载最小的经理（并列取 data.manager_ids 中靠前的）；已有经理的客户
+    以及不在 data 中的客户跳过。负载从 data.manager_loads 开始累加。
+
+    Args:
+        data: 提供 customer_ids、customer_managers、manager_ids、manager_loads
+        customer_ids, classes, best_manager_ids: 待分配客户及其等级和最佳经理ID（可以为None）
+
+    Returns:
+        {客户ID: 经理ID}
+    """
+    managers = [int(m) for m in data.manager_ids]
+    loads = dict(zip(managers, (int(load) for load in data.manager_loads)))
+    position = {m: i for i, m in enumerate(managers)}
+    current = dict(zip(data.customer_ids.tolist(), (int(m) for m in data.customer_managers)))
+
+    # 负载最小的经理用堆维护，负载只增不减，堆顶负载与当前值不符的是过期项
+    heap = [(loads[m], position[m], m) for m in managers]
+    heapq.heapify(heap)
+
+    order = sorted(range(len(customer_ids)), key=lambda i: CLASS_PRIORITY.get(classes[i], 5))
+    assignments = {}
+    for i in order:
+        customer_id = int(customer_ids[i])
+        if current.get(customer_id, 0) != -1:
+            continue
+
+        best_manager_id = best_manager_ids[i]
+        if not best_manager_id or best_manager_id not in loads or loads[best_manager_id] >= capacity:
+            while heap and heap[0][0] != loads[heap[0][2]]:
+                heapq.heappop(heap)
+            if not heap:
+                continue
+            manager_id = heap[0][2]
+        else:
+            manager_id = best_manager_id
+
+        loads[manager_id] += 1
+        heapq.heappush(heap, (loads[manager_id], position[manager_id], manager_id))
+        assignments[customer_id] = manager_id
+    return assignments
+
+
+def run_match(repository, workers=1, kernel=None, rules=None):
+    """在一个仓库上执行分类和分配，结果一次写回
+
+    Args:
+        repository: 提供 load() 和 save(data, classes=None, assignments=None, match_counts=None) 的适配器
+        rules: 等级规则和经理容量，默认为 DEFAULT_RULES
+
+    Returns:
+        (分类结果，格式同 classify_customers; 分配结果 {客户ID: 经理ID})
+    """
+    rules = rules or DEFAULT_RULES
+    data = repository.load()
+    classification = classify(data, workers=workers, kernel=kernel, rules=rules)
+    results = classification_results(data, classification)
+    assignments = assign(
+        data, list(results), [info['customer_class'] for info in results.values()],
+        [info['best_manager_id'] for info in results.values()], capacity=rules.capacity)
+    if len(classification):
+        repository.save(data, classes=classification.classes, assignments=assignments,
+                        match_counts=(classification.needs_match, classification.hobbies_match))
+    else:
+        repository.save(data, assignments=assignments)
+    return results, assignments
@@ -0,0 +1,444 @@
+
+"""
+仪表盘事件推送（Server-Sent Events）
+分配变化、等级分布变化和后台任务进度写入本机的 SQLite 事件库（EVENTS_DB，同一台机器的所有 worker 共用），
+每个 worker 进程中有一个后台线程轮询新事件，分发给本进程内的所有 SSE 连接：
+一个 worker 上无论有多少个仪表盘连接，都只有一条 "id > 上次位置" 的主键范围查询，不访问业务数据库。
+
+事件库中还保存当前的等级分布和经理负载（state 表），与事件在同一个事务中更新：
+- 新连接先收到 snapshot 事件（当前分布），之后只收增量，不需要再轮询 /api/admin/stats
+- 断线重连时浏览器带上 Last-Event-ID，从事件库补发期间的事件；事件已被清理时重新发送 snapshot
+- 批处理（单飞锁下的分类、分配、再平衡、规则变更）结束后用两条 GROUP BY 重新统计分布并发布差异，
+  单个客户的变化（手动分配、资料更新、注册）直接按变化前后的等级和经理发布增量
+多台机器部署时每台机器各有自己的事件库，只能收到本机发布的事件。
+发布失败只记录日志，不影响业务请求本身。
+
+EventSource 不能设置请求头，令牌只能放在 URL 中（会出现在访问日志里），因此订阅使用单独签发的事件令牌：
+有效期很短（EVENTS_TOKEN_SECONDS，只用于建立连接），并且只在事件流接口上有效。
+"""
+
+import json
+import os
+import queue
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+from flask import current_app
+
+CLASSES = ['A', 'B', 'C', 'D', 'E']
+
+# 事件类型
+SNAPSHOT = 'snapshot'
+ASSIGNMENT = 'assignment'
+CLASSES_CHANGED = 'classes'
+JOB = 'job'
+
+# 事件令牌的 scope 声明
+EVENTS_TOKEN_SCOPE = 'events'
+
+# 每个连接最多缓存的未发送事件数，客户端太慢时断开，由浏览器重连后从事件库补发
+QUEUE_SIZE = 1000
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS event (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    type TEXT NOT NULL,
+    data TEXT NOT NULL,
+    created_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS state (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+'''
+
+_initialized = set()
+_brokers = {}
+_brokers_lock = threading.Lock()
+_last_progress = {}
+
+
+def _connect(path):
+    if path not in _initialized:
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        conn = sqlite3.connect(path, timeout=10, isolation_level=None)
+        try:
+            # WAL 模式下读取不阻塞写入
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.executescript(_SCHEMA)
+        finally:
+            conn.close()
+        _initialized.add(path)
+    conn = sqlite3.connect(path, timeout=10, isolation_level=None)
+    conn.execute('PRAGMA synchronous=NORMAL')
+    return conn
+
+
+@contextmanager
+def _transaction(path):
+    """写事务：BEGIN IMMEDIATE 在所有进程之间串行化对分布状态的读-改-写"""
+    conn = _connect(path)
+    try:
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield conn
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+    finally:
+        conn.close()
+
+
+def _dumps(data):
+    return json.dumps(data, ensure_ascii=False, separators=(',', ':'), default=str)
+
+
+def _insert(conn, event_type, data, retention):
+    event_id = conn.execute('INSERT INTO event (type, data, created_at) VALUES (?, ?, ?)',
+                            (event_type, _dumps(data), time.time())).lastrowid
+    # 只保留最近 retention 条，主键范围删除
+    conn.execute('DELETE FROM event WHERE id <= ?', (event_id - retention,))
+    return event_id
+
+
+def _read_state(conn):
+    row = conn.execute("SELECT value FROM state WHERE key = 'distribution'").fetchone()
+    return json.loads(row[0]) if row else None
+
+
+def _write_state(conn, state):
+    conn.execute("INSERT OR REPLACE INTO state (key, value) VALUES ('distribution', ?)", (_dumps(state),))
+
+
+def _enabled():
+    return current_app.config['EVENTS_ENABLED']
+
+
+def _publish_with(write, description):
+    """在事件库事务中执行 write(conn, retention)，失败只记录日志"""
+    if not _enabled():
+        return
+    path = current_app.config['EVENTS_DB']
+    try:
+        with _transaction(path) as conn:
+            write(conn, current_app.config['EVENTS_RETENTION'])
+    except Exception as e:
+        current_app.logger.warning(f"发布{description}事件失败: {str(e)}")
+        return
+    _wake(path)
+
+
+def publish(event_type, data):
+    """发布一个事件"""
+    _publish_with(lambda conn, retention: _insert(conn, event_type, data, retention), event_type)
+
+
+# 分布状态
+
+def current_distribution():
+    """从业务数据库统计等级分布和经理负载（两条 GROUP BY）"""
+    from app import db
+    from app.models import CustomerProfile
+
+    class_rows = db.session.query(CustomerProfile.customer_class, db.func.count()) \
+        .group_by(CustomerProfile.customer_class).all()
+    load_rows = db.session.query(CustomerProfile.manager_id, db.func.count()) \
+        .group_by(CustomerProfile.manager_id).all()
+    classes = dict(class_rows)
+    loads = {str(manager_id): count for manager_id, count in load_rows if manager_id is not None}
+    return {
+        'classes': {name: classes.get(name, 0) for name in CLASSES},
+        'loads': loads,
+        'unassigned': sum(count for manager_id, count in load_rows if manager_id is None),
+    }
+
+
+def _diff(old, new):
+    return {key: new.get(key, 0) - old.get(key, 0)
+            for key in sorted(set(old) | set(new)) if new.get(key, 0) != old.get(key, 0)}
+
+
+def ensure_state():
+    """事件库中还没有分布状态时（第一次使用或事件库被删除）从业务数据库统计一次"""
+    path = current_app.config['EVENTS_DB']
+    conn = _connect(path)
+    try:
+        if _read_state(conn) is not None:
+            return
+    finally:
+        conn.close()
+    distribution = current_distribution()
+    with _transaction(path) as conn:
+        if _read_state(conn) is None:
+            _write_state(conn, distribution)
+
+
+def publish_distribution(source, run_id=None):
+    """批处理结束后重新统计分布，与事件库中保存的分布比较，有变化时发布 classes / assignment 事件"""
+    if not _enabled():
+        return
+    try:
+        distribution = current_distribution()
+    except Exception as e:
+        current_app.logger.warning(f"统计等级分布失败: {str(e)}")
+        return
+
+    def write(conn, retention):
+        previous = _read_state(conn)
+        _write_state(conn, distribution)
+        if previous is None:
+            # 还没有连接读取过状态，没有需要推送增量的客户端
+            return
+        class_delta = _diff(previous['classes'], distribution['classes'])
+        if class_delta:
+            _insert(conn, CLASSES_CHANGED, {'source': source, 'run_id': run_id, 'delta': class_delta,
+                                            'counts': distribution['classes']}, retention)
+        load_delta = _diff(previous['loads'], distribution['loads'])
+        if load_delta or previous['unassigned'] != distribution['unassigned']:
+            _insert(conn, ASSIGNMENT, {'source': source, 'run_id': run_id, 'load_delta': load_delta,
+                                       'unassigned': distribution['unassigned'],
+                                       'unassigned_delta': distribution['unassigned'] - previous['unassigned']},
+                    retention)
+
+    _publish_with(write, '分布')
+
+
+def publish_customer_change(customer_id, before, after, source):
+    """单个客户的等级或经理变化后（已提交）发布增量
+
+    Args:
+        before: 变化前的 (等级, 经理ID)，新注册的客户为None
+        after: 变化后的 (等级, 经理ID)
+        source: 变化来源，如 manual-assign
+    """
+    old_class, old_manager = before if before is not None else (None, None)
+    new_class, new_manager = after
+    class_delta = _diff({old_class: 1} if old_class in CLASSES else {}, {new_class: 1} if new_class in CLASSES else {})
+    load_delta = _diff({str(old_manager): 1} if old_manager is not None else {},
+                       {str(new_manager): 1} if new_manager is not None else {})
+    unassigned_delta = (new_manager is None) - (before is not None and old_manager is None)
+    if not class_delta and not load_delta and not unassigned_delta:
+        return
+
+    def write(conn, retention):
+        state = _read_state(conn)
+        if state is not None:
+            for key, change in class_delta.items():
+                state['classes'][key] = state['classes'].get(key, 0) + change
+            for key, change in load_delta.items():
+                state['loads'][key] = state['loads'].get(key, 0) + change
+            state['unassigned'] += unassigned_delta
+            _write_state(conn, state)
+        if class_delta:
+            _insert(conn, CLASSES_CHANGED, {'source': source, 'customer_id': customer_id, 'delta': class_delta,
+                                            'counts': state and state['classes']}, retention)
+        if load_delta or unassigned_delta:
+            _insert(conn, ASSIGNMENT, {'source': source, 'customer_id': customer_id, 'manager_id': new_manager,
+                                       'previous_manager_id': old_manager, 'load_delta': load_delta,
+                                       'unassigned': state and state['unassigned'],
+                                       'unassigned_delta': unassigned_delta}, retention)
+
+    _publish_with(write, '分配')
+
+
+# 后台任务
+
+def publish_job(name, run_id, status, **fields):
+    """发布单飞操作的状态变化（running / succeeded / failed）"""
+    if status != 'running':
+        _last_progress.pop(run_id, None)
+    publish(JOB, {'run_id': run_id, 'name': name, 'status': status, **fields})
+
+
+def report_progress(stage, done, total=None):
+    """批处理在每块提交后调用，发布当前单飞操作的进度（每个操作每 EVENTS_PROGRESS_INTERVAL 秒最多一次）"""
+    from app.utils.single_flight import current_run
+
+    run = current_run()
+    if run is None or not _enabled():
+        return
+    name, run_id = run
+    now = time.monotonic()
+    if now - _last_progress.get(run_id, float('-inf')) < current_app.config['EVENTS_PROGRESS_INTERVAL']:
+        return
+    _last_progress[run_id] = now
+    publish(JOB, {'run_id': run_id, 'name': name, 'status': 'running', 'stage': stage,
+                  'done': done, 'total': total})
+
+
+# 进程内的订阅
+
+class Subscription:
+    """一个 SSE 连接：initial 为连接时先发送的事件，之后的事件从 queue 中读取（None 表示已被断开）"""
+
+    def __init__(self, after, initial):
+        self.after = after
+        self.initial = initial
+        self.queue = queue.Queue(QUEUE_SIZE)
+
+
+class Broker:
+    """每个进程、每个事件库一个：后台线程轮询新事件并分发给本进程的订阅者，没有订阅者时线程退出"""
+
+    def __init__(self, path, poll_interval):
+        self.path = path
+        self.poll_interval = poll_interval
+        self.subscribers = set()
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        self.thread = None
+        self.last_id = 0
+
+    def subscribe(self, last_event_id=None):
+        """订阅事件
+
+        last_event_id 仍在事件库中时从它之后补发，否则（新连接、事件已被清理）先发送当前分布的 snapshot。
+        """
+        with self.lock:
+            conn = _connect(self.path)
+            try:
+                conn.execute('BEGIN')
+                # 同一个读事务中取分布和最大ID，snapshot 恰好对应该ID之前的全部事件
+                state = _read_state(conn)
+                min_id, max_id = conn.execute('SELECT MIN(id), MAX(id) FROM event').fetchone()
+                max_id = max_id or 0
+                if self.thread is None:
+                    self.last_id = max_id
+                    self.thread = threading.Thread(target=self._run, name='event-broker', daemon=True)
+                    self.thread.start()
+
+                resumable = last_event_id is not None and last_event_id <= max_id and (
+                    min_id is None or last_event_id >= min_id - 1)
+                if resumable:
+                    after, initial = last_event_id, []
+                else:
+                    after, initial = max_id, [(max_id, SNAPSHOT, _dumps(state or {}))]
+                # 补发后台线程已经分发过、但在 after 之后的事件
+                initial += conn.execute('SELECT id, type, data FROM event WHERE id > ? AND id <= ? ORDER BY id',
+                                        (after, self.last_id)).fetchall()
+                conn.execute('COMMIT')
+            finally:
+                conn.close()
+
+            subscription = Subscription(max(after, self.last_id), initial)
+            self.subscribers.add(subscription)
+            return subscription
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            self.subscribers.discard(subscription)
+
+    def _run(self):
+        while True:
+            self.wake.wait(self.poll_interval)
+            self.wake.clear()
+            with self.lock:
+                if not self.subscribers:
+                    self.thread = None
+                    return
+                try:
+                    conn = _connect(self.path)
+                    try:
+                        rows = conn.execute('SELECT id, type, data FROM event WHERE id > ? ORDER BY id',
+                                            (self.last_id,)).fetchall()
+                    finally:
+                        conn.close()
+                except sqlite3.Error:
+                    continue
+                for row in rows:
+                    for subscription in list(self.subscribers):
+                        if row[0] <= subscription.after:
+                            continue
+                        try:
+                            subscription.queue.put_nowait(row)
+                            subscription.after = row[0]
+                        except queue.Full:
+                            # 换成只含结束标记的队列，连接在下一次读取时结束
+                            self.subscribers.discard(subscription)
+                            subscription.queue = _closed_queue()
+                if rows:
+                    self.last_id = rows[-1][0]
+
+
+def _closed_queue():
+    closed = queue.Queue(1)
+    closed.put_nowait(None)
+    return closed
+
+
+def _broker(path, poll_interval=None):
+    with _brokers_lock:
+        broker = _brokers.get(path)
+        if broker is None and poll_interval is not None:
+            broker = _brokers[path] = Broker(path, poll_interval)
+        return broker
+
+
+def _wake(path):
+    # 同一进程内发布的事件不必等到下一次轮询
+    broker = _broker(path)
+    if broker is not None:
+        broker.wake.set()
+
+
+def format_event(event_id, event_type, data):
+    """SSE 报文，data 为已经序列化的 JSON"""
+    return f'id: {event_id}\nevent: {event_type}\ndata: {data}\n\n'
+
+
+def event_stream(last_event_id=None, max_seconds=None):
+    """打开一个 SSE 事件流（在视图函数中调用，需要应用上下文），返回逐条产生报文的生成器
+
+    生成器本身不使用应用上下文和数据库会话，请求结束后长连接不占用数据库连接。
+    每 EVENTS_HEARTBEAT 秒发送一次注释行保持连接，同时及时发现已经断开的客户端；
+    max_seconds 后结束响应，浏览器按 retry 自动重连并带上 Last-Event-ID。
+    """
+    config = current_app.config
+    ensure_state()
+    broker = _broker(config['EVENTS_DB'], config['EVENTS_POLL_INTERVAL'])
+    subscription = broker.subscribe(last_event_id)
+    heartbeat = config['EVENTS_HEARTBEAT']
+    deadline = time.monotonic() + max_seconds if max_seconds else float('inf')
+    retry_ms = int(config['EVENTS_RETRY_SECONDS'] * 1000)
+
+    def generate():
+        try:
+            yield f'retry: {retry_ms}\n\n'
+            for row in subscription.initial:
+                yield format_event(*row)
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return
+                try:
+                    row = subscription.queue.get(timeout=min(heartbeat, remaining))
+                except queue.Empty:
+                    yield ': keepalive\n\n'
+                    continue
+                if row is None:
+                    return
+                yield format_event(*row)
+        finally:
+            broker.unsubscribe(subscription)
+
+    return generate()
+
+
+def create_events_token(user_id):
+    """签发只能用于订阅事件流的短期令牌"""
+    from datetime import timedelta
+    from flask_jwt_extended import create_access_token
+    return create_access_token(identity=user_id, additional_claims={'scope': EVENTS_TOKEN_SCOPE},
+                               expires_delta=timedelta(seconds=current_app.config['EVENTS_TOKEN_SECONDS']))
+
+
+def init_events_tokens(jwt):
+    """事件令牌只在事件流接口上有效，带着它访问其他接口时按令牌校验失败处理"""
+    from flask import request
+
+    @jwt.token_verification_loader
+    def verify_token_scope(jwt_header, jwt_data):
+        return jwt_data.get('scope') != EVENTS_TOKEN_SCOPE or request.endpoint == 'api.admin_events'
@@ -0,0 +1,144 @@
+
+"""
+经理客户簿的批量客户洞察
+经理仪表盘原来对每个客户调用一次 /api/customers/<id>/insights，每次都要单独查询资料、用户和权限。
+book_insights 用一条连接查询读出整本客户簿（用户、资料和分数缓存中前3名候选经理），一次生成全部洞察；
+缓存中还没有行的客户先现场计算并写回缓存，候选经理不会因为缓存缺失而为空。
+开启 INSIGHTS_PRECOMPUTED 时，分类批处理结束后把洞察写入 CustomerInsight，
+接口直接读取预先生成的结果；客户簿成员始终按当前分配关系查询，没有预生成结果的客户现场生成。
+"""
+
+import json
+
+from sqlalchemy import and_
+
+from app import db
+from app.models import CustomerInsight, CustomerProfile, MatchScore, User
+from app.utils.clustering import build_customer_insights
+from app.utils.score_cache import fill_missing_scores
+from app.utils.snapshot import branch_filter
+
+# 洞察中的候选经理数
+RECOMMENDED_MANAGERS = 3
+
+
+def _insight_rows(query):
+    """执行带候选经理外连接的查询，返回 [(客户ID, 洞察)]，顺序与查询一致"""
+    insights = {}
+    for user_id, name, needs, hobbies, customer_class, manager_id, total_match in query:
+        if user_id not in insights:
+            insights[user_id] = (name, needs, hobbies, customer_class, [])
+        managers = insights[user_id][4]
+        # 同一客户有多份资料时候选经理会重复出现
+        if manager_id is not None and all(m['manager_id'] != manager_id for m in managers):
+            managers.append({'manager_id': manager_id, 'total_match': total_match})
+    return [
+        (user_id, build_customer_insights(name, json.loads(needs) if needs else [],
+                                          json.loads(hobbies) if hobbies else [], customer_class, managers))
+        for user_id, (name, needs, hobbies, customer_class, managers) in insights.items()
+    ]
+
+
+def _insight_query():
+    """客户、资料与分数缓存前几名的连接查询，每个客户最多 RECOMMENDED_MANAGERS 行"""
+    return db.session.query(
+        User.id, User.name, CustomerProfile._needs, CustomerProfile._hobbies, CustomerProfile.customer_class,
+        MatchScore.manager_id, MatchScore.total_match
+    ).join(CustomerProfile, CustomerProfile.user_id == User.id).outerjoin(
+        MatchScore, and_(MatchScore.customer_id == User.id, MatchScore.rank < RECOMMENDED_MANAGERS)
+    ).filter(User.role == 'customer')
+
+
+def book_insights(manager_id, customer_ids=None):
+    """现场生成经理名下全部客户的洞察（一条查询）
+
+    Args:
+        customer_ids: 只生成这些客户（用于补齐没有预生成结果的客户）
+
+    Returns:
+        [{'customer_id', ...洞察}]，按客户ID排序
+    """
+    query = _insight_query().filter(CustomerProfile.manager_id == manager_id)
+    if customer_ids is not None:
+        query = query.filter(User.id.in_(list(customer_ids)))
+    if fill_missing_scores({user_id for (user_id,) in query.with_entities(User.id)}):
+        db.session.commit()
+    return [{'customer_id': user_id, **insights}
+            for user_id, insights in _insight_rows(query.order_by(User.id, MatchScore.rank))]
+
+
+def precomputed_book_insights(manager_id):
+    """读取经理名下客户的预生成洞察，缺失的客户现场生成
+
+    Returns:
+        (洞察列表, 现场生成的客户数)
+    """
+    rows = db.session.query(User.id, CustomerInsight._payload, CustomerInsight.updated_at) \
+        .join(CustomerProfile, CustomerProfile.user_id == User.id) \
+        .outerjoin(CustomerInsight, CustomerInsight.customer_id == User.id) \
+        .filter(User.role == 'customer', CustomerProfile.manager_id == manager_id).order_by(User.id).all()
+
+    results = {}
+    missing = []
+    for user_id, payload, updated_at in rows:
+        if user_id in results or user_id in missing:
+            continue
+        if payload is None:
+            missing.append(user_id)
+        else:
+            results[user_id] = {'customer_id': user_id, **json.loads(payload), 'updated_at': updated_at.isoformat()}
+    if missing:
+        results.update((item['customer_id'], item) for item in book_insights(manager_id, missing))
+    return [results[user_id] for user_id in sorted(results)], len(missing)
+
+
+def write_insights(customer_ids):
+    """重新生成这些客户的洞察行（不提交）
+
+    Returns:
+        写入的客户数
+    """
+    customer_ids = list(customer_ids)
+    fill_missing_scores(customer_ids)
+    rows = _insight_rows(_insight_query().filter(User.id.in_(customer_ids)).order_by(User.id, MatchScore.rank))
+    CustomerInsight.query.filter(CustomerInsight.customer_id.in_(customer_ids)).delete(synchronize_session=False)
+    db.session.bulk_insert_mappings(CustomerInsight, [
+        {'customer_id': user_id, '_payload': json.dumps(insights, ensure_ascii=False)} for user_id, insights in rows
+    ])
+    return len(rows)
+
+
+def rebuild_insights(branch=None, chunk_size=2000):
+    """重新生成客户洞察表（按客户ID键集分块提交）
+
+    Args:
+        branch: 只刷新该网点的客户（按网点分区重跑后使用）
+
+    Returns:
+        写入的客户数
+    """
+    written = 0
+    last_id = 0
+    while True:
+        ids_query = db.session.query(CustomerProfile.user_id).filter(CustomerProfile.user_id > last_id)
+        if branch is not None:
+            ids_query = ids_query.filter(branch_filter(CustomerProfile.branch, branch))
+        customer_ids = [c for (c,) in ids_query.distinct().order_by(CustomerProfile.user_id).limit(chunk_size)]
+        if not customer_ids:
+            return written
+
+        written += write_insights(customer_ids)
+        db.session.commit()
+        last_id = customer_ids[-1]
+
+
+def refresh_insights_after_classification(branch=None):
+    """分类/分配批处理提交后调用：开启了 INSIGHTS_PRECOMPUTED 时刷新洞察表，失败只记录日志"""
+    from flask import current_app
+    if not current_app.config['INSIGHTS_PRECOMPUTED']:
+        return
+    try:
+        rebuild_insights(branch=branch)
+    except Exception as e:
+        db.session.rollback()
+        current_app.logger.warning(f"刷新客户洞察失败: {str(e)}")
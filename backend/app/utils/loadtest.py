@@ -0,0 +1,326 @@
+
+"""
+接口压测
+在本地用 gunicorn 启动应用（连接单独生成的 SQLite 或 MySQL 兼容数据库），为每种角色登录一批账号，
+按配置的接口比例以目标请求速率发送请求，统计每个接口的吞吐量、p50/p95/p99 延迟和错误率，
+结果保存为 JSON，便于不同版本之间对比。
+
+请求按固定速率的时间表发出（开环），延迟从计划发送时刻算起：服务端变慢导致的排队时间也计入延迟，
+不会因为客户端等待而少发请求、掩盖尾延迟。
+"""
+
+import json
+import os
+import random
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from app.utils.data_generator import BRANCHES, FINANCIAL_NEEDS, HOBBIES, OCCUPATIONS
+
+# 压测账号的用户名前缀和统一密码
+USERNAME_PREFIX = 'lt_'
+PASSWORD = 'loadtest-123456'
+
+# 接口名称 -> (登录角色, 方法, 路径)；角色为None的接口不带令牌，路径中的 {user_id} 替换为当前账号ID
+ENDPOINTS = {
+    'login': (None, 'POST', '/api/auth/login'),
+    'customers': ('admin', 'GET', '/api/customers'),
+    'admin_stats': ('admin', 'GET', '/api/admin/stats'),
+    'admin_dashboard': ('admin', 'GET', '/api/admin/dashboard'),
+    'managers': ('admin', 'GET', '/api/managers'),
+    'match_history': ('admin', 'GET', '/api/admin/match-history?limit=50'),
+    'manager_customers': ('manager', 'GET', '/api/managers/{user_id}/customers'),
+    'manager_profile': ('manager', 'GET', '/api/managers/{user_id}/profile'),
+    'customer_profile': ('customer', 'GET', '/api/customers/{user_id}/profile'),
+    'customer_insights': ('customer', 'GET', '/api/customers/{user_id}/insights'),
+    'ai_unread': ('customer', 'GET', '/api/ai/unread-count'),
+}
+
+# 默认比例，接近营业时间的流量构成
+DEFAULT_MIX = 'customers=25,admin_stats=10,login=10,manager_customers=15,customer_profile=25,ai_unread=15'
+
+ROLES = ['admin', 'manager', 'customer']
+
+
+def parse_mix(value):
+    """解析 "customers=30,login=10" 形式的接口比例"""
+    mix = {}
+    for item in filter(None, (part.strip() for part in value.split(','))):
+        name, _, weight = item.partition('=')
+        name = name.strip()
+        if name not in ENDPOINTS:
+            raise ValueError(f'未知接口: {name}（可选: {", ".join(ENDPOINTS)}）')
+        mix[name] = float(weight or 1)
+    return mix
+
+
+def seed_database(database_url, customers, managers, admins=2, reseed=False, seed=42):
+    """在压测库中建表并批量写入压测账号和资料
+
+    所有账号共用一个预先计算的密码哈希，写入只需几秒；库中已有压测账号且未指定 reseed 时跳过。
+    只会连接 database_url 指定的库，不使用应用当前配置的数据库。
+
+    Returns:
+        是否重新写入了数据
+    """
+    from sqlalchemy import create_engine, func, select
+    from werkzeug.security import generate_password_hash
+    from app import db
+    from app.models import CustomerProfile, ManagerProfile, User
+
+    engine = create_engine(database_url)
+    users = User.__table__
+    is_loadtest_user = users.c.username.like(f'{USERNAME_PREFIX}%')
+    try:
+        if reseed:
+            db.metadata.drop_all(engine)
+        db.metadata.create_all(engine)
+        with engine.begin() as connection:
+            existing = connection.execute(select(func.count()).select_from(users).where(is_loadtest_user)).scalar()
+            if existing:
+                return False
+
+            rng = random.Random(seed)
+            password_hash = generate_password_hash(PASSWORD)
+            now = datetime.utcnow()
+            counts = {'admin': admins, 'manager': managers, 'customer': customers}
+            connection.execute(users.insert(), [
+                {'username': f'{USERNAME_PREFIX}{role}{i}', 'password_hash': password_hash,
+                 'name': f'压测{role}{i}', 'role': role, 'created_at': now}
+                for role in ROLES for i in range(1, counts[role] + 1)
+            ])
+            ids = {role: [] for role in ROLES}
+            for user_id, role in connection.execute(
+                    select(users.c.id, users.c.role).where(is_loadtest_user).order_by(users.c.id)):
+                ids[role].append(user_id)
+
+            manager_rows = []
+            for i, user_id in enumerate(ids['manager']):
+                manager_rows.append({
+                    'user_id': user_id, 'branch': BRANCHES[i % len(BRANCHES)],
+                    '_capabilities': json.dumps(rng.sample(FINANCIAL_NEEDS, rng.randint(3, 7))),
+                    '_hobbies': json.dumps(rng.sample(HOBBIES, rng.randint(2, 5))),
+                    'created_at': now, 'updated_at': now,
+                })
+            if manager_rows:
+                connection.execute(ManagerProfile.__table__.insert(), manager_rows)
+
+            # 约八成客户已分配给同网点的经理，使列表和统计接口有真实的数据量
+            by_branch = defaultdict(list)
+            for row in manager_rows:
+                by_branch[row['branch']].append(row['user_id'])
+            customer_rows = []
+            for user_id in ids['customer']:
+                branch = rng.choice(BRANCHES)
+                candidates = by_branch.get(branch)
+                customer_rows.append({
+                    'user_id': user_id, 'branch': branch,
+                    'age': rng.randint(25, 65), 'occupation': rng.choice(OCCUPATIONS),
+                    'total_assets': rng.randint(10000, 1000000) * 100,
+                    '_needs': json.dumps(rng.sample(FINANCIAL_NEEDS, rng.randint(2, 5))),
+                    '_hobbies': json.dumps(rng.sample(HOBBIES, rng.randint(3, 7))),
+                    'customer_class': rng.choice('ABCDE'),
+                    'manager_id': rng.choice(candidates) if candidates and rng.random() < 0.8 else None,
+                    'created_at': now, 'updated_at': now,
+                })
+            for start in range(0, len(customer_rows), 5000):
+                connection.execute(CustomerProfile.__table__.insert(), customer_rows[start:start + 5000])
+        return True
+    finally:
+        engine.dispose()
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+class GunicornServer:
+    """在子进程中用 gunicorn 启动应用，退出上下文时停止"""
+
+    def __init__(self, app_dir, database_url, workers=4, port=None, extra_env=None, startup_timeout=60):
+        self.app_dir = app_dir
+        self.port = port or _free_port()
+        self.base_url = f'http://127.0.0.1:{self.port}'
+        self.startup_timeout = startup_timeout
+        self.command = [sys.executable, '-m', 'gunicorn', f'--workers={workers}', f'--bind=127.0.0.1:{self.port}',
+                        '--timeout=120', '--log-level=warning', 'app:create_app()']
+        self.env = dict(os.environ, DATABASE_URL=database_url, **(extra_env or {}))
+        self.process = None
+
+    def __enter__(self):
+        self.process = subprocess.Popen(self.command, cwd=self.app_dir, env=self.env)
+        deadline = time.monotonic() + self.startup_timeout
+        while time.monotonic() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError(f'gunicorn 启动失败，退出码 {self.process.returncode}')
+            try:
+                with urllib.request.urlopen(f'{self.base_url}/api/health', timeout=1):
+                    return self
+            except OSError:
+                time.sleep(0.2)
+        self.__exit__(None, None, None)
+        raise RuntimeError(f'gunicorn 在{self.startup_timeout}秒内没有就绪')
+
+    def __exit__(self, *exc):
+        if self.process and self.process.poll() is None:
+            self.process.send_signal(signal.SIGTERM)
+            try:
+                self.process.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+
+
+def _request(base_url, method, path, token=None, body=None, timeout=30):
+    """发送一个请求，返回状态码（连接失败等异常返回0）"""
+    data = json.dumps(body).encode() if body is not None else None
+    request = urllib.request.Request(base_url + path, data=data, method=method)
+    if data is not None:
+        request.add_header('Content-Type', 'application/json')
+    if token:
+        request.add_header('Authorization', f'Bearer {token}')
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            response.read()
+            return response.status
+    except urllib.error.HTTPError as e:
+        e.read()
+        return e.code
+    except OSError:
+        return 0
+
+
+def login_pool(base_url, pool_size):
+    """为每种角色登录 pool_size 个压测账号
+
+    Returns:
+        {角色: [(用户ID, 用户名, 令牌), ...]}
+    """
+    sessions = {}
+    for role in ROLES:
+        sessions[role] = []
+        for i in range(1, pool_size + 1):
+            username = f'{USERNAME_PREFIX}{role}{i}'
+            request = urllib.request.Request(
+                f'{base_url}/api/auth/login', method='POST',
+                data=json.dumps({'username': username, 'password': PASSWORD}).encode(),
+                headers={'Content-Type': 'application/json'})
+            try:
+                with urllib.request.urlopen(request, timeout=30) as response:
+                    payload = json.loads(response.read())
+            except urllib.error.HTTPError:
+                # 该角色的账号数少于 pool_size
+                break
+            sessions[role].append((payload['user']['id'], username, payload['token']))
+    return sessions
+
+
+def percentile(sorted_values, q):
+    """最近秩法百分位数，输入需已排序"""
+    if not sorted_values:
+        return None
+    rank = max(1, int(-(-q * len(sorted_values) // 100)))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+def run_load(base_url, sessions, mix, rate, duration, concurrency=64, seed=42):
+    """按目标速率回放接口比例
+
+    Args:
+        sessions: login_pool 的结果
+        mix: {接口名称: 权重}
+        rate: 目标请求速率（每秒）
+        duration: 持续秒数
+
+    Returns:
+        {接口名称: [(延迟秒数, 状态码), ...]} 和实际耗时
+    """
+    rng = random.Random(seed)
+    names = [name for name in mix if ENDPOINTS[name][0] is None or sessions.get(ENDPOINTS[name][0])]
+    weights = [mix[name] for name in names]
+    if not names:
+        raise ValueError('接口比例中没有可用的接口（对应角色没有登录成功的账号）')
+
+    total = int(rate * duration)
+    plan = []
+    for i in range(total):
+        name = rng.choices(names, weights)[0]
+        role, method, path = ENDPOINTS[name]
+        if role is None:
+            # 登录接口随机使用任一角色的账号
+            _, username, _ = rng.choice(sessions[rng.choice([r for r in ROLES if sessions.get(r)])])
+            plan.append((i / rate, name, method, path, None, {'username': username, 'password': PASSWORD}))
+        else:
+            user_id, _, token = rng.choice(sessions[role])
+            plan.append((i / rate, name, method, path.format(user_id=user_id), token, None))
+
+    samples = defaultdict(list)
+    lock = threading.Lock()
+    started = time.perf_counter()
+
+    def fire(item):
+        offset, name, method, path, token, body = item
+        delay = started + offset - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        status = _request(base_url, method, path, token, body)
+        latency = time.perf_counter() - (started + offset)
+        with lock:
+            samples[name].append((latency, status))
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(fire, plan))
+    return samples, time.perf_counter() - started
+
+
+def summarize(samples, elapsed):
+    """每个接口的吞吐量、延迟百分位数（毫秒）和错误率；429 单独统计为限流"""
+    endpoints = {}
+    for name, rows in sorted(samples.items()):
+        latencies = sorted(latency * 1000 for latency, _ in rows)
+        errors = sum(1 for _, status in rows if status == 0 or (status >= 400 and status != 429))
+        throttled = sum(1 for _, status in rows if status == 429)
+        endpoints[name] = {
+            'requests': len(rows),
+            'throughput': round(len(rows) / elapsed, 2),
+            'p50_ms': round(percentile(latencies, 50), 1),
+            'p95_ms': round(percentile(latencies, 95), 1),
+            'p99_ms': round(percentile(latencies, 99), 1),
+            'max_ms': round(latencies[-1], 1),
+            'error_rate': round(errors / len(rows), 4),
+            'throttled_rate': round(throttled / len(rows), 4),
+        }
+    return endpoints
+
+
+def save_results(results, out_dir):
+    """把一次压测的配置和结果写入 out_dir/loadtest-<时间>.json，返回文件路径"""
+    os.makedirs(out_dir, exist_ok=True)
+    path = os.path.join(out_dir, f'loadtest-{datetime.utcnow().strftime("%Y%m%dT%H%M%S")}.json')
+    with open(path, 'w') as f:
+        json.dump(results, f, ensure_ascii=False, indent=2)
+    return path
+
+
+def compare_results(previous, current):
+    """两次压测中共同接口的 p50/p99 和吞吐量变化
+
+    Returns:
+        {接口名称: {'p50_ms': (之前, 现在), 'p99_ms': (...), 'throughput': (...)}}
+    """
+    rows = {}
+    for name, stats in current['endpoints'].items():
+        before = previous['endpoints'].get(name)
+        if before:
+            rows[name] = {key: (before[key], stats[key]) for key in ('p50_ms', 'p99_ms', 'throughput')}
+    return rows
@@ -0,0 +1,163 @@
+
+"""
+MinHash/LSH 候选生成
+标签词表增长到数千个时，客户×经理的全量重合计算不再可行。
+这里先为客户和经理的标签集合计算 MinHash 签名，再用 LSH 分段分桶，
+只有落入同一个桶的客户-经理对才按现有的需求/爱好规则精确打分。
+"""
+
+from functools import partial
+
+import numpy as np
+from scipy import sparse
+
+# 签名分块计算时每块最多处理的 (哈希数 × 非零元素) 数量，控制峰值内存
+_SIGNATURE_BLOCK = 50_000_000
+
+
+def minhash_signatures(sets, num_perm, seed=42):
+    """计算每行标签集合的 MinHash 签名
+
+    Args:
+        sets: CSR 格式的0/1矩阵，每行一个集合
+        num_perm: 哈希（随机排列）个数
+
+    Returns:
+        形状为 行数×num_perm 的 int32 签名矩阵；空集合的签名全部为列数
+    """
+    n_rows, n_cols = sets.shape
+    rng = np.random.default_rng(seed)
+    permutations = np.stack([rng.permutation(n_cols) for _ in range(num_perm)]).astype(np.int32)
+
+    signatures = np.full((n_rows, num_perm), n_cols, dtype=np.int32)
+    indptr, indices = sets.indptr, sets.indices
+    nnz_per_row = max(1, sets.nnz // max(n_rows, 1))
+    block_rows = max(1, _SIGNATURE_BLOCK // (num_perm * nnz_per_row))
+
+    for start in range(0, n_rows, block_rows):
+        stop = min(start + block_rows, n_rows)
+        lo, hi = indptr[start], indptr[stop]
+        if lo == hi:
+            continue
+        hashed = permutations[:, indices[lo:hi]]
+        offsets = indptr[start:stop] - lo
+        non_empty = np.diff(indptr[start:stop + 1]) > 0
+        minima = np.minimum.reduceat(hashed, offsets[non_empty], axis=1)
+        signatures[start:stop][non_empty] = minima.T
+    return signatures
+
+
+def _band_keys(signatures, bands, rows, seed):
+    """把每个分段的 rows 个签名值合成一个64位桶键"""
+    rng = np.random.default_rng(seed + 1)
+    coefficients = rng.integers(1, 2 ** 63, size=rows, dtype=np.uint64) | np.uint64(1)
+    keys = np.empty((len(signatures), bands), dtype=np.uint64)
+    with np.errstate(over='ignore'):
+        for b in range(bands):
+            block = signatures[:, b * rows:(b + 1) * rows].astype(np.uint64)
+            keys[:, b] = (block * coefficients).sum(axis=1, dtype=np.uint64)
+    return keys
+
+
+def lsh_candidate_pairs(customer_sets, manager_sets, bands, rows, seed=42):
+    """用 LSH 分段分桶找出候选客户-经理对
+
+    Returns:
+        (客户行号数组, 经理行号数组)，按 (客户, 经理) 升序且去重
+    """
+    num_perm = bands * rows
+    customer_keys = _band_keys(minhash_signatures(customer_sets, num_perm, seed), bands, rows, seed)
+    manager_keys = _band_keys(minhash_signatures(manager_sets, num_perm, seed), bands, rows, seed)
+
+    n_managers = manager_sets.shape[0]
+    pair_ids = []
+    for b in range(bands):
+        order = np.argsort(manager_keys[:, b], kind='stable')
+        sorted_keys = manager_keys[order, b]
+        left = np.searchsorted(sorted_keys, customer_keys[:, b], side='left')
+        right = np.searchsorted(sorted_keys, customer_keys[:, b], side='right')
+        counts = right - left
+        if not counts.any():
+            continue
+        customers = np.repeat(np.arange(len(counts)), counts)
+        # 每个客户在排序后经理数组中的连续区间 [left, right)
+        starts = np.repeat(left - np.concatenate([[0], np.cumsum(counts)[:-1]]), counts)
+        managers = order[starts + np.arange(counts.sum())]
+        pair_ids.append(customers.astype(np.int64) * n_managers + managers)
+
+    if not pair_ids:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    pair_ids = np.unique(np.concatenate(pair_ids))
+    return pair_ids // n_managers, pair_ids % n_managers
+
+
+def _pair_overlaps(customer_matrix, manager_matrix, customer_index, manager_index, block=1_000_000):
+    """逐对计算集合交集大小（稀疏行逐元素相乘）"""
+    overlaps = np.empty(len(customer_index), dtype=np.int32)
+    for start in range(0, len(customer_index), block):
+        stop = start + block
+        product = customer_matrix[customer_index[start:stop]].multiply(manager_matrix[manager_index[start:stop]])
+        overlaps[start:stop] = np.asarray(product.sum(axis=1)).ravel()
+    return overlaps
+
+
+def lsh_best_matches(customer_needs, customer_hobbies, manager_capabilities, manager_hobbies,
+                     bands=32, rows=2, seed=42, fallback=True, stats=None):
+    """best_manager_matches 的近似版本：只对 LSH 候选对精确打分
+
+    候选对的需求/爱好重合数按现有规则精确计算，在候选中取总分最高者，
+    并列时取行号最小的经理（与精确版本的决胜规则相同）。
+
+    Args:
+        bands, rows: LSH 分段数和每段的签名行数，签名长度为两者之积
+        fallback: 没有任何候选的客户是否退回到与全部经理精确比较
+        stats: 可选字典，写入候选对数量等统计信息
+
+    Returns:
+        (最佳经理行号, 需求匹配数, 爱好匹配数)
+    """
+    n_customers = len(customer_needs)
+    customer_needs = sparse.csr_matrix(np.asarray(customer_needs, dtype=np.uint8))
+    customer_hobbies = sparse.csr_matrix(np.asarray(customer_hobbies, dtype=np.uint8))
+    manager_capabilities = sparse.csr_matrix(np.asarray(manager_capabilities, dtype=np.uint8))
+    manager_hobbies = sparse.csr_matrix(np.asarray(manager_hobbies, dtype=np.uint8))
+
+    customer_index, manager_index = lsh_candidate_pairs(
+        sparse.hstack([customer_needs, customer_hobbies], format='csr'),
+        sparse.hstack([manager_capabilities, manager_hobbies], format='csr'),
+        bands, rows, seed)
+
+    needs = _pair_overlaps(customer_needs, manager_capabilities, customer_index, manager_index)
+    hobbies = _pair_overlaps(customer_hobbies, manager_hobbies, customer_index, manager_index)
+
+    # 每个客户取总分最高、经理行号最小的候选
+    order = np.lexsort((manager_index, -(needs + hobbies), customer_index))
+    first = order[np.r_[True, customer_index[order][1:] != customer_index[order][:-1]]] if len(order) else order
+
+    best = np.zeros(n_customers, dtype=np.int64)
+    needs_match = np.zeros(n_customers, dtype=np.int32)
+    hobbies_match = np.zeros(n_customers, dtype=np.int32)
+    best[customer_index[first]] = manager_index[first]
+    needs_match[customer_index[first]] = needs[first]
+    hobbies_match[customer_index[first]] = hobbies[first]
+
+    missing = np.setdiff1d(np.arange(n_customers), customer_index[first])
+    if fallback and len(missing):
+        from app.utils.clustering import best_manager_matches
+        best[missing], needs_match[missing], hobbies_match[missing] = best_manager_matches(
+            customer_needs[missing].toarray(), customer_hobbies[missing].toarray(),
+            manager_capabilities.toarray(), manager_hobbies.toarray())
+
+    if stats is not None:
+        stats.update({
+            'candidate_pairs': int(len(customer_index)),
+            'pair_fraction': len(customer_index) / max(n_customers * manager_capabilities.shape[0], 1),
+            'customers_without_candidates': int(len(missing)),
+        })
+    return best, needs_match, hobbies_match
+
+
+def lsh_kernel(setting):
+    """由 "分段数x每段行数" 形式的配置（如 "32x2"）构造可传给 classify_customers 的打分函数"""
+    bands, rows = (int(x) for x in setting.lower().split('x'))
+    return partial(lsh_best_matches, bands=bands, rows=rows)
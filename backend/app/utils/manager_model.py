@@ -0,0 +1,164 @@
+
+"""
+跨 gunicorn worker 共享的经理模型
+经理的能力/爱好矩阵和当前负载发布为带版本号的内存映射文件，
+所有 worker 以只读 mmap 方式挂载同一份数据（共享页缓存，内存不随 worker 数增长）。
+经理资料或分配关系变化时发布新版本，读者在下一次访问时无锁切换。
+"""
+
+from datetime import datetime
+
+import numpy as np
+
+from app.utils.snapshot import (
+    SnapshotError, current_version_name, decode_manager_rows, manager_loads,
+    manager_rows_query, open_version, tag_matrix, write_version
+)
+
+MODEL_ARRAYS = ['manager_ids', 'manager_capabilities', 'manager_hobbies', 'manager_loads']
+
+# 当前进程已挂载的模型，替换引用本身是原子的，读者无需加锁
+_attached = None
+
+
+class ManagerModel:
+    """一个已挂载的经理模型版本（只读）"""
+
+    def __init__(self, model_dir, version_name, manifest, arrays):
+        self.model_dir = model_dir
+        self.version_name = version_name
+        self.version = manifest['version']
+        self.published_at = manifest['published_at']
+        self.tags = manifest['tags']
+        self.tag_index = {tag: j for j, tag in enumerate(self.tags)}
+        for name, array in arrays.items():
+            setattr(self, name, array)
+
+    @property
+    def manager_count(self):
+        return len(self.manager_ids)
+
+    def index_of(self, manager_id):
+        """返回经理在模型中的行号，不存在时返回None"""
+        i = int(np.searchsorted(self.manager_ids, manager_id))
+        if i < len(self.manager_ids) and self.manager_ids[i] == manager_id:
+            return i
+        return None
+
+    def encode(self, tags):
+        """把标签列表编码为与模型列顺序一致的0/1向量，模型中没有的标签不影响匹配"""
+        return tag_matrix([tags], self.tag_index)[0]
+
+    def score(self, needs, hobbies):
+        """计算一个客户与所有经理的重合数，O(M)向量运算
+
+        Returns:
+            (需求匹配数数组, 爱好匹配数数组)
+        """
+        needs_match = self.manager_capabilities @ self.encode(needs).astype(np.int32)
+        hobbies_match = self.manager_hobbies @ self.encode(hobbies).astype(np.int32)
+        return needs_match, hobbies_match
+
+    def score_many(self, needs_lists, hobbies_lists):
+        """计算一批客户与所有经理的重合数
+
+        Returns:
+            (需求匹配数矩阵, 爱好匹配数矩阵)，形状均为 客户数×经理数
+        """
+        needs = tag_matrix(needs_lists, self.tag_index).astype(np.int32)
+        hobbies = tag_matrix(hobbies_lists, self.tag_index).astype(np.int32)
+        return needs @ self.manager_capabilities.T, hobbies @ self.manager_hobbies.T
+
+    def __repr__(self):
+        return f'<ManagerModel v{self.version} {self.manager_count} managers>'
+
+
+def default_model_dir():
+    """当前应用配置的经理模型目录"""
+    from flask import current_app
+    return current_app.config['MATCH_MANAGER_MODEL_DIR']
+
+
+def load_manager_arrays():
+    """从数据库读取所有经理，编码为模型数组
+
+    Returns:
+        (标签列表, 数组字典)
+    """
+    managers = decode_manager_rows(manager_rows_query().all())
+
+    # 词表只需要经理一侧的标签，客户独有的标签不会产生重合
+    all_tags = set()
+    for _, capabilities, hobbies, _ in managers.values():
+        all_tags.update(capabilities)
+        all_tags.update(hobbies)
+    tags = sorted(all_tags)
+    tag_index = {tag: j for j, tag in enumerate(tags)}
+
+    manager_ids = sorted(managers)
+    rows = [managers[m] for m in manager_ids]
+    arrays = {
+        'manager_ids': np.array(manager_ids, dtype=np.int64),
+        'manager_capabilities': tag_matrix([r[1] for r in rows], tag_index),
+        'manager_hobbies': tag_matrix([r[2] for r in rows], tag_index),
+        'manager_loads': manager_loads(manager_ids),
+    }
+    return tags, arrays
+
+
+def build_manager_model():
+    """在当前进程内构造一个不发布的经理模型，供离线任务使用"""
+    tags, arrays = load_manager_arrays()
+    manifest = {'version': 0, 'published_at': datetime.utcnow().isoformat(), 'tags': tags}
+    return ManagerModel(None, None, manifest, arrays)
+
+
+def publish_manager_model(model_dir=None):
+    """从数据库读取所有经理并发布新版本
+
+    Returns:
+        新版本号
+    """
+    model_dir = model_dir or default_model_dir()
+    tags, arrays = load_manager_arrays()
+    manifest = {'published_at': datetime.utcnow().isoformat(), 'tags': tags}
+    return write_version(model_dir, arrays, manifest)
+
+
+def notify_managers_changed():
+    """经理资料或分配关系提交后调用，发布失败只记录日志，不影响请求本身"""
+    from flask import current_app
+    try:
+        publish_manager_model()
+    except Exception as e:
+        current_app.logger.warning(f"发布经理模型失败: {str(e)}")
+
+
+def get_manager_model(model_dir=None):
+    """返回最新版本的经理模型
+
+    每次调用只读取一次 CURRENT 指针；版本未变化时直接返回已挂载的模型，
+    变化时挂载新版本。目录中还没有任何版本时先发布一次。
+    """
+    global _attached
+    model_dir = model_dir or default_model_dir()
+
+    for _ in range(3):
+        version_name = current_version_name(model_dir)
+        if version_name is None:
+            publish_manager_model(model_dir)
+            continue
+
+        model = _attached
+        if model is not None and model.model_dir == model_dir and model.version_name == version_name:
+            return model
+
+        try:
+            _, manifest, arrays = open_version(model_dir, MODEL_ARRAYS, version_name)
+        except FileNotFoundError:
+            # 指针读取之后该版本已被清理，重新读取指针
+            continue
+        _attached = ManagerModel(model_dir, version_name, manifest, arrays)
+        return _attached
+
+    raise SnapshotError(f'无法挂载经理模型: {model_dir}')
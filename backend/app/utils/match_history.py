@@ -0,0 +1,251 @@
+
+"""
+匹配历史的写入、分页查询、按天汇总和归档
+所有写 MatchHistory 的地方都通过 record_matches，在同一个事务里累加 MatchDailyStat，
+因此汇总表始终与原始记录一致；归档任务把过期的原始记录分批写入本地 gzip 文件后删除，汇总表保留。
+"""
+
+import gzip
+import json
+import os
+import re
+from collections import defaultdict
+from datetime import datetime, time, timedelta
+
+from sqlalchemy import func
+from sqlalchemy.orm import joinedload
+
+from app import db
+from app.models import MatchDailyStat, MatchHistory
+from app.utils.counters import increment_counters
+from app.utils.pagination import keyset_page
+
+# 归档文件名：match_history_<截止日期>_<归档时间>.jsonl.gz
+ARCHIVE_NAME = re.compile(r'^match_history_(\d{8})_\d{14}\.jsonl\.gz$')
+
+
+def default_archive_dir():
+    """当前应用配置的归档目录"""
+    from flask import current_app
+    return current_app.config['MATCH_HISTORY_ARCHIVE_DIR']
+
+
+def record_matches(matches, created_by, created_at=None):
+    """写入匹配历史并同步累加按天汇总（不提交）
+
+    Args:
+        matches: (客户ID, 经理ID, 需求匹配数, 爱好匹配数) 的可迭代对象
+        created_by: 操作人ID
+        created_at: 记录时间，默认为当前时间
+
+    Returns:
+        写入的记录数
+    """
+    created_at = created_at or datetime.utcnow()
+    day = created_at.date()
+    groups = defaultdict(lambda: [0, 0.0])
+    records = []
+    for customer_id, manager_id, needs_match, hobbies_match in matches:
+        score = int(needs_match) + int(hobbies_match)
+        records.append(MatchHistory(
+            customer_id=int(customer_id),
+            manager_id=int(manager_id),
+            match_score=score,
+            needs_match=int(needs_match),
+            hobbies_match=int(hobbies_match),
+            created_by=created_by,
+            created_at=created_at
+        ))
+        group = groups[(day, int(manager_id))]
+        group[0] += 1
+        group[1] += score
+
+    db.session.add_all(records)
+    increment_counters(MatchDailyStat, ['day', 'manager_id'], [
+        {'day': day, 'manager_id': manager_id, 'match_count': count, 'score_sum': score_sum}
+        for (day, manager_id), (count, score_sum) in groups.items()
+    ])
+    return len(records)
+
+
+def record_assignments(assignments, created_by):
+    """为自动分配的结果写入匹配历史（不提交）
+
+    分数优先从分数缓存读取，缓存中没有的客户-经理对再加载资料计算。
+
+    Args:
+        assignments: {客户ID: 经理ID}
+
+    Returns:
+        写入的记录数
+    """
+    from app.models import CustomerProfile, ManagerProfile
+    from app.utils.clustering import compute_similarity_score
+    from app.utils.score_cache import lookup_scores
+
+    cached_scores = lookup_scores(assignments.items())
+    matches = []
+    for customer_id, manager_id in assignments.items():
+        similarity = cached_scores.get((customer_id, manager_id))
+        if similarity is None:
+            customer_profile = CustomerProfile.query.filter_by(user_id=customer_id).first()
+            manager_profile = ManagerProfile.query.filter_by(user_id=manager_id).first()
+            if customer_profile and manager_profile:
+                similarity = compute_similarity_score(
+                    customer_profile.needs, customer_profile.hobbies,
+                    manager_profile.capabilities, manager_profile.hobbies
+                )
+        if similarity:
+            matches.append((customer_id, manager_id, similarity['needs_match'], similarity['hobbies_match']))
+
+    return record_matches(matches, created_by)
+
+
+def history_page(limit=50, cursor=None, manager_id=None, customer_id=None, query=None):
+    """按 (created_at, id) 倒序键集分页读取匹配历史
+
+    默认返回 ORM 实例，客户和经理通过 joinedload 在同一条查询中加载，to_dict 不再逐行懒加载；
+    也可以传入只选取所需列的查询（结果行需要带 created_at 和 id 两列）。
+
+    Returns:
+        (记录列表, 下一页游标)；没有下一页时游标为None
+    """
+    if query is None:
+        query = MatchHistory.query.options(
+            joinedload(MatchHistory.customer), joinedload(MatchHistory.manager))
+    if manager_id is not None:
+        query = query.filter(MatchHistory.manager_id == manager_id)
+    if customer_id is not None:
+        query = query.filter(MatchHistory.customer_id == customer_id)
+    return keyset_page(query, MatchHistory.created_at, MatchHistory.id, limit=limit, cursor=cursor)
+
+
+def daily_stats(manager_id=None, start=None, end=None):
+    """读取按天汇总，start/end 为闭区间日期"""
+    query = MatchDailyStat.query
+    if manager_id is not None:
+        query = query.filter(MatchDailyStat.manager_id == manager_id)
+    if start is not None:
+        query = query.filter(MatchDailyStat.day >= start)
+    if end is not None:
+        query = query.filter(MatchDailyStat.day <= end)
+    return query.order_by(MatchDailyStat.day, MatchDailyStat.manager_id).all()
+
+
+def total_match_count():
+    """匹配总数，以按天汇总为准（已归档的记录仍计入）
+
+    汇总表上线前写入、还没有用 flask history rollup 补齐的历史不在汇总中：汇总最早一天之前的按原始记录计数，
+    最早一天（上线当天，汇总只含上线后的记录）取汇总与原始记录数中较大者。两次计数都是 created_at 上的范围查询。
+    """
+    summarized = db.session.query(func.coalesce(func.sum(MatchDailyStat.match_count), 0)).scalar()
+    first_day = db.session.query(func.min(MatchDailyStat.day)).scalar()
+    if first_day is None:
+        return db.session.query(func.count(MatchHistory.id)).scalar()
+    if isinstance(first_day, str):
+        first_day = datetime.strptime(first_day, '%Y-%m-%d').date()
+
+    start = datetime.combine(first_day, time.min)
+    end = start + timedelta(days=1)
+    before = db.session.query(func.count(MatchHistory.id)).filter(MatchHistory.created_at < start).scalar()
+    first_raw = db.session.query(func.count(MatchHistory.id)) \
+        .filter(MatchHistory.created_at >= start, MatchHistory.created_at < end).scalar()
+    first_summarized = db.session.query(func.coalesce(func.sum(MatchDailyStat.match_count), 0)) \
+        .filter(MatchDailyStat.day == first_day).scalar()
+    return int(summarized) + before + max(first_raw - int(first_summarized), 0)
+
+
+def archived_through(archive_dir=None):
+    """归档文件覆盖到的最晚日期（由文件名中的截止时间得出，该日的原始记录可能只归档了一部分）
+
+    Returns:
+        日期；没有归档文件时返回None
+    """
+    archive_dir = archive_dir or default_archive_dir()
+    if not os.path.isdir(archive_dir):
+        return None
+    days = [datetime.strptime(match.group(1), '%Y%m%d').date()
+            for match in map(ARCHIVE_NAME.match, os.listdir(archive_dir)) if match]
+    return max(days, default=None)
+
+
+def rebuild_daily_stats(archive_dir=None, force=False):
+    """由现存的原始记录按天重建汇总表（用于上线前已有的历史数据）
+
+    只删除并重建仍有原始记录的日期，没有原始记录的日期（如已归档）保留原汇总。
+    存在归档文件时，截止日及之前的日期原始记录可能不完整，默认跳过；force 为真时一并重建。
+
+    Returns:
+        (写入的汇总行数, 跳过的截止日期)；没有跳过时日期为None
+    """
+    skipped_through = None if force else archived_through(archive_dir)
+    day = func.date(MatchHistory.created_at)
+    query = db.session.query(day, MatchHistory.manager_id, func.count(MatchHistory.id), func.sum(MatchHistory.match_score))
+    if skipped_through is not None:
+        query = query.filter(MatchHistory.created_at >= datetime.combine(skipped_through + timedelta(days=1), time.min))
+    rows = [(d if not isinstance(d, str) else datetime.strptime(d, '%Y-%m-%d').date(), manager_id, count, score_sum)
+            for d, manager_id, count, score_sum in query.group_by(day, MatchHistory.manager_id).all()]
+
+    days = sorted({d for d, _, _, _ in rows})
+    if days:
+        MatchDailyStat.query.filter(MatchDailyStat.day.in_(days)).delete(synchronize_session=False)
+    db.session.bulk_insert_mappings(MatchDailyStat, [
+        {'day': d, 'manager_id': manager_id, 'match_count': count, 'score_sum': float(score_sum or 0)}
+        for d, manager_id, count, score_sum in rows
+    ])
+    db.session.commit()
+    return len(rows), skipped_through
+
+
+def _archive_row(row):
+    return {
+        'id': row.id,
+        'customer_id': row.customer_id,
+        'manager_id': row.manager_id,
+        'match_score': row.match_score,
+        'needs_match': row.needs_match,
+        'hobbies_match': row.hobbies_match,
+        'created_by': row.created_by,
+        'created_at': row.created_at.isoformat(),
+    }
+
+
+def archive_match_history(days, archive_dir=None, batch_size=5000, echo=None):
+    """把 days 天前的原始匹配历史分批归档到 gzip 压缩的 JSON Lines 文件并删除
+
+    每批先追加写入文件（一个独立的 gzip 成员）并落盘，再删除并提交，
+    中途失败最多导致该批在归档文件中重复出现（可按 id 去重），不会丢失记录。
+
+    Returns:
+        (归档的记录数, 归档文件路径)；没有需要归档的记录时路径为None
+    """
+    archive_dir = archive_dir or default_archive_dir()
+    cutoff = datetime.utcnow() - timedelta(days=days)
+    echo = echo or (lambda message: None)
+
+    path = None
+    archived = 0
+    while True:
+        rows = MatchHistory.query.filter(MatchHistory.created_at < cutoff) \
+            .order_by(MatchHistory.created_at, MatchHistory.id).limit(batch_size).all()
+        if not rows:
+            break
+
+        if path is None:
+            os.makedirs(archive_dir, exist_ok=True)
+            path = os.path.join(archive_dir, f"match_history_{cutoff:%Y%m%d}_{datetime.utcnow():%Y%m%d%H%M%S}.jsonl.gz")
+        with open(path, 'ab') as f:
+            with gzip.GzipFile(fileobj=f, mode='wb') as gz:
+                for row in rows:
+                    gz.write((json.dumps(_archive_row(row), ensure_ascii=False) + '\n').encode('utf-8'))
+            f.flush()
+            os.fsync(f.fileno())
+
+        last_created_at = rows[-1].created_at
+        MatchHistory.query.filter(MatchHistory.id.in_([row.id for row in rows])).delete(synchronize_session=False)
+        db.session.commit()
+        db.session.expunge_all()
+
+        archived += len(rows)
+        echo(f'已归档{archived}条 (至 {last_created_at.isoformat()})')
+    return archived, path
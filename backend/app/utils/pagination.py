@@ -0,0 +1,52 @@
+
+"""
+键集分页
+按 (时间, id) 倒序翻页，游标是上一页最后一行的 (时间, id) 编码成的不透明字符串，
+翻页只需在索引上定位，不随页码增长而变慢。
+"""
+
+import base64
+from datetime import datetime
+
+from sqlalchemy import and_, or_
+
+# 单页最多返回的记录数
+MAX_PAGE_SIZE = 200
+
+
+def encode_cursor(timestamp, row_id):
+    raw = f'{timestamp.isoformat()}|{row_id}'.encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """解析分页游标，格式错误时抛出 ValueError"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode()
+        timestamp, row_id = raw.split('|')
+        return datetime.fromisoformat(timestamp), int(row_id)
+    except Exception:
+        raise ValueError('无效的分页游标')
+
+
+def keyset_page(query, time_column, id_column, limit=50, cursor=None):
+    """对已过滤的查询按 (时间, id) 倒序取一页
+
+    Returns:
+        (记录列表, 下一页游标)；没有下一页时游标为None
+    """
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+    if cursor:
+        timestamp, row_id = decode_cursor(cursor)
+        query = query.filter(or_(
+            time_column < timestamp,
+            and_(time_column == timestamp, id_column < row_id)
+        ))
+
+    rows = query.order_by(time_column.desc(), id_column.desc()).limit(limit + 1).all()
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        last = rows[-1]
+        next_cursor = encode_cursor(getattr(last, time_column.key), getattr(last, id_column.key))
+    return rows, next_cursor
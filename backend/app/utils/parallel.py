@@ -0,0 +1,104 @@
+
+"""
+多进程分片打分
+把客户矩阵切成若干分片，在进程池中与只读的经理矩阵计算最佳匹配。
+输入和输出矩阵都放在 multiprocessing.shared_memory 中，子进程只收到分片的起止行号，
+不需要序列化任何数组；每个分片写入互不重叠的输出区间，合并结果与串行计算完全一致。
+"""
+
+import os
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+
+# 输出数组：最佳经理行号、需求匹配数、爱好匹配数
+OUTPUTS = [('best', np.int64), ('needs_match', np.int32), ('hobbies_match', np.int32)]
+
+# 子进程中挂载的共享数组
+_shared = {}
+_handles = []
+
+
+def _to_shared(array):
+    """把数组复制到新的共享内存块，返回 (共享内存, 描述信息)"""
+    array = np.ascontiguousarray(array)
+    shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)[...] = array
+    return shm, (shm.name, array.shape, array.dtype.str)
+
+
+def _empty_shared(shape, dtype):
+    dtype = np.dtype(dtype)
+    shm = shared_memory.SharedMemory(create=True, size=max(int(np.prod(shape)) * dtype.itemsize, 1))
+    return shm, (shm.name, shape, dtype.str)
+
+
+def _attach(specs):
+    """进程池初始化：按名称挂载所有共享数组"""
+    for name, (shm_name, shape, dtype) in specs.items():
+        shm = shared_memory.SharedMemory(name=shm_name)
+        _handles.append(shm)
+        _shared[name] = np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf)
+
+
+def _score_shard(bounds):
+    from app.utils.engine import best_manager_matches
+
+    start, stop = bounds
+    best, needs_match, hobbies_match = best_manager_matches(
+        _shared['customer_needs'][start:stop], _shared['customer_hobbies'][start:stop],
+        _shared['manager_capabilities'], _shared['manager_hobbies']
+    )
+    _shared['best'][start:stop] = best
+    _shared['needs_match'][start:stop] = needs_match
+    _shared['hobbies_match'][start:stop] = hobbies_match
+    return bounds
+
+
+def shard_bounds(total, workers, shard_size=None):
+    """把 [0, total) 切成分片，默认每个 worker 分到约4个分片以平衡负载"""
+    shard_size = shard_size or max(1, -(-total // (workers * 4)))
+    return [(start, min(start + shard_size, total)) for start in range(0, total, shard_size)]
+
+
+def parallel_best_matches(customer_needs, customer_hobbies, manager_capabilities, manager_hobbies,
+                          workers=None, shard_size=None):
+    """best_manager_matches 的多进程版本，返回值与串行版本逐元素相同
+
+    Args:
+        workers: 进程数，默认为CPU核数
+        shard_size: 每个分片的客户数，默认自动计算
+
+    Returns:
+        (最佳经理行号, 需求匹配数, 爱好匹配数)
+    """
+    workers = workers or os.cpu_count() or 1
+    total = len(customer_needs)
+
+    blocks = {}
+    specs = {}
+    try:
+        inputs = {
+            'customer_needs': customer_needs,
+            'customer_hobbies': customer_hobbies,
+            'manager_capabilities': manager_capabilities,
+            'manager_hobbies': manager_hobbies,
+        }
+        for name, array in inputs.items():
+            blocks[name], specs[name] = _to_shared(array)
+        for name, dtype in OUTPUTS:
+            blocks[name], specs[name] = _empty_shared((total,), dtype)
+
+        with ProcessPoolExecutor(max_workers=workers, initializer=_attach, initargs=(specs,)) as pool:
+            # 等待全部分片完成；任何分片失败都会在这里抛出
+            list(pool.map(_score_shard, shard_bounds(total, workers, shard_size)))
+
+        return tuple(
+            np.ndarray((total,), dtype=dtype, buffer=blocks[name].buf).copy()
+            for name, dtype in OUTPUTS
+        )
+    finally:
+        for shm in blocks.values():
+            shm.close()
+            shm.unlink()
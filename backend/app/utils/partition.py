@@ -0,0 +1,114 @@
+
+"""
+按网点分区的分类与分配
+客户和经理都属于某个网点，分配从不跨网点，因此每个网点是一个独立的匹配问题：
+只在网点内打分（客户×经理对数约为全局的 1/网点数），经理负载按网点分别统计，每个网点单独提交。
+全量执行时各网点在线程池中并发运行，每个线程有自己的应用上下文和数据库会话；
+每个网点还各自持有单飞锁 match:<网点>，可以单独重跑某一个网点；网点锁与全量锁 match 互斥，
+单独重跑网点时全量的 match run、自动分配等不能同时执行，反之亦然。
+"""
+
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from app import db
+from app.models import CustomerProfile, ManagerProfile
+from app.utils.events import report_progress
+from app.utils.single_flight import MATCH_OPERATION, OperationBusy, current_run, run_exclusive
+from app.utils.snapshot import UNASSIGNED_BRANCH
+
+
+def list_branches():
+    """客户或经理资料中出现过的全部网点，未设置网点的资料记为 UNASSIGNED_BRANCH"""
+    branches = set()
+    for model in (CustomerProfile, ManagerProfile):
+        branches.update(branch or UNASSIGNED_BRANCH for (branch,) in db.session.query(model.branch).distinct())
+    return sorted(branches)
+
+
+def operation_name(branch):
+    """单个网点的单飞锁名称（全量执行仍使用 MATCH_OPERATION）"""
+    return f'{MATCH_OPERATION}:{branch}'
+
+
+def match_branch(branch, created_by, workers=1, kernel=None):
+    """对一个网点执行分类、分配并记录匹配历史，单独提交
+
+    Args:
+        branch: 网点，UNASSIGNED_BRANCH 表示未设置网点的资料
+        created_by: 匹配历史的操作人ID
+        workers, kernel: 分类打分方式，见 classify_customers
+
+    Returns:
+        该网点的结果摘要
+    """
+    from app.utils.clustering import auto_assign_customers, classify_customers
+    from app.utils.match_history import record_assignments
+    from app.utils.snapshot import snapshot_from_database
+
+    started = time.perf_counter()
+    snapshot = snapshot_from_database(branch)
+    classification = classify_customers(snapshot=snapshot, workers=workers, kernel=kernel)
+    assignments = auto_assign_customers(classification=classification, branch=branch)
+    recorded_matches = record_assignments(assignments, created_by)
+    db.session.commit()
+
+    return {
+        'branch': branch,
+        'customer_count': snapshot.customer_count,
+        'manager_count': snapshot.manager_count,
+        'pair_count': snapshot.customer_count * snapshot.manager_count,
+        'assigned_count': len(assignments),
+        'recorded_matches': recorded_matches,
+        'seconds': round(time.perf_counter() - started, 3),
+    }
+
+
+def run_partitions(app, created_by, branches=None, parallel=4, workers=1, kernel=None):
+    """并发执行多个网点（默认全部网点）
+
+    每个网点在独立线程中持有自己的单飞锁执行并单独提交：某个网点失败或正在被单独重跑时
+    只记录在 failed 中，不影响其他网点已经提交的结果。
+
+    Args:
+        app: Flask 应用，工作线程在它的应用上下文中执行
+        parallel: 同时执行的网点数
+
+    Returns:
+        {'branches': {网点: 结果摘要}, 'failed': {网点: 错误}, 以及各网点合计的 assigned_count、
+        recorded_matches、pair_count}
+    """
+    if branches is None:
+        branches = list_branches()
+    # 在全量锁下执行时，各网点的网点锁不与这次全量执行互斥
+    parent = current_run()
+    parent_run_id = parent[1] if parent is not None and parent[0] == MATCH_OPERATION else None
+
+    def run_one(branch):
+        with app.app_context():
+            _, result = run_exclusive(operation_name(branch),
+                                      lambda: match_branch(branch, created_by, workers=workers, kernel=kernel),
+                                      started_by=created_by, parent_run_id=parent_run_id)
+            return result
+
+    results = {}
+    failed = {}
+    with ThreadPoolExecutor(max_workers=max(1, min(parallel, len(branches)))) as pool:
+        futures = {branch: pool.submit(run_one, branch) for branch in branches}
+        for branch, future in futures.items():
+            try:
+                results[branch] = future.result()
+            except OperationBusy as busy:
+                failed[branch] = f'该网点或全量分类/分配正在执行 (run {busy.run_id})'
+            except Exception as e:
+                app.logger.error(f"网点{branch or '(未设置)'}分配失败: {str(e)}")
+                failed[branch] = str(e)
+            report_progress('branches', len(results) + len(failed), len(branches))
+
+    return {
+        'branches': results,
+        'failed': failed,
+        'assigned_count': sum(r['assigned_count'] for r in results.values()),
+        'recorded_matches': sum(r['recorded_matches'] for r in results.values()),
+        'pair_count': sum(r['pair_count'] for r in results.values()),
+    }
@@ -0,0 +1,220 @@
+
+"""
+按需性能剖析
+单个请求或批处理在 cProfile 和 tracemalloc 下运行，结束后把 pstats 文件和摘要
+（累计耗时最高的函数、分配最多的代码行、峰值内存）写入 PROFILE_DIR，返回剖析ID供之后读取。
+- 请求：管理员带 X-Profile: 1 请求头时剖析该请求，响应头 X-Profile-Id 返回ID；
+  PROFILE_SAMPLE_RATE 大于0时按该比例随机剖析 /api 请求（生产环境抽样）
+- 批处理：flask match 的批处理命令加 --profile
+PROFILE_REQUESTS 关闭且不抽样时不注册请求钩子，没有任何额外开销。
+cProfile 只记录当前线程，MATCH_WORKERS 大于1时子进程中的打分不在剖析结果中；
+tracemalloc 是进程级的，同一进程中并发请求的分配也会被计入。同一进程同时只剖析一个任务，其余的直接跳过。
+"""
+
+import cProfile
+import json
+import os
+import pstats
+import random
+import re
+import secrets
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from datetime import datetime
+
+PROFILE_HEADER = 'X-Profile'
+PROFILE_ID_HEADER = 'X-Profile-Id'
+
+# 摘要中保留的函数和分配位置数
+TOP_FUNCTIONS = 40
+TOP_ALLOCATIONS = 25
+
+# 目录中最多保留的剖析数，超出时删除最旧的
+MAX_PROFILES = 200
+
+_PROFILE_ID = re.compile(r'^\d{8}T\d{6}-[0-9a-f]{6}$')
+_active = threading.Lock()
+
+
+class Profile:
+    """一次剖析的结果，run() 结束后 profile_id 和 summary 才有值"""
+
+    def __init__(self, label):
+        self.label = label
+        self.profile_id = None
+        self.summary = None
+
+
+def _top_functions(profiler):
+    stats = pstats.Stats(profiler)
+    rows = []
+    for (filename, line, name), (_, calls, total, cumulative, _) in stats.stats.items():
+        rows.append({'function': f'{filename}:{line}({name})', 'calls': calls,
+                     'total_seconds': round(total, 6), 'cumulative_seconds': round(cumulative, 6)})
+    rows.sort(key=lambda row: row['cumulative_seconds'], reverse=True)
+    return rows[:TOP_FUNCTIONS]
+
+
+def _top_allocations(snapshot):
+    snapshot = snapshot.filter_traces([
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, __file__),
+    ])
+    return [
+        {'location': f'{stat.traceback[0].filename}:{stat.traceback[0].lineno}',
+         'size_kb': round(stat.size / 1024, 1), 'count': stat.count}
+        for stat in snapshot.statistics('lineno')[:TOP_ALLOCATIONS]
+    ]
+
+
+def _prune(profile_dir):
+    summaries = sorted(name for name in os.listdir(profile_dir) if name.endswith('.json'))
+    for name in summaries[:max(0, len(summaries) - MAX_PROFILES)]:
+        for suffix in ('.json', '.prof'):
+            try:
+                os.remove(os.path.join(profile_dir, name[:-len('.json')] + suffix))
+            except FileNotFoundError:
+                pass
+
+
+@contextmanager
+def profiled(profile_dir, label, **metadata):
+    """在 cProfile 和 tracemalloc 下执行 with 块，结束时（包括异常）写入剖析文件
+
+    已有其他剖析在进行时不剖析，yield 的 Profile 的 profile_id 保持为 None。
+
+    Args:
+        label: 剖析对象，如 "POST /api/admin/auto-assign" 或 "flask match run"
+        metadata: 额外写入摘要的字段
+    """
+    profile = Profile(label)
+    if not _active.acquire(blocking=False):
+        yield profile
+        return
+
+    try:
+        tracing = tracemalloc.is_tracing()
+        if not tracing:
+            tracemalloc.start()
+        tracemalloc.reset_peak()
+        profiler = cProfile.Profile()
+        started_at = datetime.utcnow()
+        started = time.perf_counter()
+        profiler.enable()
+        try:
+            yield profile
+        finally:
+            profiler.disable()
+            seconds = time.perf_counter() - started
+            snapshot = tracemalloc.take_snapshot()
+            _, peak = tracemalloc.get_traced_memory()
+            if not tracing:
+                tracemalloc.stop()
+
+            profile.profile_id = f'{started_at:%Y%m%dT%H%M%S}-{secrets.token_hex(3)}'
+            profile.summary = dict(
+                metadata, id=profile.profile_id, label=label, started_at=started_at.isoformat(),
+                seconds=round(seconds, 4), peak_traced_mb=round(peak / 1024 / 1024, 2),
+                functions=_top_functions(profiler), allocations=_top_allocations(snapshot),
+            )
+            os.makedirs(profile_dir, exist_ok=True)
+            profiler.dump_stats(os.path.join(profile_dir, f'{profile.profile_id}.prof'))
+            with open(os.path.join(profile_dir, f'{profile.profile_id}.json'), 'w') as f:
+                json.dump(profile.summary, f, ensure_ascii=False, indent=1)
+            _prune(profile_dir)
+    finally:
+        _active.release()
+
+
+def profile_path(profile_dir, profile_id, suffix):
+    """剖析文件路径，ID格式不对或文件不存在时返回None"""
+    if not _PROFILE_ID.match(profile_id or ''):
+        return None
+    path = os.path.join(profile_dir, f'{profile_id}{suffix}')
+    return path if os.path.exists(path) else None
+
+
+def load_summary(profile_dir, profile_id):
+    path = profile_path(profile_dir, profile_id, '.json')
+    if path is None:
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def list_profiles(profile_dir, limit=50):
+    """最近的剖析（新的在前），只含ID、对象、时间和耗时"""
+    if not os.path.isdir(profile_dir):
+        return []
+    names = sorted((name for name in os.listdir(profile_dir) if name.endswith('.json')), reverse=True)[:limit]
+    profiles = []
+    for name in names:
+        summary = load_summary(profile_dir, name[:-len('.json')])
+        if summary is not None:
+            profiles.append({key: summary.get(key) for key in ('id', 'label', 'started_at', 'seconds',
+                                                               'peak_traced_mb', 'sampled')})
+    return profiles
+
+
+def _requested_by_admin():
+    """请求头要求剖析且当前用户是管理员"""
+    from flask_jwt_extended import get_jwt_identity, verify_jwt_in_request
+    from app.models import User
+
+    try:
+        verify_jwt_in_request(optional=True)
+    except Exception:
+        return False
+    user_id = get_jwt_identity()
+    user = User.query.get(user_id) if user_id is not None else None
+    return user is not None and user.role == 'admin'
+
+
+def init_profiling(app):
+    """注册请求剖析钩子；PROFILE_REQUESTS 关闭且 PROFILE_SAMPLE_RATE 为0时什么也不做"""
+    from flask import g, request
+
+    header_enabled = app.config['PROFILE_REQUESTS']
+    sample_rate = app.config['PROFILE_SAMPLE_RATE']
+    if not header_enabled and sample_rate <= 0:
+        return
+
+    @app.before_request
+    def start_profile():
+        if not request.path.startswith('/api/') or request.path.startswith('/api/admin/profiles'):
+            return
+        sampled = False
+        if header_enabled and request.headers.get(PROFILE_HEADER, '').lower() in ('1', 'true', 'yes'):
+            if not _requested_by_admin():
+                return
+        elif sample_rate > 0 and random.random() < sample_rate:
+            sampled = True
+        else:
+            return
+
+        context = profiled(app.config['PROFILE_DIR'], f'{request.method} {request.path}',
+                           endpoint=request.endpoint, sampled=sampled)
+        g.profile = context.__enter__()
+        g.profile_context = context
+
+    def finish_profile(error=None):
+        context = g.pop('profile_context', None)
+        if context is None:
+            return None
+        try:
+            context.__exit__(None, None, None)
+        except Exception as e:
+            app.logger.warning(f"写入剖析结果失败: {str(e)}")
+        return g.pop('profile', None)
+
+    @app.after_request
+    def attach_profile_id(response):
+        profile = finish_profile()
+        if profile is not None and profile.profile_id:
+            response.headers[PROFILE_ID_HEADER] = profile.profile_id
+        return response
+
+    # 视图抛出异常时 after_request 不执行，在这里结束剖析
+    app.teardown_request(finish_profile)
@@ -0,0 +1,172 @@
+
+"""
+基于聚类中心的候选经理剪枝
+classify_customers 中 K-Means 的聚类结果原本只作为 cluster 字段返回。剪枝模式下先用每个聚类的
+中心（聚类内客户需求/爱好的均值）与全部经理打一次分，每个聚类只保留得分最高的 N 个经理，
+之后每个客户只与所属聚类的候选名单精确打分，打分对数约为 客户数×N。
+剪枝是近似的：候选名单外的经理可能得分更高。按当前生效的等级规则（阈值和需求优先升级的差值），
+可能升到更高等级的客户可以退回到与全部经理精确比较，保证这些客户的等级不因剪枝而降低；
+另外抽样与精确结果对比，报告最佳经理的一致率。
+"""
+
+import numpy as np
+
+from app.utils.engine import CLASS_LEVELS, DEFAULT_RULES, best_manager_matches, classify_match_counts
+
+
+def cluster_centroids(customer_needs, customer_hobbies, clusters, n_clusters):
+    """每个聚类内客户需求/爱好矩阵的均值（空聚类为全0）
+
+    Returns:
+        (需求中心矩阵, 爱好中心矩阵)，形状均为 聚类数×标签数
+    """
+    order = np.argsort(clusters, kind='stable')
+    counts = np.bincount(clusters, minlength=n_clusters)
+    starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+    present = counts > 0
+
+    needs_sum = np.zeros((n_clusters, customer_needs.shape[1]), dtype=np.float32)
+    hobbies_sum = np.zeros((n_clusters, customer_hobbies.shape[1]), dtype=np.float32)
+    if present.any():
+        needs_sum[present] = np.add.reduceat(np.asarray(customer_needs, dtype=np.float32)[order], starts[present], axis=0)
+        hobbies_sum[present] = np.add.reduceat(np.asarray(customer_hobbies, dtype=np.float32)[order], starts[present], axis=0)
+    scale = 1 / np.maximum(counts, 1)[:, None]
+    return needs_sum * scale, hobbies_sum * scale
+
+
+def cluster_shortlists(centroid_needs, centroid_hobbies, manager_capabilities, manager_hobbies, top_n):
+    """每个聚类中心得分最高的 top_n 个经理
+
+    Returns:
+        聚类数×top_n 的经理行号矩阵，每行升序（客户打分时并列仍取行号最小的经理）
+    """
+    scores = centroid_needs @ np.asarray(manager_capabilities, dtype=np.float32).T \
+        + centroid_hobbies @ np.asarray(manager_hobbies, dtype=np.float32).T
+    top_n = min(top_n, scores.shape[1])
+    return np.sort(np.argsort(-scores, axis=1, kind='stable')[:, :top_n], axis=1)
+
+
+def near_boundary(needs_match, hobbies_match, customer_needs, customer_hobbies, margin, rules=None):
+    """总分再增加不超过 margin 就可能升到更高等级、且理论上能够达到的客户
+
+    升级有两种途径：总分达到上一级阈值，或需求重合数比爱好重合数多 upgrade_margin 及以上（尚未升级的客户）。
+    客户与任何经理的需求重合数不超过其需求数、总分不超过其需求数加爱好数，达不到的客户不需要退回精确打分。
+
+    Args:
+        rules: 等级规则，默认为 DEFAULT_RULES
+    """
+    rules = rules or DEFAULT_RULES
+    thresholds = rules.thresholds
+    needs_match = np.asarray(needs_match)
+    hobbies_match = np.asarray(hobbies_match)
+    total = needs_match + hobbies_match
+    level = np.searchsorted(thresholds, total, side='right')
+    has_next = level < len(thresholds)
+    next_threshold = thresholds[np.minimum(level, len(thresholds) - 1)]
+    needs_count = np.asarray(customer_needs).sum(axis=1)
+    upper_bound = needs_count + np.asarray(customer_hobbies).sum(axis=1)
+    boundary = has_next & (next_threshold - total <= margin) & (upper_bound >= next_threshold)
+
+    if rules.upgrade_margin is not None:
+        upgraded = needs_match >= hobbies_match + rules.upgrade_margin
+        # 总分在 [total, total + margin] 内、需求重合数尽可能多的分法是否满足升级条件
+        reach = np.clip(needs_count, total, np.minimum(total + margin, upper_bound))
+        reach_needs = np.minimum(needs_count, reach)
+        can_upgrade = reach_needs - (reach - reach_needs) >= rules.upgrade_margin
+        boundary |= ~upgraded & can_upgrade & (level < len(CLASS_LEVELS) - 1)
+    return boundary
+
+
+def centroid_best_matches(customer_needs, customer_hobbies, manager_capabilities, manager_hobbies, clusters,
+                          top_n=20, margin=None, sample=1000, seed=42, stats=None, rules=None):
+    """best_manager_matches 的剪枝版本：每个客户只与所属聚类的候选经理打分
+
+    Args:
+        clusters: 每个客户的聚类编号（K-Means 的 labels）
+        top_n: 每个聚类保留的候选经理数
+        margin: 总分再增加不超过该值就可能升级的客户退回与全部经理精确比较，为空时不退回
+        sample: 与精确结果对比的抽样客户数，0表示不抽样
+        stats: 可选字典，写入打分对比例、退回数和抽样一致率
+        rules: 判断是否退回和计算等级一致率的等级规则，默认为 DEFAULT_RULES
+
+    Returns:
+        (最佳经理行号, 需求匹配数, 爱好匹配数)
+    """
+    customer_needs = np.asarray(customer_needs)
+    customer_hobbies = np.asarray(customer_hobbies)
+    clusters = np.asarray(clusters, dtype=np.int64)
+    n_customers = len(customer_needs)
+    n_managers = len(manager_capabilities)
+    n_clusters = int(clusters.max()) + 1 if n_customers else 0
+
+    shortlists = cluster_shortlists(*cluster_centroids(customer_needs, customer_hobbies, clusters, n_clusters),
+                                    manager_capabilities, manager_hobbies, top_n)
+
+    best = np.zeros(n_customers, dtype=np.int64)
+    needs_match = np.zeros(n_customers, dtype=np.int32)
+    hobbies_match = np.zeros(n_customers, dtype=np.int32)
+    for cluster in np.unique(clusters):
+        rows = np.flatnonzero(clusters == cluster)
+        shortlist = shortlists[cluster]
+        local, needs_match[rows], hobbies_match[rows] = best_manager_matches(
+            customer_needs[rows], customer_hobbies[rows],
+            np.asarray(manager_capabilities)[shortlist], np.asarray(manager_hobbies)[shortlist])
+        best[rows] = shortlist[local]
+
+    fallback = np.empty(0, dtype=np.int64)
+    if margin is not None:
+        fallback = np.flatnonzero(near_boundary(needs_match, hobbies_match, customer_needs, customer_hobbies, margin,
+                                                   rules=rules))
+        if len(fallback):
+            best[fallback], needs_match[fallback], hobbies_match[fallback] = best_manager_matches(
+                customer_needs[fallback], customer_hobbies[fallback], manager_capabilities, manager_hobbies)
+
+    if stats is not None:
+        stats.update({
+            'clusters': n_clusters,
+            'shortlist_size': shortlists.shape[1] if n_clusters else 0,
+            'pair_fraction': (n_customers * (shortlists.shape[1] if n_clusters else 0) + len(fallback) * n_managers)
+                             / max(n_customers * n_managers, 1),
+            'fallback_customers': int(len(fallback)),
+        })
+        if sample and n_customers:
+            picked = np.sort(np.random.default_rng(seed).choice(n_customers, min(sample, n_customers), replace=False))
+            exact_best, exact_needs, exact_hobbies = best_manager_matches(
+                customer_needs[picked], customer_hobbies[picked], manager_capabilities, manager_hobbies)
+            stats.update({
+                'sampled': int(len(picked)),
+                'best_agreement': float((best[picked] == exact_best).mean()),
+                'total_agreement': float(((needs_match[picked] + hobbies_match[picked])
+                                          == (exact_needs + exact_hobbies)).mean()),
+                'class_agreement': float((classify_match_counts(needs_match[picked], hobbies_match[picked], rules)
+                                          == classify_match_counts(exact_needs, exact_hobbies, rules)).mean()),
+            })
+    return best, needs_match, hobbies_match
+
+
+def centroid_kernel(setting):
+    """由 "候选数[:退回阈值差]" 形式的配置（如 "20" 或 "20:1"）构造可传给 classify_customers 的打分函数
+
+    该打分函数需要聚类编号和等级规则，engine.classify 根据 uses_clusters / uses_rules 属性把 K-Means 的结果
+    和本次分类使用的规则一并传入；每次调用把抽样一致率等统计写入应用日志。
+    """
+    top_n, _, margin = setting.partition(':')
+    top_n = int(top_n)
+    margin = int(margin) if margin else None
+
+    def kernel(customer_needs, customer_hobbies, manager_capabilities, manager_hobbies, clusters, rules=None):
+        from flask import current_app, has_app_context
+
+        stats = {}
+        result = centroid_best_matches(customer_needs, customer_hobbies, manager_capabilities, manager_hobbies,
+                                       clusters, top_n=top_n, margin=margin, stats=stats, rules=rules)
+        if has_app_context() and 'best_agreement' in stats:
+            current_app.logger.info(
+                f"聚类剪枝: 候选{stats['shortlist_size']}个经理, 打分对比例{stats['pair_fraction']:.1%}, "
+                f"退回精确{stats['fallback_customers']}个客户, 抽样最佳经理一致率{stats['best_agreement']:.1%}, "
+                f"等级一致率{stats['class_agreement']:.1%}")
+        return result
+
+    kernel.uses_clusters = True
+    kernel.uses_rules = True
+    return kernel
@@ -0,0 +1,160 @@
+
+"""
+资料更新时的实时重新匹配
+客户更新需求/爱好后，在同一个请求内基于共享经理模型重新计算等级和最佳经理（O(M)向量运算）；
+经理更新能力/爱好后，在后台线程中只重新打分该经理名下的客户。
+开启 MATCH_PARTITION_BY_BRANCH 时只在同一网点的经理中打分和分配，与按网点的批处理保持一致。
+"""
+
+import threading
+import time
+
+import numpy as np
+from flask import current_app
+
+from app import db
+from app.models import CustomerProfile, ManagerProfile
+from app.utils.class_rules import active_rules
+from app.utils.events import publish_distribution
+from app.utils.manager_model import get_manager_model
+from app.utils.match_history import record_matches
+from app.utils.score_cache import refresh_manager_scores
+from app.utils.snapshot import UNASSIGNED_BRANCH, branch_filter, customer_rows_query, decode_customer_rows
+
+
+def _branch_mask(model, branch):
+    """按网点分区时返回模型中同网点经理的布尔掩码，未分区时返回None"""
+    if not current_app.config['MATCH_PARTITION_BY_BRANCH']:
+        return None
+    manager_ids = [user_id for (user_id,) in db.session.query(ManagerProfile.user_id)
+                   .filter(branch_filter(ManagerProfile.branch, branch or UNASSIGNED_BRANCH))]
+    return np.isin(model.manager_ids, manager_ids)
+
+
+def rematch_customer(customer_profile, assign=True, created_by=None):
+    """重新计算单个客户的等级和最佳经理
+
+    只修改传入的 ORM 对象，由调用方负责提交。客户尚未分配经理且 assign 为真时，
+    按自动分配的规则分配：最佳经理未满员则分配给他，否则分配给负载最小的经理。
+
+    Returns:
+        匹配结果字典；没有可用经理时返回None
+    """
+    started = time.perf_counter()
+    model = get_manager_model()
+    if not model.manager_count:
+        return None
+
+    mask = _branch_mask(model, customer_profile.branch)
+    if mask is not None and not mask.any():
+        return None
+
+    rules = active_rules()
+    needs_match, hobbies_match = model.score(customer_profile.needs, customer_profile.hobbies)
+    totals = needs_match + hobbies_match
+    if mask is not None:
+        totals = np.where(mask, totals, -1)
+    best = int(np.argmax(totals))
+    customer_class = str(rules.classify(needs_match[best], hobbies_match[best]))
+    customer_profile.customer_class = customer_class
+    customer_profile.best_needs_match = int(needs_match[best])
+    customer_profile.best_hobbies_match = int(hobbies_match[best])
+
+    result = {
+        'customer_class': customer_class,
+        'best_manager_id': int(model.manager_ids[best]),
+        'needs_match': int(needs_match[best]),
+        'hobbies_match': int(hobbies_match[best]),
+        'assigned_manager_id': None,
+        'model_version': model.version,
+    }
+
+    if assign and not customer_profile.manager_id:
+        loads = model.manager_loads
+        if mask is not None:
+            loads = np.where(mask, loads, np.iinfo(np.int64).max)
+        chosen = best if loads[best] < rules.capacity else int(np.argmin(loads))
+        customer_profile.manager_id = int(model.manager_ids[chosen])
+        result['assigned_manager_id'] = customer_profile.manager_id
+        if created_by is not None:
+            record_matches([(customer_profile.user_id, customer_profile.manager_id,
+                             needs_match[chosen], hobbies_match[chosen])], created_by)
+
+    result['elapsed_ms'] = round((time.perf_counter() - started) * 1000, 3)
+    return result
+
+
+def rescore_manager_customers(manager_id, chunk_size=500):
+    """重新计算某个经理名下所有客户的等级（需要在应用上下文中调用）
+
+    Returns:
+        重新打分的客户数
+    """
+    model = get_manager_model()
+    if not model.manager_count:
+        return 0
+    mask = None
+    if current_app.config['MATCH_PARTITION_BY_BRANCH']:
+        branch = db.session.query(ManagerProfile.branch).filter_by(user_id=manager_id).scalar()
+        mask = _branch_mask(model, branch)
+        if not mask.any():
+            return 0
+
+    rules = active_rules()
+    rescored = 0
+    last_id = 0
+    while True:
+        rows = decode_customer_rows(
+            customer_rows_query()
+            .filter(CustomerProfile.manager_id == manager_id, CustomerProfile.user_id > last_id)
+            .order_by(CustomerProfile.user_id)
+            .limit(chunk_size).all())
+        if not rows:
+            break
+
+        values = list(rows.values())
+        needs_overlap, hobbies_overlap = model.score_many([r[1] for r in values], [r[2] for r in values])
+        totals = needs_overlap + hobbies_overlap
+        if mask is not None:
+            totals = np.where(mask, totals, -1)
+        best = np.argmax(totals, axis=1)
+        index = np.arange(len(values))
+        needs_match = needs_overlap[index, best]
+        hobbies_match = hobbies_overlap[index, best]
+        classes = rules.classify(needs_match, hobbies_match)
+
+        db.session.bulk_update_mappings(CustomerProfile, [
+            {'id': row[0], 'customer_class': str(classes[i]),
+             'best_needs_match': int(needs_match[i]), 'best_hobbies_match': int(hobbies_match[i])}
+            for i, row in enumerate(values)
+        ])
+        db.session.commit()
+
+        rescored += len(values)
+        last_id = list(rows)[-1]
+    return rescored
+
+
+def rescore_manager_customers_async(app, manager_id):
+    """在后台线程中重新打分经理名下的客户并更新分数缓存，不阻塞当前请求"""
+
+    def run():
+        with app.app_context():
+            started = time.perf_counter()
+            try:
+                count = rescore_manager_customers(manager_id)
+                refreshed = refresh_manager_scores(manager_id)
+                # 等级分布可能变化，推送给仪表盘
+                publish_distribution(f'manager-rescore:{manager_id}')
+                app.logger.info(f"经理{manager_id}名下{count}个客户已重新打分, "
+                                f"{refreshed}个客户的分数缓存已更新 "
+                                f"({(time.perf_counter() - started) * 1000:.1f}ms)")
+            except Exception as e:
+                db.session.rollback()
+                app.logger.error(f"经理{manager_id}名下客户重新打分失败: {str(e)}")
+            finally:
+                db.session.remove()
+
+    thread = threading.Thread(target=run, name=f'rescore-manager-{manager_id}', daemon=True)
+    thread.start()
+    return thread
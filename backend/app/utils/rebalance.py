@@ -0,0 +1,237 @@
+
+"""
+超载经理的增量再平衡
+auto_assign_customers 跳过已有经理的客户，经理超过容量或新经理加入后已有的分配不会再变化。
+再平衡只读取超载经理名下的客户和他们的分数缓存：每个客户迁到某个有空位的同网点经理的代价是
+当前总分减去新经理的总分，按代价从小到大贪心地接受迁移，直到每个经理都不超过容量。
+缓存中的候选经理都已满时，再用经理模型为剩下的客户与全部经理现场打分补一轮。
+超载经理由共享经理模型中的负载（每次分配提交后都会重新发布）找出，精确负载只对超载经理和候选目标经理查询，
+计算量与超载经理名下的客户数×缓存深度成正比，与客户总数无关；计划可以先预览，确认后再执行。
+"""
+
+import heapq
+from collections import defaultdict
+
+from sqlalchemy import func
+
+from app import db
+from app.models import CustomerProfile, ManagerProfile, MatchScore, User
+from app.utils.class_rules import active_rules
+from app.utils.manager_model import get_manager_model
+from app.utils.snapshot import UNASSIGNED_BRANCH, branch_filter, customer_rows_query, decode_customer_rows
+
+
+def manager_loads(manager_ids=None):
+    """各经理名下的客户数（一条聚合查询），可以只统计指定的经理"""
+    query = db.session.query(CustomerProfile.manager_id, func.count(CustomerProfile.id)) \
+        .filter(CustomerProfile.manager_id.isnot(None))
+    if manager_ids is not None:
+        query = query.filter(CustomerProfile.manager_id.in_(list(manager_ids)))
+    return dict(query.group_by(CustomerProfile.manager_id).all())
+
+
+def _manager_branches(branch=None, manager_ids=None):
+    """{经理ID: 网点}，只含角色为 manager 的用户"""
+    query = db.session.query(ManagerProfile.user_id, ManagerProfile.branch) \
+        .join(User, User.id == ManagerProfile.user_id).filter(User.role == 'manager')
+    if branch is not None:
+        query = query.filter(branch_filter(ManagerProfile.branch, branch))
+    if manager_ids is not None:
+        query = query.filter(ManagerProfile.user_id.in_(list(manager_ids)))
+    return {user_id: branch or UNASSIGNED_BRANCH for user_id, branch in query}
+
+
+def _add_free(free, manager_ids, capacity):
+    """查询这些经理的精确负载，把有空位的加入 free"""
+    manager_ids = [m for m in manager_ids if m not in free]
+    loads = manager_loads(manager_ids) if manager_ids else {}
+    for manager_id in manager_ids:
+        if loads.get(manager_id, 0) < capacity:
+            free[manager_id] = capacity - loads.get(manager_id, 0)
+
+
+def _cached_scores(customer_ids):
+    """{客户ID: {经理ID: (需求匹配数, 爱好匹配数)}}，只含分数缓存中的行"""
+    scores = defaultdict(dict)
+    customer_ids = list(customer_ids)
+    for start in range(0, len(customer_ids), 500):
+        rows = db.session.query(MatchScore.customer_id, MatchScore.manager_id,
+                                MatchScore.needs_match, MatchScore.hobbies_match) \
+            .filter(MatchScore.customer_id.in_(customer_ids[start:start + 500]))
+        for customer_id, manager_id, needs_match, hobbies_match in rows:
+            scores[customer_id][manager_id] = (needs_match, hobbies_match)
+    return scores
+
+
+def _model_scores(customer_ids, model):
+    """用经理模型现场计算这些客户与全部经理的分数，格式同 _cached_scores"""
+    scores = {}
+    customer_ids = list(customer_ids)
+    for start in range(0, len(customer_ids), 1000):
+        chunk = decode_customer_rows(customer_rows_query().filter(
+            CustomerProfile.user_id.in_(customer_ids[start:start + 1000])).all())
+        if not chunk:
+            continue
+        values = list(chunk.values())
+        needs_overlap, hobbies_overlap = model.score_many([r[1] for r in values], [r[2] for r in values])
+        for i, customer_id in enumerate(chunk):
+            scores[customer_id] = {int(manager_id): (int(needs_overlap[i, j]), int(hobbies_overlap[i, j]))
+                                   for j, manager_id in enumerate(model.manager_ids)}
+    return scores
+
+
+def _greedy_moves(customers, scores, excess, free, manager_branches):
+    """按损失从小到大接受迁移，直接修改 excess 和 free
+
+    Args:
+        customers: {客户ID: (当前经理ID, 网点)}，只包含还可以迁移的客户
+        scores: {客户ID: {经理ID: (需求匹配数, 爱好匹配数)}}
+        excess: {超载经理ID: 需要迁出的客户数}
+        free: {经理ID: 剩余容量}
+
+    Returns:
+        迁移列表
+    """
+    options = {}
+    heap = []
+    for customer_id, (source, branch) in customers.items():
+        customer_scores = scores.get(customer_id, {})
+        current = sum(customer_scores.get(source, (0, 0)))
+        # 损失相同时优先总分高的，再按经理ID，结果可复现
+        candidates = sorted(
+            (current - needs - hobbies, manager_id, needs, hobbies)
+            for manager_id, (needs, hobbies) in customer_scores.items()
+            if manager_id != source and manager_branches.get(manager_id) == branch and free.get(manager_id, 0) > 0
+        )
+        if candidates:
+            options[customer_id] = candidates
+            heapq.heappush(heap, (candidates[0][0], candidates[0][1], customer_id, 0))
+
+    moves = []
+    while heap:
+        loss, target, customer_id, k = heapq.heappop(heap)
+        source, _ = customers[customer_id]
+        if excess.get(source, 0) <= 0:
+            continue
+        if free.get(target, 0) <= 0:
+            # 目标经理已满，换这个客户的下一个候选
+            if k + 1 < len(options[customer_id]):
+                next_loss, next_target, _, _ = options[customer_id][k + 1]
+                heapq.heappush(heap, (next_loss, next_target, customer_id, k + 1))
+            continue
+
+        _, _, needs_match, hobbies_match = options[customer_id][k]
+        before = scores[customer_id].get(source, (0, 0))
+        moves.append({
+            'customer_id': customer_id,
+            'from_manager_id': source,
+            'to_manager_id': target,
+            'score_before': int(sum(before)),
+            'score_after': int(needs_match + hobbies_match),
+            'score_loss': int(loss),
+            'needs_match': int(needs_match),
+            'hobbies_match': int(hobbies_match),
+        })
+        excess[source] -= 1
+        free[target] -= 1
+    return moves
+
+
+def plan_rebalance(capacity=None, branch=None, model=None):
+    """计算把所有经理降到容量以内、总分损失尽量小的迁移计划（只读，不修改数据）
+
+    Args:
+        capacity: 每个经理的客户上限，默认为当前生效规则中的经理容量
+        branch: 只处理该网点的经理，为空时处理全部网点（迁移始终不跨网点）
+
+    Returns:
+        {'capacity', 'overloaded_managers', 'moves': 迁移列表, 'total_loss',
+         'unresolved': {经理ID: 同网点没有空位而仍需迁出的客户数}}
+    """
+    capacity = capacity or active_rules().capacity
+    model = model or get_manager_model()
+    manager_branches = _manager_branches(branch)
+    model_loads = {int(m): int(load) for m, load in zip(model.manager_ids, model.manager_loads)
+                   if int(m) in manager_branches}
+    # 模型中超载的经理再查一次精确负载，不统计全表
+    suspects = [m for m, load in model_loads.items() if load > capacity]
+    loads = manager_loads(suspects) if suspects else {}
+    excess = {m: loads[m] - capacity for m in loads if loads[m] > capacity}
+
+    plan = {'capacity': capacity, 'overloaded_managers': len(excess), 'moves': [], 'total_loss': 0,
+            'unresolved': {}}
+    if not excess:
+        return plan
+
+    customers = {
+        customer_id: (manager_id, customer_branch or UNASSIGNED_BRANCH)
+        for customer_id, manager_id, customer_branch in db.session.query(
+            CustomerProfile.user_id, CustomerProfile.manager_id, CustomerProfile.branch
+        ).filter(CustomerProfile.manager_id.in_(list(excess)))
+    }
+    scores = _cached_scores(customers)
+    # 缓存里没有当前经理的客户现场补算，避免把迁移前的分数当成0
+    missing = [c for c, (source, _) in customers.items() if source not in scores.get(c, {})]
+    if missing and model.manager_count:
+        for customer_id, row in _model_scores(missing, model).items():
+            source = customers[customer_id][0]
+            if source in row:
+                scores[customer_id][source] = row[source]
+
+    # 候选目标只有分数缓存中出现的同网点经理
+    free = {}
+    _add_free(free, {m for row in scores.values() for m in row if m in manager_branches and m not in excess},
+              capacity)
+    moves = _greedy_moves(customers, scores, excess, free, manager_branches)
+
+    # 缓存中的候选都已满：剩下的客户与全部经理打分后再贪心一轮，目标为模型中还有空位的经理
+    if any(count > 0 for count in excess.values()) and model.manager_count:
+        moved = {move['customer_id'] for move in moves}
+        remaining = {c: v for c, v in customers.items() if c not in moved and excess.get(v[0], 0) > 0}
+        _add_free(free, [m for m, load in model_loads.items() if load < capacity and m not in excess], capacity)
+        moves += _greedy_moves(remaining, _model_scores(remaining, model), excess, free, manager_branches)
+
+    plan['moves'] = moves
+    plan['total_loss'] = sum(move['score_loss'] for move in moves)
+    plan['unresolved'] = {m: count for m, count in excess.items() if count > 0}
+    return plan
+
+
+def apply_rebalance(moves, created_by, capacity=None):
+    """执行 plan_rebalance 得到的迁移计划并为每次迁移写入匹配历史，然后提交
+
+    moves 必须来自服务端计算的计划（其中的分数会直接写入匹配历史），不能直接使用客户端提交的内容。
+    计划之后数据可能已经变化：客户已不在原经理名下、目标不再是同网点的经理，或者目标经理已满的迁移会被跳过。
+
+    Returns:
+        {'applied': 执行的迁移数, 'skipped': 跳过的客户ID列表, 'recorded_matches': 写入的历史记录数}
+    """
+    from app.utils.match_history import record_matches
+
+    capacity = capacity or active_rules().capacity
+    targets = {move['to_manager_id'] for move in moves}
+    manager_branches = _manager_branches(manager_ids=targets) if targets else {}
+    loads = manager_loads(targets) if targets else {}
+    applied = []
+    skipped = []
+    for move in moves:
+        target = move['to_manager_id']
+        if target not in manager_branches or loads.get(target, 0) >= capacity:
+            skipped.append(move['customer_id'])
+            continue
+        changed = CustomerProfile.query.filter(
+            CustomerProfile.user_id == move['customer_id'],
+            CustomerProfile.manager_id == move['from_manager_id'],
+            branch_filter(CustomerProfile.branch, manager_branches[target]),
+        ).update({CustomerProfile.manager_id: target}, synchronize_session=False)
+        if not changed:
+            skipped.append(move['customer_id'])
+            continue
+        loads[target] = loads.get(target, 0) + 1
+        applied.append(move)
+
+    recorded_matches = record_matches(
+        ((move['customer_id'], move['to_manager_id'], move['needs_match'], move['hobbies_match']) for move in applied),
+        created_by)
+    db.session.commit()
+    return {'applied': len(applied), 'skipped': skipped, 'recorded_matches': recorded_matches}
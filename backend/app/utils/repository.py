@@ -0,0 +1,139 @@
+
+"""
+匹配引擎的数据适配器
+每个适配器提供 load() 返回引擎输入（MatchData 或 ProfileSnapshot），
+load_assignment_state() 返回只含ID、当前经理和负载的输入（只做分配时不必编码标签矩阵），
+save(data, classes=None, assignments=None, match_counts=None) 把等级、分配结果和
+与最佳经理的 (需求重合数, 爱好重合数)（后者与 classes 一样是与 data 客户顺序一致的数组）写回。
+- SQLAlchemyRepository：读写数据库，需要应用上下文
+- InMemoryRepository：读写内存中的字典，用于测试、基准和假设分析
+- ColumnarRepository：读写列式快照目录，写回时生成新版本，不修改数据库
+"""
+
+from datetime import datetime
+
+import numpy as np
+
+from app.utils.engine import MatchData
+
+
+class SQLAlchemyRepository:
+    """数据库适配器，branch 不为空时只读写该网点的客户和经理"""
+
+    def __init__(self, branch=None):
+        self.branch = branch
+
+    def load(self):
+        from app.utils.snapshot import snapshot_from_database
+        return snapshot_from_database(self.branch)
+
+    def load_assignment_state(self):
+        from app import db
+        from app.models import CustomerProfile, ManagerProfile, User
+        from app.utils.snapshot import branch_filter, manager_loads
+
+        customer_query = db.session.query(CustomerProfile.user_id, CustomerProfile.id, CustomerProfile.manager_id) \
+            .join(User, User.id == CustomerProfile.user_id).filter(User.role == 'customer')
+        manager_query = db.session.query(ManagerProfile.user_id) \
+            .join(User, User.id == ManagerProfile.user_id).filter(User.role == 'manager')
+        if self.branch is not None:
+            customer_query = customer_query.filter(branch_filter(CustomerProfile.branch, self.branch))
+            manager_query = manager_query.filter(branch_filter(ManagerProfile.branch, self.branch))
+
+        # 同一用户只保留第一份资料
+        customers = {}
+        for user_id, profile_id, manager_id in customer_query:
+            customers.setdefault(user_id, (profile_id, manager_id or -1))
+        customer_ids = sorted(customers)
+        manager_ids = sorted({m for (m,) in manager_query})
+        return MatchData(
+            customer_ids, manager_ids,
+            customer_profile_ids=np.array([customers[c][0] for c in customer_ids], dtype=np.int64),
+            customer_managers=[customers[c][1] for c in customer_ids],
+            # 负载统计该经理名下的全部客户（不限网点）
+            manager_loads=manager_loads(manager_ids),
+        )
+
+    def save(self, data, classes=None, assignments=None, match_counts=None):
+        from app import db
+        from app.models import CustomerProfile
+
+        if classes is not None:
+            # 按主键批量更新客户类别，同时保存重合数供规则变化时重新计算等级
+            rows = [{'id': int(profile_id), 'customer_class': str(customer_class)}
+                    for profile_id, customer_class in zip(data.customer_profile_ids, classes)]
+            if match_counts is not None:
+                for row, needs_match, hobbies_match in zip(rows, *match_counts):
+                    row.update(best_needs_match=int(needs_match), best_hobbies_match=int(hobbies_match))
+            db.session.bulk_update_mappings(CustomerProfile, rows)
+        if assignments:
+            profile_ids = dict(zip(data.customer_ids.tolist(), data.customer_profile_ids.tolist()))
+            db.session.bulk_update_mappings(CustomerProfile, [
+                {'id': profile_ids[customer_id], 'manager_id': manager_id}
+                for customer_id, manager_id in assignments.items() if customer_id in profile_ids
+            ])
+        db.session.commit()
+
+
+class InMemoryRepository:
+    """内存适配器
+
+    Args:
+        customers: {客户ID: {'needs': [...], 'hobbies': [...], 'manager_id': 经理ID或None}}，
+            save 时写入 customer_class、best_needs_match、best_hobbies_match 和 manager_id
+        managers: {经理ID: {'capabilities': [...], 'hobbies': [...]}}
+    """
+
+    def __init__(self, customers, managers):
+        self.customers = customers
+        self.managers = managers
+
+    def load(self):
+        return MatchData.from_profiles(self.customers, self.managers)
+
+    def load_assignment_state(self):
+        return self.load()
+
+    def save(self, data, classes=None, assignments=None, match_counts=None):
+        if classes is not None:
+            for customer_id, customer_class in zip(data.customer_ids.tolist(), classes):
+                self.customers[customer_id]['customer_class'] = str(customer_class)
+        if match_counts is not None:
+            for customer_id, needs_match, hobbies_match in zip(data.customer_ids.tolist(), *match_counts):
+                self.customers[customer_id].update(best_needs_match=int(needs_match), best_hobbies_match=int(hobbies_match))
+        for customer_id, manager_id in (assignments or {}).items():
+            self.customers[customer_id]['manager_id'] = manager_id
+
+
+class ColumnarRepository:
+    """列式快照适配器
+
+    读取目录中的当前版本，写回时复制全部数组、更新客户等级、当前经理和经理负载后写成新版本
+    （快照格式中没有重合数，match_counts 被忽略）。
+    写回不会同步到数据库，之后 flask snapshot refresh 也不会撤销这些修改；
+    需要与数据库保持一致的快照目录（MATCH_SNAPSHOT_DIR）不要用它写回。
+    """
+
+    def __init__(self, snapshot_dir):
+        self.snapshot_dir = snapshot_dir
+
+    def load(self):
+        from app.utils.snapshot import load_snapshot
+        return load_snapshot(self.snapshot_dir)
+
+    def load_assignment_state(self):
+        return self.load()
+
+    def save(self, data, classes=None, assignments=None, match_counts=None):
+        from app.utils.snapshot import CUSTOMER_ARRAYS, MANAGER_ARRAYS, write_version
+
+        arrays = {name: np.array(getattr(data, name)) for name in CUSTOMER_ARRAYS + MANAGER_ARRAYS}
+        if classes is not None:
+            arrays['customer_classes'] = np.asarray(classes, dtype='<U1')
+        if assignments:
+            customer_ids = np.fromiter(assignments.keys(), dtype=np.int64, count=len(assignments))
+            manager_ids = np.fromiter(assignments.values(), dtype=np.int64, count=len(assignments))
+            arrays['customer_managers'][np.searchsorted(arrays['customer_ids'], customer_ids)] = manager_ids
+            np.add.at(arrays['manager_loads'], np.searchsorted(arrays['manager_ids'], manager_ids), 1)
+        manifest = {key: value for key, value in data.manifest.items() if key not in ('version', 'format')}
+        write_version(self.snapshot_dir, arrays, dict(manifest, mode='engine', built_at=datetime.utcnow().isoformat()))
@@ -0,0 +1,259 @@
+
+"""
+客户×经理匹配分数缓存
+每个客户在 MatchScore 表中保留总分最高的前N个经理（并列按经理ID），
+由批处理和 classify_customers（接口触发的分类/自动分配）全量构建；客户资料变化时只重算该客户一行，
+经理资料变化时只重算受影响的客户。手动分配、客户洞察和候选经理查询优先读取缓存，
+缺失时再现场计算（候选经理和洞察会把算出的行写回缓存）。
+"""
+
+import random
+
+import numpy as np
+from sqlalchemy import tuple_
+
+from app import db
+from app.models import CustomerProfile, MatchScore
+from app.utils.clustering import similarity_from_counts
+from app.utils.manager_model import build_manager_model, get_manager_model
+from app.utils.snapshot import customer_rows_query, decode_customer_rows, tag_matrix
+
+
+def default_top_n():
+    """当前应用配置的缓存深度N"""
+    from flask import current_app
+    return current_app.config['MATCH_SCORE_TOP_N']
+
+
+def top_n_rows(customer_ids, needs_overlap, hobbies_overlap, manager_ids, n):
+    """由一块客户的重合数矩阵生成前N名缓存行"""
+    total = needs_overlap + hobbies_overlap
+    n = min(n, total.shape[1])
+    # 稳定排序保证并列时经理行号小的在前
+    top = np.argsort(-total, axis=1, kind='stable')[:, :n]
+    rows = []
+    for i, customer_id in enumerate(customer_ids):
+        for rank, j in enumerate(top[i]):
+            rows.append({
+                'customer_id': int(customer_id),
+                'manager_id': int(manager_ids[j]),
+                'rank': rank,
+                'total_match': int(total[i, j]),
+                'needs_match': int(needs_overlap[i, j]),
+                'hobbies_match': int(hobbies_overlap[i, j]),
+            })
+    return rows
+
+
+def replace_rows(customer_ids, rows):
+    """用新行替换这些客户的全部缓存行（不提交）"""
+    MatchScore.query.filter(MatchScore.customer_id.in_(list(customer_ids))).delete(synchronize_session=False)
+    if rows:
+        db.session.bulk_insert_mappings(MatchScore, rows)
+
+
+def _customer_chunks(chunk_size, customer_ids=None):
+    """按用户ID键集分页读取客户资料"""
+    last_id = 0
+    while True:
+        query = customer_rows_query().filter(CustomerProfile.user_id > last_id)
+        if customer_ids is not None:
+            query = query.filter(CustomerProfile.user_id.in_(customer_ids))
+        rows = decode_customer_rows(query.order_by(CustomerProfile.user_id).limit(chunk_size).all())
+        if not rows:
+            return
+        yield rows
+        last_id = list(rows)[-1]
+
+
+def rebuild_score_cache(n=None, chunk_size=2000, model=None):
+    """全量重建分数缓存，峰值内存为 chunk_size×经理数
+
+    Returns:
+        写入的缓存行数
+    """
+    n = n or default_top_n()
+    model = model or build_manager_model()
+
+    MatchScore.query.delete(synchronize_session=False)
+    db.session.commit()
+    if not model.manager_count:
+        return 0
+
+    written = 0
+    for chunk in _customer_chunks(chunk_size):
+        values = list(chunk.values())
+        needs_overlap, hobbies_overlap = model.score_many([r[1] for r in values], [r[2] for r in values])
+        rows = top_n_rows(list(chunk), needs_overlap, hobbies_overlap, model.manager_ids, n)
+        db.session.bulk_insert_mappings(MatchScore, rows)
+        db.session.commit()
+        written += len(rows)
+    return written
+
+
+def write_scores_from_data(data, n=None, chunk_size=2000):
+    """由分类使用的标签矩阵（MatchData 或快照）重写其中全部客户的缓存行，按块提交
+
+    按网点分类时矩阵中只有该网点的经理，缓存也只包含同网点的候选经理。
+
+    Returns:
+        写入的缓存行数
+    """
+    n = n or default_top_n()
+    if not len(data.customer_ids) or not len(data.manager_ids):
+        return 0
+
+    capabilities = np.asarray(data.manager_capabilities, dtype=np.int32).T
+    manager_hobbies = np.asarray(data.manager_hobbies, dtype=np.int32).T
+    written = 0
+    for start in range(0, len(data.customer_ids), chunk_size):
+        # 同一客户有多份资料时只取第一份
+        customer_ids, first = np.unique(data.customer_ids[start:start + chunk_size], return_index=True)
+        rows = first + start
+        needs_overlap = np.asarray(data.customer_needs[rows], dtype=np.int32) @ capabilities
+        hobbies_overlap = np.asarray(data.customer_hobbies[rows], dtype=np.int32) @ manager_hobbies
+        cache_rows = top_n_rows(customer_ids.tolist(), needs_overlap, hobbies_overlap, data.manager_ids, n)
+        replace_rows(customer_ids.tolist(), cache_rows)
+        db.session.commit()
+        written += len(cache_rows)
+    return written
+
+
+def fill_missing_scores(customer_ids, n=None, chunk_size=2000, model=None):
+    """缓存中没有任何行的客户现场计算并写入缓存（不提交）
+
+    Returns:
+        补算的客户数
+    """
+    customer_ids = list(customer_ids)
+    if not customer_ids:
+        return 0
+    cached = {c for (c,) in db.session.query(MatchScore.customer_id)
+              .filter(MatchScore.customer_id.in_(customer_ids)).distinct()}
+    missing = [c for c in customer_ids if c not in cached]
+    if not missing:
+        return 0
+
+    n = n or default_top_n()
+    model = model or get_manager_model()
+    if not model.manager_count:
+        return 0
+    filled = 0
+    for chunk in _customer_chunks(chunk_size, missing):
+        values = list(chunk.values())
+        needs_overlap, hobbies_overlap = model.score_many([r[1] for r in values], [r[2] for r in values])
+        replace_rows(list(chunk), top_n_rows(list(chunk), needs_overlap, hobbies_overlap, model.manager_ids, n))
+        filled += len(chunk)
+    return filled
+
+
+def refresh_customer_scores(customer_profile, n=None, model=None):
+    """客户资料变化后重算该客户的一行缓存（不提交）"""
+    n = n or default_top_n()
+    model = model or get_manager_model()
+    if not model.manager_count:
+        return
+    needs_match, hobbies_match = model.score(customer_profile.needs, customer_profile.hobbies)
+    rows = top_n_rows([customer_profile.user_id], needs_match[None, :], hobbies_match[None, :], model.manager_ids, n)
+    replace_rows([customer_profile.user_id], rows)
+
+
+def refresh_manager_scores(manager_id, n=None, chunk_size=2000, model=None):
+    """经理资料变化后只重算受影响客户的缓存行
+
+    受影响的客户是：缓存中已包含该经理的客户，以及该经理的新分数
+    不低于其缓存中第N名分数（或缓存不足N行）的客户。
+
+    Returns:
+        重算的客户数
+    """
+    n = n or default_top_n()
+    model = model or get_manager_model()
+    j = model.index_of(manager_id)
+    if j is None:
+        return 0
+
+    cached_with_manager = {c for (c,) in db.session.query(MatchScore.customer_id)
+                           .filter(MatchScore.manager_id == manager_id)}
+    thresholds = dict(db.session.query(MatchScore.customer_id, MatchScore.total_match)
+                      .filter(MatchScore.rank == n - 1))
+
+    capabilities = model.manager_capabilities[j].astype(np.int32)
+    manager_hobbies = model.manager_hobbies[j].astype(np.int32)
+    refreshed = 0
+    for chunk in _customer_chunks(chunk_size):
+        values = list(chunk.values())
+        # 先只算与这一位经理的分数（一列），筛出受影响的客户
+        scores = (tag_matrix([r[1] for r in values], model.tag_index) @ capabilities
+                  + tag_matrix([r[2] for r in values], model.tag_index) @ manager_hobbies)
+        affected = [
+            customer_id for customer_id, total in zip(chunk, scores)
+            if customer_id in cached_with_manager or total >= thresholds.get(customer_id, -1)
+        ]
+        if not affected:
+            continue
+
+        affected_rows = [chunk[c] for c in affected]
+        needs_overlap, hobbies_overlap = model.score_many(
+            [r[1] for r in affected_rows], [r[2] for r in affected_rows])
+        replace_rows(affected, top_n_rows(affected, needs_overlap, hobbies_overlap, model.manager_ids, n))
+        db.session.commit()
+        refreshed += len(affected)
+    return refreshed
+
+
+def lookup_scores(pairs):
+    """批量读取 (客户ID, 经理ID) 对的缓存分数
+
+    Returns:
+        {(客户ID, 经理ID): similarity 字典}，未缓存的对不在结果中
+    """
+    pairs = list(pairs)
+    scores = {}
+    for start in range(0, len(pairs), 500):
+        rows = db.session.query(MatchScore.customer_id, MatchScore.manager_id,
+                                MatchScore.needs_match, MatchScore.hobbies_match) \
+            .filter(tuple_(MatchScore.customer_id, MatchScore.manager_id).in_(pairs[start:start + 500])).all()
+        scores.update({(c, m): similarity_from_counts(needs, hobbies) for c, m, needs, hobbies in rows})
+    return scores
+
+
+def candidate_managers(customer_id, limit=None):
+    """按名次返回客户缓存中的候选经理，缓存中没有该客户时先现场计算并写回"""
+    query = MatchScore.query.filter_by(customer_id=customer_id).order_by(MatchScore.rank)
+    if limit:
+        query = query.limit(limit)
+    candidates = query.all()
+    if not candidates and fill_missing_scores([customer_id]):
+        db.session.commit()
+        candidates = query.all()
+    return candidates
+
+
+def verify_score_cache(n=None, sample_size=500, model=None):
+    """抽样重算客户的前N名并与缓存比对
+
+    Returns:
+        (比对的客户数, 不一致的客户ID列表)
+    """
+    n = n or default_top_n()
+    model = model or build_manager_model()
+    customer_ids = [c for (c,) in customer_rows_query().with_entities(CustomerProfile.user_id)]
+    sample = sorted(random.sample(customer_ids, min(sample_size, len(customer_ids))))
+
+    mismatched = []
+    for chunk in _customer_chunks(1000, sample):
+        values = list(chunk.values())
+        needs_overlap, hobbies_overlap = model.score_many([r[1] for r in values], [r[2] for r in values])
+        expected = {}
+        for row in top_n_rows(list(chunk), needs_overlap, hobbies_overlap, model.manager_ids, n):
+            expected.setdefault(row['customer_id'], []).append(
+                (row['rank'], row['manager_id'], row['needs_match'], row['hobbies_match']))
+
+        cached = {}
+        for row in MatchScore.query.filter(MatchScore.customer_id.in_(list(chunk))).order_by(MatchScore.rank):
+            cached.setdefault(row.customer_id, []).append(
+                (row.rank, row.manager_id, row.needs_match, row.hobbies_match))
+
+        mismatched.extend(c for c in chunk if expected.get(c, []) != cached.get(c, []))
+    return len(sample), mismatched
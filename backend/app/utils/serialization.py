@@ -0,0 +1,116 @@
+
+"""
+API 响应的序列化
+- OrjsonProvider：安装了 orjson 时替换 Flask 默认的 JSON provider，未安装时 create_app 继续使用默认实现
+- RowSerializer：直接把查询结果元组转换成与 to_dict() 相同结构的字典，
+  不构造 ORM 实例、不逐行懒加载关系；转换函数按字段列表生成一次后反复使用
+"""
+
+import json
+
+from flask.json.provider import DefaultJSONProvider
+
+try:
+    import orjson
+except ImportError:  # orjson 是可选依赖
+    orjson = None
+
+# RowSerializer 的字段类型
+DATETIME = 'datetime'
+JSON_TEXT = 'json'
+
+
+class OrjsonProvider(DefaultJSONProvider):
+    """基于 orjson 的 JSON provider
+
+    datetime 由 orjson 直接输出为 ISO 8601（与 to_dict 中的 isoformat 相同），
+    其他 orjson 不支持的类型交给 provider 的 default（默认为 Flask 的转换函数，可以在子类或实例上覆盖）。
+    """
+
+    # RowSerializer 据此决定是否还需要逐行调用 isoformat
+    native_datetime = True
+
+    def _options(self, pretty=False):
+        option = orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY
+        if self.sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        if pretty:
+            option |= orjson.OPT_INDENT_2
+        return option
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=self.default, option=self._options()).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        pretty = self.compact is False or (self.compact is None and self._app.debug)
+        body = orjson.dumps(obj, default=self.default, option=self._options(pretty))
+        return self._app.response_class(body + b'\n', mimetype=self.mimetype)
+
+
+def json_provider_class(name):
+    """按配置选择 JSON provider：orjson 未安装时退回 Flask 默认实现"""
+    if name == 'orjson' and orjson is not None:
+        return OrjsonProvider
+    return DefaultJSONProvider
+
+
+def _loads_tags(value):
+    return (orjson.loads if orjson is not None else json.loads)(value)
+
+
+class RowSerializer:
+    """把查询结果元组转换为字典列表
+
+    Args:
+        fields: (键, 列表达式[, 类型]) 列表；键中的 "." 表示嵌套字典，例如 "customer.id"；
+            类型为 DATETIME 时按需转换为 ISO 字符串，为 JSON_TEXT 时把 JSON 文本解析为列表
+    """
+
+    def __init__(self, fields):
+        self.fields = [(field[0], field[1], field[2] if len(field) > 2 else None) for field in fields]
+        self._compiled = {}
+
+    @property
+    def columns(self):
+        """查询用的列，按字段顺序并带唯一标签（避免联表时同名列冲突）"""
+        return [column.label(key.replace('.', '__')) for key, column, _ in self.fields]
+
+    def _compile(self, native_datetime):
+        tree = {}
+        for i, (key, _, kind) in enumerate(self.fields):
+            value = f'r[{i}]'
+            if kind == DATETIME and not native_datetime:
+                value = f'({value}.isoformat() if {value} is not None else None)'
+            elif kind == JSON_TEXT:
+                value = f'(_loads({value}) if {value} else [])'
+            node = tree
+            *parents, leaf = key.split('.')
+            for parent in parents:
+                node = node.setdefault(parent, {})
+            node[leaf] = value
+
+        def render(node):
+            return '{' + ', '.join(
+                f'{key!r}: {render(value) if isinstance(value, dict) else value}' for key, value in node.items()
+            ) + '}'
+
+        source = f'def serialize(rows):\n    return [{render(tree)} for r in rows]\n'
+        namespace = {'_loads': _loads_tags}
+        exec(compile(source, '<row-serializer>', 'exec'), namespace)
+        return namespace['serialize']
+
+    def serialize(self, rows, native_datetime=None):
+        """转换一批行；native_datetime 为空时按当前应用的 JSON provider 决定"""
+        if native_datetime is None:
+            from flask import current_app
+            native_datetime = getattr(current_app.json, 'native_datetime', False)
+        if native_datetime not in self._compiled:
+            self._compiled[native_datetime] = self._compile(native_datetime)
+        return self._compiled[native_datetime](rows)
+
+    def __call__(self, rows):
+        return self.serialize(rows)
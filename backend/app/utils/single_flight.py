@@ -0,0 +1,242 @@
+
+"""
+跨 worker 的单飞（single-flight）执行
+自动分配、分类这类全量操作同一时间只允许执行一次：第一个调用方通过条件 UPDATE 抢占
+OperationLock 行成为执行者，之后同一类型（kind）的调用方不再重复执行，而是等待同一条 OperationRun 并共享结果；
+锁被其他类型的操作（如再平衡、命令行批处理）占用时不合并，直接报告忙。
+全量锁 match 与网点锁 match:<网点> 互斥：抢到其中一种后再检查另一种是否被占用，被占用则放弃刚抢到的锁，
+两个调用方同时抢占时至少有一方能看到对方。按网点分区的全量执行中，各网点以全量执行为父操作抢占网点锁。
+执行者在后台线程中定期刷新心跳，worker 被杀死后锁在心跳超时后可以被接管。
+操作的开始、进度和结束都作为 job 事件推送给仪表盘（见 events 模块）。
+"""
+
+import json
+import os
+import socket
+import threading
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy.exc import IntegrityError
+
+from app import db
+from app.models import OperationLock, OperationRun
+
+# 客户分类和自动分配共用的锁名（两者都会改写客户的等级和经理）
+MATCH_OPERATION = 'match'
+
+# 心跳间隔和超时（秒）
+HEARTBEAT_INTERVAL = 10
+STALE_AFTER = 60
+
+# 当前线程正在执行的操作，供批处理发布进度
+_current = threading.local()
+
+
+class OperationBusy(Exception):
+    """操作正在由其他调用方执行"""
+
+    def __init__(self, run_id):
+        super().__init__(f'操作正在执行中 (run {run_id})')
+        self.run_id = run_id
+
+
+def current_run():
+    """当前线程正在执行的操作 (名称, OperationRun ID)，不在操作中时为None"""
+    return getattr(_current, 'run', None)
+
+
+def _holder():
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+
+def _ensure_lock_row(name):
+    if db.session.get(OperationLock, name) is None:
+        try:
+            db.session.add(OperationLock(name=name))
+            db.session.commit()
+        except IntegrityError:
+            # 其他 worker 同时插入了这一行
+            db.session.rollback()
+
+
+def _conflicting_run(name, parent_run_id=None):
+    """与 name 互斥的另一种匹配锁（全量锁与网点锁之间）正在执行的记录ID"""
+    stale_before = datetime.utcnow() - timedelta(seconds=STALE_AFTER)
+    query = OperationLock.query.filter(OperationLock.run_id.isnot(None), OperationLock.heartbeat_at >= stale_before)
+    if name == MATCH_OPERATION:
+        query = query.filter(OperationLock.name.like(f'{MATCH_OPERATION}:%'))
+    elif name.startswith(f'{MATCH_OPERATION}:'):
+        query = query.filter(OperationLock.name == MATCH_OPERATION)
+        if parent_run_id is not None:
+            query = query.filter(OperationLock.run_id != parent_run_id)
+    else:
+        return None
+    lock = query.first()
+    return lock.run_id if lock is not None else None
+
+
+def claim(name, started_by=None, kind=None, parent_run_id=None):
+    """尝试成为操作的执行者
+
+    Args:
+        parent_run_id: 父操作（按网点分区的全量执行）的记录ID，网点锁不与它互斥
+
+    Returns:
+        (OperationRun ID, 是否为执行者)；不是执行者时返回正在执行的记录ID
+    """
+    _ensure_lock_row(name)
+    while True:
+        now = datetime.utcnow()
+        run = OperationRun(name=name, kind=kind, status='running', started_by=started_by, started_at=now)
+        db.session.add(run)
+        db.session.flush()
+
+        claimed = OperationLock.query.filter(
+            OperationLock.name == name,
+            db.or_(OperationLock.run_id.is_(None), OperationLock.heartbeat_at < now - timedelta(seconds=STALE_AFTER))
+        ).update({'run_id': run.id, 'holder': _holder(), 'heartbeat_at': now}, synchronize_session=False)
+
+        if claimed:
+            # 接管了心跳超时的锁时，把原来的执行记录标记为放弃
+            OperationRun.query.filter(
+                OperationRun.name == name, OperationRun.status == 'running', OperationRun.id != run.id
+            ).update({'status': 'abandoned', 'finished_at': now}, synchronize_session=False)
+            db.session.commit()
+
+            # 先提交自己的锁再检查互斥的锁，同时抢占的两方不会都检查通过
+            conflict = _conflicting_run(name, parent_run_id)
+            if conflict is None:
+                return run.id, True
+            finish(name, run.id, error=f'与正在执行的操作 (run {conflict}) 冲突')
+            return conflict, False
+
+        db.session.rollback()
+        current_run_id = db.session.get(OperationLock, name).run_id
+        db.session.rollback()
+        if current_run_id is not None:
+            return current_run_id, False
+        # 执行者恰好在两次查询之间释放了锁，重新抢占
+
+
+def finish(name, run_id, result=None, error=None):
+    """记录执行结果并释放锁"""
+    OperationRun.query.filter_by(id=run_id).update({
+        'status': 'failed' if error else 'succeeded',
+        'result': json.dumps(result, ensure_ascii=False) if result is not None else None,
+        'error': error,
+        'finished_at': datetime.utcnow(),
+    }, synchronize_session=False)
+    OperationLock.query.filter_by(name=name, run_id=run_id).update(
+        {'run_id': None, 'holder': None, 'heartbeat_at': None}, synchronize_session=False)
+    db.session.commit()
+
+
+def wait_for_run(run_id, timeout, poll_interval=0.5):
+    """等待执行记录结束
+
+    Returns:
+        结束的 OperationRun；超时返回None
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        # 每次轮询前结束事务，避免在可重复读隔离级别下一直读到旧快照
+        db.session.rollback()
+        run = db.session.get(OperationRun, run_id, populate_existing=True)
+        if run is None or run.status != 'running':
+            return run
+        if time.monotonic() >= deadline:
+            return None
+        time.sleep(poll_interval)
+
+
+def _heartbeat(app, name, run_id, stop):
+    with app.app_context():
+        try:
+            while not stop.wait(HEARTBEAT_INTERVAL):
+                OperationLock.query.filter_by(name=name, run_id=run_id).update(
+                    {'heartbeat_at': datetime.utcnow()}, synchronize_session=False)
+                db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            app.logger.error(f"{name}锁心跳失败: {str(e)}")
+        finally:
+            db.session.remove()
+
+
+def _execute(name, run_id, func):
+    """执行 func 并记录结果，期间由后台线程刷新心跳；func 抛出的异常记录后继续抛出"""
+    from flask import current_app
+    from app.utils.events import publish_job
+
+    stop = threading.Event()
+    heartbeat = threading.Thread(target=_heartbeat, args=(current_app._get_current_object(), name, run_id, stop),
+                                 name=f'heartbeat-{name}', daemon=True)
+    heartbeat.start()
+    publish_job(name, run_id, 'running')
+    outer, _current.run = current_run(), (name, run_id)
+    try:
+        result = func()
+    except Exception as e:
+        db.session.rollback()
+        finish(name, run_id, error=str(e))
+        _finished(name, run_id, 'failed', error=str(e))
+        raise
+    finally:
+        _current.run = outer
+        stop.set()
+        heartbeat.join()
+    finish(name, run_id, result=result)
+    _finished(name, run_id, 'succeeded')
+    return result
+
+
+def _finished(name, run_id, status, **fields):
+    """锁释放后推送结果：分类/分配类操作（包括失败前已提交的块）先推送分布变化，再推送任务结束"""
+    from app.utils.events import publish_distribution, publish_job
+
+    if name == MATCH_OPERATION or name.startswith(f'{MATCH_OPERATION}:'):
+        publish_distribution(name, run_id)
+    publish_job(name, run_id, status, **fields)
+
+
+def run_exclusive(name, func, started_by=None, parent_run_id=None):
+    """以执行者身份运行 func，锁已被占用时抛出 OperationBusy（用于命令行等不需要合并的调用方）
+
+    Returns:
+        (OperationRun ID, func 的返回值)
+    """
+    run_id, leader = claim(name, started_by, parent_run_id=parent_run_id)
+    if not leader:
+        raise OperationBusy(run_id)
+    return run_id, _execute(name, run_id, func)
+
+
+def single_flight(name, func, kind, started_by=None, wait_timeout=100):
+    """合并并发调用：没有正在执行的操作时执行 func，否则等待正在执行的同类型操作
+
+    func 需要自行提交数据库修改，返回值必须可以序列化为 JSON，等待方拿到的是执行者保存的结果。
+
+    Args:
+        kind: 操作类型（如 auto-assign），锁被其他类型的操作或互斥的另一种匹配锁（全量与网点之间）
+              占用时抛出 OperationBusy，只合并到同名同类型的执行
+
+    Returns:
+        (OperationRun，是否合并到了已有的执行)；等待超时时 OperationRun 的状态仍为 running
+    """
+    from flask import current_app
+
+    run_id, leader = claim(name, started_by, kind=kind)
+    if not leader:
+        run = db.session.get(OperationRun, run_id)
+        if run is not None and (run.name != name or run.kind != kind):
+            db.session.rollback()
+            raise OperationBusy(run_id)
+        run = wait_for_run(run_id, wait_timeout)
+        return run or db.session.get(OperationRun, run_id), True
+
+    try:
+        _execute(name, run_id, func)
+    except Exception as e:
+        current_app.logger.error(f"{name}执行失败: {str(e)}")
+    return db.session.get(OperationRun, run_id, populate_existing=True), False
@@ -0,0 +1,479 @@
+
+"""
+客户/经理画像的列式快照
+将标签矩阵、ID、客户等级和经理负载写入带版本号的 .npy 目录，
+批处理任务和离线工具可以用 mmap 直接打开，无需经过 ORM 和 JSON 解码
+"""
+
+import json
+import os
+import random
+import shutil
+import uuid
+from datetime import datetime
+
+import numpy as np
+from sqlalchemy import func, or_
+
+from app import db
+from app.models import User, CustomerProfile, ManagerProfile
+from app.utils.engine import tag_matrix
+
+# 快照文件格式版本，格式不兼容时递增
+SNAPSHOT_FORMAT = 1
+
+# 指向当前版本目录的指针文件
+CURRENT_FILE = 'CURRENT'
+
+# 保留的历史版本数量（已经 mmap 打开旧版本的进程不受删除影响）
+KEEP_VERSIONS = 3
+
+# 未设置网点的资料归入的分区
+UNASSIGNED_BRANCH = ''
+
+CUSTOMER_ARRAYS = [
+    'customer_ids', 'customer_profile_ids', 'customer_needs', 'customer_hobbies',
+    'customer_classes', 'customer_managers'
+]
+
+MANAGER_ARRAYS = [
+    'manager_ids', 'manager_profile_ids', 'manager_capabilities', 'manager_hobbies',
+    'manager_loads'
+]
+
+
+class SnapshotError(Exception):
+    """快照不存在或格式不兼容"""
+
+
+class ProfileSnapshot:
+    """一个已打开的快照版本
+
+    所有数组都以只读 mmap 方式打开，按用户ID升序排列。
+    标签矩阵为 uint8 的 0/1 矩阵，列顺序与 tags 一致。
+    """
+
+    def __init__(self, path, manifest, arrays):
+        self.path = path
+        self.manifest = manifest
+        self.version = manifest['version']
+        self.tags = manifest['tags']
+        for name, array in arrays.items():
+            setattr(self, name, array)
+
+    @property
+    def customer_count(self):
+        return len(self.customer_ids)
+
+    @property
+    def manager_count(self):
+        return len(self.manager_ids)
+
+    def customer_index(self, user_id):
+        """返回客户在快照中的行号，不存在时返回None"""
+        i = int(np.searchsorted(self.customer_ids, user_id))
+        if i < len(self.customer_ids) and self.customer_ids[i] == user_id:
+            return i
+        return None
+
+    def __repr__(self):
+        return f'<ProfileSnapshot v{self.version} {self.customer_count}x{self.manager_count}>'
+
+
+def default_snapshot_dir():
+    """当前应用配置的快照目录"""
+    from flask import current_app
+    return current_app.config['MATCH_SNAPSHOT_DIR']
+
+
+def _version_dirname(version):
+    return f'v{version:06d}'
+
+
+def current_version_name(snapshot_dir):
+    """读取 CURRENT 指针，没有任何版本时返回None"""
+    try:
+        with open(os.path.join(snapshot_dir, CURRENT_FILE)) as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+def write_version(snapshot_dir, arrays, manifest):
+    """把一组数组写成新版本目录，并原子地切换 CURRENT 指针
+
+    先写入临时目录，再重命名为版本目录，最后用 os.replace 替换 CURRENT，
+    读者在任何时刻看到的都是完整的版本。
+
+    Returns:
+        新版本号
+    """
+    os.makedirs(snapshot_dir, exist_ok=True)
+    tmp_dir = os.path.join(snapshot_dir, f'.tmp-{os.getpid()}-{uuid.uuid4().hex[:8]}')
+    os.makedirs(tmp_dir)
+
+    try:
+        for name, array in arrays.items():
+            np.save(os.path.join(tmp_dir, f'{name}.npy'), np.ascontiguousarray(array))
+
+        # 版本号取已有最大值加一，rename 失败说明被并发写入者占用，继续递增
+        existing = [d for d in os.listdir(snapshot_dir) if d.startswith('v') and d[1:].isdigit()]
+        version = max([int(d[1:]) for d in existing], default=0) + 1
+        while True:
+            manifest = dict(manifest, version=version, format=SNAPSHOT_FORMAT)
+            with open(os.path.join(tmp_dir, 'manifest.json'), 'w') as f:
+                json.dump(manifest, f, ensure_ascii=False, indent=2)
+            try:
+                os.rename(tmp_dir, os.path.join(snapshot_dir, _version_dirname(version)))
+                break
+            except OSError:
+                version += 1
+    except Exception:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+
+    pointer_tmp = os.path.join(snapshot_dir, f'.{CURRENT_FILE}-{uuid.uuid4().hex[:8]}')
+    with open(pointer_tmp, 'w') as f:
+        f.write(_version_dirname(version))
+    os.replace(pointer_tmp, os.path.join(snapshot_dir, CURRENT_FILE))
+
+    _prune_versions(snapshot_dir)
+    return version
+
+
+def _prune_versions(snapshot_dir, keep=KEEP_VERSIONS):
+    versions = sorted(d for d in os.listdir(snapshot_dir) if d.startswith('v') and d[1:].isdigit())
+    current = current_version_name(snapshot_dir)
+    for name in versions[:-keep]:
+        if name != current:
+            shutil.rmtree(os.path.join(snapshot_dir, name), ignore_errors=True)
+
+
+def open_version(snapshot_dir, names, version_name=None):
+    """以只读 mmap 方式打开指定（默认当前）版本
+
+    Returns:
+        (版本目录, manifest, 数组字典)
+    """
+    version_name = version_name or current_version_name(snapshot_dir)
+    if not version_name:
+        raise SnapshotError(f'快照目录中没有可用版本: {snapshot_dir}')
+
+    path = os.path.join(snapshot_dir, version_name)
+    with open(os.path.join(path, 'manifest.json')) as f:
+        manifest = json.load(f)
+    if manifest.get('format') != SNAPSHOT_FORMAT:
+        raise SnapshotError(f'不支持的快照格式: {manifest.get("format")}')
+
+    arrays = {name: np.load(os.path.join(path, f'{name}.npy'), mmap_mode='r') for name in names}
+    return path, manifest, arrays
+
+
+def load_snapshot(snapshot_dir=None):
+    """打开当前版本的画像快照（零拷贝）"""
+    snapshot_dir = snapshot_dir or default_snapshot_dir()
+    path, manifest, arrays = open_version(snapshot_dir, CUSTOMER_ARRAYS + MANAGER_ARRAYS)
+    return ProfileSnapshot(path, manifest, arrays)
+
+
+def _decode(value):
+    return json.loads(value) if value else []
+
+
+def branch_filter(column, branch):
+    """网点条件；UNASSIGNED_BRANCH 同时匹配空值和空字符串"""
+    if branch == UNASSIGNED_BRANCH:
+        return or_(column.is_(None), column == UNASSIGNED_BRANCH)
+    return column == branch
+
+
+def customer_rows_query(branch=None):
+    """客户资料的列查询，不构造ORM对象；指定 branch 时只查该网点"""
+    query = db.session.query(
+        CustomerProfile.user_id, CustomerProfile.id, CustomerProfile._needs,
+        CustomerProfile._hobbies, CustomerProfile.customer_class,
+        CustomerProfile.manager_id, CustomerProfile.updated_at
+    ).join(User, User.id == CustomerProfile.user_id).filter(User.role == 'customer')
+    if branch is not None:
+        query = query.filter(branch_filter(CustomerProfile.branch, branch))
+    return query
+
+
+def manager_rows_query(branch=None):
+    """经理资料的列查询，不构造ORM对象；指定 branch 时只查该网点"""
+    query = db.session.query(
+        ManagerProfile.user_id, ManagerProfile.id, ManagerProfile._capabilities,
+        ManagerProfile._hobbies, ManagerProfile.updated_at
+    ).join(User, User.id == ManagerProfile.user_id).filter(User.role == 'manager')
+    if branch is not None:
+        query = query.filter(branch_filter(ManagerProfile.branch, branch))
+    return query
+
+
+def decode_customer_rows(rows):
+    # 同一用户只保留第一份资料，与 classify_customers 中 .first() 的语义一致
+    decoded = {}
+    for user_id, profile_id, needs, hobbies, customer_class, manager_id, updated_at in rows:
+        if user_id not in decoded:
+            decoded[user_id] = (profile_id, _decode(needs), _decode(hobbies),
+                                customer_class or '', manager_id or -1, updated_at)
+    return decoded
+
+
+def decode_manager_rows(rows):
+    decoded = {}
+    for user_id, profile_id, capabilities, hobbies, updated_at in rows:
+        if user_id not in decoded:
+            decoded[user_id] = (profile_id, _decode(capabilities), _decode(hobbies), updated_at)
+    return decoded
+
+
+def manager_loads(manager_ids):
+    """一次 GROUP BY 查询出各经理当前的客户数"""
+    counts = dict(db.session.query(CustomerProfile.manager_id, func.count(CustomerProfile.id))
+                  .filter(CustomerProfile.manager_id.isnot(None))
+                  .group_by(CustomerProfile.manager_id).all())
+    return np.array([counts.get(int(m), 0) for m in manager_ids], dtype=np.int64)
+
+
+def _watermark(values):
+    values = [v for v in values if v is not None]
+    return max(values).isoformat() if values else None
+
+
+def _arrays_from_rows(customers, managers, tags):
+    """由解码后的行构造快照数组（按用户ID排序）"""
+    tag_index = {tag: j for j, tag in enumerate(tags)}
+
+    customer_ids = sorted(customers)
+    customer_rows = [customers[c] for c in customer_ids]
+    manager_ids = sorted(managers)
+    manager_rows = [managers[m] for m in manager_ids]
+
+    return {
+        'customer_ids': np.array(customer_ids, dtype=np.int64),
+        'customer_profile_ids': np.array([r[0] for r in customer_rows], dtype=np.int64),
+        'customer_needs': tag_matrix([r[1] for r in customer_rows], tag_index),
+        'customer_hobbies': tag_matrix([r[2] for r in customer_rows], tag_index),
+        'customer_classes': np.array([r[3] for r in customer_rows], dtype='<U1'),
+        'customer_managers': np.array([r[4] for r in customer_rows], dtype=np.int64),
+        'manager_ids': np.array(manager_ids, dtype=np.int64),
+        'manager_profile_ids': np.array([r[0] for r in manager_rows], dtype=np.int64),
+        'manager_capabilities': tag_matrix([r[1] for r in manager_rows], tag_index),
+        'manager_hobbies': tag_matrix([r[2] for r in manager_rows], tag_index),
+        'manager_loads': manager_loads(manager_ids),
+    }
+
+
+def _collect_tags(customers, managers):
+    # 与 feature_engineering 相同：所有需求、能力和爱好的并集并排序
+    all_tags = set()
+    for row in customers.values():
+        all_tags.update(row[1])
+        all_tags.update(row[2])
+    for row in managers.values():
+        all_tags.update(row[1])
+        all_tags.update(row[2])
+    return sorted(all_tags)
+
+
+def _collect_from_database(branch=None):
+    customers = decode_customer_rows(customer_rows_query(branch).all())
+    managers = decode_manager_rows(manager_rows_query(branch).all())
+    tags = _collect_tags(customers, managers)
+    manifest = {
+        'built_at': datetime.utcnow().isoformat(),
+        'mode': 'full',
+        'tags': tags,
+        'customer_count': len(customers),
+        'manager_count': len(managers),
+        'customer_watermark': _watermark(r[5] for r in customers.values()),
+        'manager_watermark': _watermark(r[3] for r in managers.values()),
+    }
+    return manifest, _arrays_from_rows(customers, managers, tags)
+
+
+def build_snapshot(snapshot_dir=None):
+    """从数据库全量构建一个新的快照版本
+
+    Returns:
+        新打开的 ProfileSnapshot
+    """
+    snapshot_dir = snapshot_dir or default_snapshot_dir()
+    manifest, arrays = _collect_from_database()
+    write_version(snapshot_dir, arrays, manifest)
+    return load_snapshot(snapshot_dir)
+
+
+def snapshot_from_database(branch=None):
+    """从数据库构造一个只在内存中的快照（不写文件），供一次性计算使用
+
+    指定 branch 时只包含该网点的客户和经理，标签列也只取该网点出现过的标签。
+    """
+    manifest, arrays = _collect_from_database(branch)
+    return ProfileSnapshot(None, dict(manifest, version=0), arrays)
+
+
+def _since(query, column, watermark):
+    if watermark:
+        query = query.filter(column >= datetime.fromisoformat(watermark))
+    return query
+
+
+def _apply_rows(ids, columns, changed, encoders):
+    """把变更行合并到已有数组中，新ID追加后重新排序"""
+    ids = np.array(ids)
+    columns = {name: np.array(array) for name, array in columns.items()}
+
+    new_ids = [i for i in changed if not len(ids) or not _contains(ids, i)]
+    if new_ids:
+        ids = np.concatenate([ids, np.array(new_ids, dtype=ids.dtype)])
+        for name, array in columns.items():
+            pad = np.zeros((len(new_ids),) + array.shape[1:], dtype=array.dtype)
+            columns[name] = np.concatenate([array, pad])
+        order = np.argsort(ids, kind='stable')
+        ids = ids[order]
+        columns = {name: array[order] for name, array in columns.items()}
+
+    positions = np.searchsorted(ids, list(changed))
+    for pos, row in zip(positions, changed.values()):
+        for name, encode in encoders.items():
+            columns[name][pos] = encode(row)
+    return ids, columns
+
+
+def _contains(sorted_ids, value):
+    i = np.searchsorted(sorted_ids, value)
+    return i < len(sorted_ids) and sorted_ids[i] == value
+
+
+def refresh_snapshot(snapshot_dir=None):
+    """基于 updated_at 增量刷新快照
+
+    只解码 updated_at 不早于上次水位线的资料行。出现新标签或有资料被删除时
+    无法增量合并，退化为全量构建。
+
+    Returns:
+        (ProfileSnapshot, 统计信息字典)
+    """
+    snapshot_dir = snapshot_dir or default_snapshot_dir()
+    try:
+        current = load_snapshot(snapshot_dir)
+    except SnapshotError:
+        return build_snapshot(snapshot_dir), {'mode': 'full', 'reason': 'no_snapshot'}
+
+    manifest = current.manifest
+    changed_customers = decode_customer_rows(
+        _since(customer_rows_query(), CustomerProfile.updated_at, manifest['customer_watermark']).all())
+    changed_managers = decode_manager_rows(
+        _since(manager_rows_query(), ManagerProfile.updated_at, manifest['manager_watermark']).all())
+
+    # 新标签会改变列空间，删除无法从 updated_at 发现，两者都需要全量构建
+    tag_index = {tag: j for j, tag in enumerate(current.tags)}
+    new_tags = set(_collect_tags(changed_customers, changed_managers)) - set(tag_index)
+    db_customer_count = customer_rows_query().with_entities(func.count(func.distinct(CustomerProfile.user_id))).scalar()
+    db_manager_count = manager_rows_query().with_entities(func.count(func.distinct(ManagerProfile.user_id))).scalar()
+    added_customers = sum(1 for c in changed_customers if current.customer_index(c) is None)
+    added_managers = sum(1 for m in changed_managers if not _contains(current.manager_ids, m))
+
+    if (new_tags or db_customer_count != current.customer_count + added_customers
+            or db_manager_count != current.manager_count + added_managers):
+        reason = 'new_tags' if new_tags else 'deleted_rows'
+        return build_snapshot(snapshot_dir), {'mode': 'full', 'reason': reason}
+
+    def tags_row(tags):
+        row = np.zeros(len(tag_index), dtype=np.uint8)
+        for tag in tags:
+            row[tag_index[tag]] = 1
+        return row
+
+    customer_ids, customer_columns = _apply_rows(
+        current.customer_ids,
+        {name: getattr(current, name) for name in CUSTOMER_ARRAYS[1:]},
+        changed_customers,
+        {
+            'customer_profile_ids': lambda r: r[0],
+            'customer_needs': lambda r: tags_row(r[1]),
+            'customer_hobbies': lambda r: tags_row(r[2]),
+            'customer_classes': lambda r: r[3],
+            'customer_managers': lambda r: r[4],
+        })
+    manager_ids, manager_columns = _apply_rows(
+        current.manager_ids,
+        {name: getattr(current, name) for name in MANAGER_ARRAYS[1:-1]},
+        changed_managers,
+        {
+            'manager_profile_ids': lambda r: r[0],
+            'manager_capabilities': lambda r: tags_row(r[1]),
+            'manager_hobbies': lambda r: tags_row(r[2]),
+        })
+
+    arrays = dict(customer_columns, customer_ids=customer_ids,
+                  manager_ids=manager_ids, manager_loads=manager_loads(manager_ids), **manager_columns)
+
+    manifest = dict(
+        manifest,
+        built_at=datetime.utcnow().isoformat(),
+        mode='incremental',
+        base_version=current.version,
+        customer_count=len(customer_ids),
+        manager_count=len(manager_ids),
+        customer_watermark=_watermark([r[5] for r in changed_customers.values()]
+                                      + [_parse(manifest['customer_watermark'])]),
+        manager_watermark=_watermark([r[3] for r in changed_managers.values()]
+                                     + [_parse(manifest['manager_watermark'])]),
+    )
+    write_version(snapshot_dir, arrays, manifest)
+    return load_snapshot(snapshot_dir), {
+        'mode': 'incremental',
+        'changed_customers': len(changed_customers),
+        'changed_managers': len(changed_managers),
+    }
+
+
+def _parse(value):
+    return datetime.fromisoformat(value) if value else None
+
+
+def verify_snapshot(snapshot=None, sample_size=200):
+    """检查快照与数据库是否一致
+
+    比较ID集合、经理负载和客户等级分布，并对随机抽样的客户逐行比对标签。
+
+    Returns:
+        问题描述列表，为空表示一致
+    """
+    snapshot = snapshot or load_snapshot()
+    problems = []
+
+    db_customer_ids = sorted({row[0] for row in customer_rows_query().with_entities(CustomerProfile.user_id)})
+    db_manager_ids = sorted({row[0] for row in manager_rows_query().with_entities(ManagerProfile.user_id)})
+    if db_customer_ids != snapshot.customer_ids.tolist():
+        problems.append(f'客户ID集合不一致: 数据库{len(db_customer_ids)}个, 快照{snapshot.customer_count}个')
+    if db_manager_ids != snapshot.manager_ids.tolist():
+        problems.append(f'经理ID集合不一致: 数据库{len(db_manager_ids)}个, 快照{snapshot.manager_count}个')
+
+    if not problems:
+        db_loads = manager_loads(snapshot.manager_ids)
+        for manager_id, expected, actual in zip(snapshot.manager_ids, db_loads, snapshot.manager_loads):
+            if expected != actual:
+                problems.append(f'经理{manager_id}负载不一致: 数据库{expected}, 快照{actual}')
+
+        class_rows = db.session.query(CustomerProfile.customer_class, func.count(CustomerProfile.id)) \
+            .filter(CustomerProfile.user_id.in_(db_customer_ids)).group_by(CustomerProfile.customer_class).all()
+        db_classes = {(c or ''): n for c, n in class_rows}
+        names, counts = np.unique(snapshot.customer_classes, return_counts=True)
+        snapshot_classes = dict(zip(names.tolist(), counts.tolist()))
+        if db_classes != snapshot_classes:
+            problems.append(f'客户等级分布不一致: 数据库{db_classes}, 快照{snapshot_classes}')
+
+        sample = random.sample(db_customer_ids, min(sample_size, len(db_customer_ids)))
+        rows = decode_customer_rows(customer_rows_query().filter(CustomerProfile.user_id.in_(sample)).all())
+        tags = np.array(snapshot.tags)
+        for user_id, row in rows.items():
+            i = snapshot.customer_index(user_id)
+            if (set(row[1]) != set(tags[snapshot.customer_needs[i] == 1])
+                    or set(row[2]) != set(tags[snapshot.customer_hobbies[i] == 1])):
+                problems.append(f'客户{user_id}的标签与数据库不一致')
+
+    return problems
@@ -0,0 +1,234 @@
+
+"""
+内存受限的流式客户分类
+classify_customers 会同时持有全部客户的 ORM 对象、特征矩阵和结果字典，客户数到百万级时超出 worker 内存。
+流式模式下内存只与块大小和经理数有关：
+- K-Means 在按用户ID取模抽出的样本上拟合，之后逐块 predict
+- 客户资料在单独的连接上用 yield_per 流式读取，写入和提交走 db.session 自己的连接
+  （SQLite 在读游标未关闭时无法提交，退化为按用户ID键集分页）
+- 每块与经理模型打分、写回客户等级（以及可选的结果文件和分数缓存）后立即提交并清空会话
+- 每块结束前采样常驻内存，超过预算时把后续块大小减半，减到下限仍超出时中止（已提交的块保留）
+"""
+
+import json
+import os
+import time
+from collections import Counter
+
+import numpy as np
+from sqlalchemy import func
+
+from app import db
+from app.models import CustomerProfile
+from app.utils.class_rules import active_rules
+from app.utils.engine import cluster_count
+from app.utils.events import report_progress
+from app.utils.manager_model import build_manager_model
+from app.utils.score_cache import replace_rows, top_n_rows
+from app.utils.snapshot import customer_rows_query, decode_customer_rows, tag_matrix
+
+# 内存超出预算时块大小的下限
+MIN_CHUNK_SIZE = 100
+
+
+class MemoryBudgetExceeded(Exception):
+    """块大小已经减到下限，常驻内存仍超过预算"""
+
+
+def current_rss():
+    """当前进程的常驻内存（字节）；没有 /proc 时退化为进程历史峰值"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _mb(size):
+    return round(size / 1024 / 1024, 1)
+
+
+def _features(rows, tag_index):
+    """客户特征为需求和爱好的并集，与 feature_engineering 相同"""
+    return (tag_matrix([r[1] for r in rows], tag_index) | tag_matrix([r[2] for r in rows], tag_index)).astype(np.float64)
+
+
+def fit_sample_kmeans(model, total, sample_size):
+    """在客户样本上拟合 K-Means
+
+    样本按用户ID取模抽取（结果确定、不需要全表扫描），词表为经理标签与样本中出现的标签的并集，
+    样本中没有出现过的客户标签在 predict 时被忽略。
+
+    Returns:
+        (KMeans 模型, 特征列的标签索引, 样本客户数)
+    """
+    from sklearn.cluster import KMeans
+
+    stride = max(1, total // sample_size)
+    query = customer_rows_query().order_by(CustomerProfile.user_id)
+    sample = decode_customer_rows(query.filter(CustomerProfile.user_id % stride == 0).limit(sample_size).all())
+    if not sample:
+        sample = decode_customer_rows(query.limit(sample_size).all())
+    rows = list(sample.values())
+
+    tags = set(model.tags)
+    for row in rows:
+        tags.update(row[1])
+        tags.update(row[2])
+    tag_index = {tag: j for j, tag in enumerate(sorted(tags))}
+
+    n_clusters = min(cluster_count(total, model.manager_count), len(rows))
+    kmeans = KMeans(n_clusters=n_clusters, init='k-means++', random_state=42, n_init=10)
+    kmeans.fit(_features(rows, tag_index))
+    return kmeans, tag_index, len(rows)
+
+
+def stream_customer_rows(chunk_size):
+    """按用户ID顺序逐块读取客户资料行
+
+    Args:
+        chunk_size: 返回当前块大小的函数，每读一块调用一次（预算收紧后可以变小）
+    """
+    query = customer_rows_query()
+    if db.engine.dialect.name == 'sqlite':
+        last_id = 0
+        while True:
+            rows = query.filter(CustomerProfile.user_id > last_id) \
+                .order_by(CustomerProfile.user_id).limit(chunk_size()).all()
+            if not rows:
+                return
+            yield rows
+            last_id = rows[-1][0]
+    else:
+        with db.engine.connect() as connection:
+            result = connection.execution_options(yield_per=chunk_size()).execute(
+                query.order_by(CustomerProfile.user_id, CustomerProfile.id).statement)
+            while True:
+                rows = result.fetchmany(chunk_size())
+                if not rows:
+                    return
+                yield rows
+
+
+def _initial_chunk_size(chunk_size, budget, baseline, manager_count, tag_count):
+    """按每个客户的估算占用把块大小限制在剩余预算的一半以内
+
+    每个客户约占：三个 int32 的重合数/总分行、一个 int64 的排序行（经理数），
+    两个标签行和特征行（词表大小），以及解码后的资料元组。
+    """
+    if not budget:
+        return chunk_size
+    per_row = 20 * manager_count + 10 * tag_count + 2048
+    return max(MIN_CHUNK_SIZE, min(chunk_size, (budget - baseline) // (2 * per_row)))
+
+
+def stream_classify(chunk_size=5000, sample_size=20000, memory_budget_mb=None, out_path=None,
+                    score_cache_n=None, echo=None):
+    """流式对所有客户分类，只写回客户等级，不在内存中保留全量结果
+
+    Args:
+        chunk_size: 每块处理并提交的客户数（设置了预算时可能被调小）
+        sample_size: 拟合 K-Means 的样本客户数
+        memory_budget_mb: 常驻内存预算（MB），为空时不限制
+        out_path: 可选的 JSON Lines 结果文件，每行与 classify_customers 结果中的一项相同并带 customer_id
+        score_cache_n: 同时写入的分数缓存深度，为空时不更新缓存
+        echo: 进度输出函数
+
+    Returns:
+        报告字典：处理的客户数、块数、最终块大小、聚类数、各等级人数、基线和峰值常驻内存
+    """
+    echo = echo or (lambda message: None)
+    started = time.perf_counter()
+    budget = memory_budget_mb * 1024 * 1024 if memory_budget_mb else None
+    baseline = peak = current_rss()
+    if budget and baseline >= budget:
+        raise MemoryBudgetExceeded(f'启动时常驻内存 {_mb(baseline)}MB 已超过预算 {memory_budget_mb}MB')
+
+    report = {
+        'classified': 0, 'chunks': 0, 'chunk_size': chunk_size, 'sample_size': 0, 'n_clusters': 0,
+        'class_counts': {}, 'baseline_rss_mb': _mb(baseline), 'peak_rss_mb': _mb(baseline),
+        'memory_budget_mb': memory_budget_mb, 'seconds': 0.0,
+    }
+    model = build_manager_model()
+    rules = active_rules()
+    total = customer_rows_query().with_entities(func.count(func.distinct(CustomerProfile.user_id))).scalar()
+    if not model.manager_count or not total:
+        return report
+
+    kmeans, tag_index, report['sample_size'] = fit_sample_kmeans(model, total, sample_size)
+    report['n_clusters'] = int(kmeans.n_clusters)
+    size = _initial_chunk_size(chunk_size, budget, current_rss(), model.manager_count, len(tag_index))
+    echo(f'样本{report["sample_size"]}个客户拟合{report["n_clusters"]}个聚类，块大小{size}')
+
+    class_counts = Counter()
+    last_user_id = None
+    out = open(out_path, 'w', encoding='utf-8') if out_path else None
+    try:
+        for raw_rows in stream_customer_rows(lambda: size):
+            # 同一用户的多份资料可能跨块，只保留第一份
+            chunk = decode_customer_rows(r for r in raw_rows if r[0] != last_user_id)
+            last_user_id = raw_rows[-1][0]
+            if not chunk:
+                continue
+            customer_ids = list(chunk)
+            rows = list(chunk.values())
+
+            needs_overlap, hobbies_overlap = model.score_many([r[1] for r in rows], [r[2] for r in rows])
+            best = np.argmax(needs_overlap + hobbies_overlap, axis=1)
+            index = np.arange(len(rows))
+            needs_match = needs_overlap[index, best]
+            hobbies_match = hobbies_overlap[index, best]
+            classes = rules.classify(needs_match, hobbies_match)
+            clusters = kmeans.predict(_features(rows, tag_index))
+
+            db.session.bulk_update_mappings(CustomerProfile, [
+                {'id': row[0], 'customer_class': str(classes[i]),
+                 'best_needs_match': int(needs_match[i]), 'best_hobbies_match': int(hobbies_match[i])}
+                for i, row in enumerate(rows)
+            ])
+            if score_cache_n:
+                replace_rows(customer_ids, top_n_rows(customer_ids, needs_overlap, hobbies_overlap,
+                                                      model.manager_ids, score_cache_n))
+            if out is not None:
+                for i, customer_id in enumerate(customer_ids):
+                    out.write(json.dumps({
+                        'customer_id': customer_id,
+                        'cluster': int(clusters[i]),
+                        'customer_class': str(classes[i]),
+                        'best_manager_id': int(model.manager_ids[best[i]]),
+                        'similarity_score': {
+                            'total_match': int(needs_match[i] + hobbies_match[i]),
+                            'needs_match': int(needs_match[i]),
+                            'hobbies_match': int(hobbies_match[i]),
+                            'customer_class': str(classes[i]),
+                        },
+                    }, ensure_ascii=False) + '\n')
+
+            # 打分矩阵仍然存活时采样，得到的是这一块的峰值
+            rss = current_rss()
+            peak = max(peak, rss)
+            db.session.commit()
+            db.session.expunge_all()
+
+            class_counts.update(str(c) for c in classes)
+            report['classified'] += len(rows)
+            report['chunks'] += 1
+            echo(f'已分类{report["classified"]}/{total}个客户，常驻内存{_mb(rss)}MB')
+            report_progress('classify', report['classified'], total)
+
+            if budget and rss > budget:
+                if size <= MIN_CHUNK_SIZE:
+                    raise MemoryBudgetExceeded(
+                        f'块大小已降到{size}，常驻内存 {_mb(rss)}MB 仍超过预算 {memory_budget_mb}MB')
+                size = max(MIN_CHUNK_SIZE, size // 2)
+                echo(f'超出内存预算，块大小减为{size}')
+    finally:
+        if out is not None:
+            out.close()
+        report['chunk_size'] = size
+        report['class_counts'] = dict(sorted(class_counts.items()))
+        report['peak_rss_mb'] = _mb(peak)
+        report['seconds'] = round(time.perf_counter() - started, 3)
+
+    return report
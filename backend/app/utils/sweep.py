@@ -0,0 +1,206 @@
+
+"""
+等级规则和经理容量的假设分析
+在一份只读的画像快照上同时评估多组规则（阈值、升级差值、经理容量），不写数据库。
+每个客户与最佳经理的重合数与规则无关，只计算一次；各方案只需用查找表重新分级、
+按方案的容量模拟一次自动分配，再统计等级分布、未分配人数、经理负载和平均匹配分数。
+方案在进程池中并行评估，输入数组放在共享内存中（见 parallel 模块），子进程只收到方案参数。
+"""
+
+import itertools
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from app.utils import parallel
+from app.utils.engine import CLASS_LEVELS, ClassRules, MatchData, assign, best_manager_matches
+
+# 计算非最佳经理的匹配分数时每块的客户数
+PAIR_CHUNK = 50_000
+
+# 比较表的列：(标题, 结果中的键)
+TABLE_COLUMNS = [
+    ('方案', 'name'), ('阈值', 'thresholds'), ('升级', 'upgrade_margin'), ('容量', 'capacity'),
+] + [(level, f'class_{level}') for level in CLASS_LEVELS[::-1]] + [
+    ('新分配', 'assigned'), ('未分配', 'unassigned'), ('最小负载', 'load_min'), ('最大负载', 'load_max'),
+    ('负载标准差', 'load_std'), ('超容量经理', 'overloaded_managers'), ('平均分', 'mean_score'),
+    ('最佳经理占比', 'best_manager_share'),
+]
+
+
+def scenario_grid(thresholds=(), upgrade_margins=(), capacities=(), base=None):
+    """由各参数的候选值生成全部组合，未给出候选值的参数沿用 base（默认为内置规则）
+
+    Args:
+        thresholds: 阈值列表的候选，如 [[4, 7, 10, 13], [3, 6, 9, 12]]
+        upgrade_margins: 升级差值的候选，None 表示不升级
+
+    Returns:
+        [(方案名, ClassRules)]，base 本身排在第一个作为基线
+    """
+    base = base or ClassRules()
+    scenarios = [('基线', base)]
+    for values in itertools.product(thresholds or [base.thresholds.tolist()],
+                                    upgrade_margins or [base.upgrade_margin],
+                                    capacities or [base.capacity]):
+        rules = ClassRules(*values)
+        if all(rules != existing for _, existing in scenarios):
+            scenarios.append((f'S{len(scenarios)}', rules))
+    return scenarios
+
+
+def _pair_totals(arrays, rows, managers):
+    """这些 (客户行, 经理行) 对的总重合数"""
+    totals = np.zeros(len(rows), dtype=np.int64)
+    for start in range(0, len(rows), PAIR_CHUNK):
+        r = rows[start:start + PAIR_CHUNK]
+        m = managers[start:start + PAIR_CHUNK]
+        totals[start:start + PAIR_CHUNK] = (
+            np.count_nonzero(np.logical_and(arrays['customer_needs'][r], arrays['manager_capabilities'][m]), axis=1)
+            + np.count_nonzero(np.logical_and(arrays['customer_hobbies'][r], arrays['manager_hobbies'][m]), axis=1))
+    return totals
+
+
+def evaluate(arrays, name, rules):
+    """在已经算好的最佳经理和重合数上评估一个方案
+
+    Args:
+        arrays: customer_ids、customer_managers、manager_ids、manager_loads、四个标签矩阵，
+            以及 best、needs_match、hobbies_match（与客户顺序一致）
+
+    Returns:
+        方案结果字典（TABLE_COLUMNS 中的各项）
+    """
+    needs_match = arrays['needs_match']
+    hobbies_match = arrays['hobbies_match']
+    classes = rules.lookup_table(int(needs_match.max(initial=0)), int(hobbies_match.max(initial=0)))[
+        needs_match, hobbies_match]
+    manager_ids = arrays['manager_ids']
+    data = MatchData(arrays['customer_ids'], manager_ids,
+                     customer_managers=arrays['customer_managers'], manager_loads=arrays['manager_loads'])
+    assignments = assign(data, data.customer_ids.tolist(), classes.tolist(),
+                         manager_ids[arrays['best']].tolist(), capacity=rules.capacity)
+
+    # 最终的分配关系：原有经理加上新分配
+    final = np.array(data.customer_managers)
+    if assignments:
+        customer_rows = np.searchsorted(data.customer_ids, np.fromiter(assignments, dtype=np.int64))
+        final[customer_rows] = np.fromiter(assignments.values(), dtype=np.int64)
+    has_manager = final != -1
+    manager_rows = np.searchsorted(manager_ids, final[has_manager])
+    # 负载从快照中的负载（含快照外的客户）加上新分配
+    loads = np.asarray(data.manager_loads, dtype=np.int64) + np.bincount(
+        np.searchsorted(manager_ids, np.fromiter(assignments.values(), dtype=np.int64, count=len(assignments))),
+        minlength=len(manager_ids))
+
+    # 分给最佳经理的直接用已有的重合数，其余的逐对计算
+    rows = np.flatnonzero(has_manager)
+    at_best = manager_rows == arrays['best'][rows]
+    totals = np.empty(len(rows), dtype=np.int64)
+    totals[at_best] = needs_match[rows[at_best]] + hobbies_match[rows[at_best]]
+    totals[~at_best] = _pair_totals(arrays, rows[~at_best], manager_rows[~at_best])
+
+    levels, counts = np.unique(classes, return_counts=True)
+    class_counts = dict(zip(levels.tolist(), counts.tolist()))
+    result = {
+        'name': name,
+        'thresholds': ','.join(map(str, rules.thresholds.tolist())),
+        'upgrade_margin': rules.upgrade_margin,
+        'capacity': rules.capacity,
+        'assigned': len(assignments),
+        'unassigned': int((~has_manager).sum()),
+        'load_min': int(loads.min()),
+        'load_max': int(loads.max()),
+        'load_std': round(float(loads.std()), 2),
+        'overloaded_managers': int((loads > rules.capacity).sum()),
+        'mean_score': round(float(totals.mean()), 3) if len(totals) else 0.0,
+        'best_manager_share': round(float(at_best.mean()), 4) if len(at_best) else 0.0,
+    }
+    result.update({f'class_{level}': class_counts.get(level, 0) for level in CLASS_LEVELS})
+    return result
+
+
+def _evaluate_shared(scenario):
+    name, rules = scenario
+    return evaluate(parallel._shared, name, ClassRules(**rules))
+
+
+def sweep(data, scenarios, workers=None, from_scratch=False):
+    """在一份快照上评估全部方案（只读，不写数据库）
+
+    Args:
+        data: ProfileSnapshot 或 MatchData（需要标签矩阵）
+        scenarios: [(方案名, ClassRules)]，见 scenario_grid
+        workers: 进程数，默认为 CPU 核数与方案数中较小的；为1时在当前进程中依次评估
+        from_scratch: 把所有客户视为未分配、经理负载从0开始（比较重新全量分配的结果），
+            否则与 /api/admin/auto-assign 一样只分配当前没有经理的客户
+
+    Returns:
+        (各方案结果列表, 共用的打分耗时统计)
+
+    Raises:
+        ValueError: 快照中没有客户或经理
+    """
+    if not len(data.customer_ids) or not len(data.manager_ids):
+        raise ValueError('快照中没有客户或经理')
+
+    started = time.perf_counter()
+    best, needs_match, hobbies_match = best_manager_matches(
+        data.customer_needs, data.customer_hobbies, data.manager_capabilities, data.manager_hobbies)
+    score_seconds = time.perf_counter() - started
+
+    customer_count = len(data.customer_ids)
+    arrays = {
+        'customer_ids': np.asarray(data.customer_ids, dtype=np.int64),
+        'manager_ids': np.asarray(data.manager_ids, dtype=np.int64),
+        'customer_managers': np.full(customer_count, -1, dtype=np.int64) if from_scratch
+        else np.asarray(data.customer_managers, dtype=np.int64),
+        'manager_loads': np.zeros(len(data.manager_ids), dtype=np.int64) if from_scratch
+        else np.asarray(data.manager_loads, dtype=np.int64),
+        'customer_needs': data.customer_needs, 'customer_hobbies': data.customer_hobbies,
+        'manager_capabilities': data.manager_capabilities, 'manager_hobbies': data.manager_hobbies,
+        'best': best, 'needs_match': needs_match, 'hobbies_match': hobbies_match,
+    }
+
+    workers = min(workers or os.cpu_count() or 1, len(scenarios))
+    started = time.perf_counter()
+    if workers <= 1:
+        results = [evaluate(arrays, name, rules) for name, rules in scenarios]
+    else:
+        blocks = {}
+        specs = {}
+        try:
+            for name, array in arrays.items():
+                blocks[name], specs[name] = parallel._to_shared(array)
+            payload = [(name, {'thresholds': rules.thresholds.tolist(), 'upgrade_margin': rules.upgrade_margin,
+                               'capacity': rules.capacity}) for name, rules in scenarios]
+            with ProcessPoolExecutor(max_workers=workers, initializer=parallel._attach,
+                                     initargs=(specs,)) as pool:
+                results = list(pool.map(_evaluate_shared, payload))
+        finally:
+            for shm in blocks.values():
+                shm.close()
+                shm.unlink()
+    return results, {
+        'customer_count': customer_count,
+        'manager_count': len(data.manager_ids),
+        'score_seconds': round(score_seconds, 3),
+        'evaluate_seconds': round(time.perf_counter() - started, 3),
+        'workers': workers,
+    }
+
+
+def format_table(results):
+    """比较表（等宽文本），第一行为基线"""
+    rows = [[title for title, _ in TABLE_COLUMNS]]
+    rows += [['-' if result[key] is None else str(result[key]) for _, key in TABLE_COLUMNS] for result in results]
+    widths = [max(_display_width(row[i]) for row in rows) for i in range(len(TABLE_COLUMNS))]
+    return '\n'.join('  '.join(cell + ' ' * (width - _display_width(cell)) for cell, width in zip(row, widths))
+                     for row in rows)
+
+
+def _display_width(text):
+    # 中文字符在终端中占两列
+    return sum(2 if ord(char) > 0x2e80 else 1 for char in text)